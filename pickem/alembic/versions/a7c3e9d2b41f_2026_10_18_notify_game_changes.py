@@ -0,0 +1,45 @@
+"""2026-10-18_Notify game changes
+
+Revision ID: a7c3e9d2b41f
+Revises: f06b1ea5ba44
+Create Date: 2026-10-18 10:12:31.402177
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'a7c3e9d2b41f'
+down_revision: Union[str, None] = 'f06b1ea5ba44'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # Sends the ID of every inserted, updated or deleted game on the games_changed channel,
+    # so the API can refresh its in-memory schedule (see pickem/lib/schedule.py).
+    op.execute("""
+        CREATE OR REPLACE FUNCTION notify_games_changed() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP = 'DELETE' THEN
+                PERFORM pg_notify('games_changed', OLD.id::text);
+                RETURN OLD;
+            END IF;
+            PERFORM pg_notify('games_changed', NEW.id::text);
+            RETURN NEW;
+        END;
+        $$ LANGUAGE plpgsql;
+    """)
+    op.execute("""
+        CREATE TRIGGER games_changed
+        AFTER INSERT OR UPDATE OR DELETE ON games
+        FOR EACH ROW EXECUTE FUNCTION notify_games_changed();
+    """)
+
+
+def downgrade() -> None:
+    op.execute("DROP TRIGGER IF EXISTS games_changed ON games;")
+    op.execute("DROP FUNCTION IF EXISTS notify_games_changed();")
@@ -1,15 +1,39 @@
-import redis
 from sqlalchemy import create_engine
+from sqlalchemy.engine import make_url, URL
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 from dotenv import load_dotenv
 import os
 
+from pickem.db.pool import getPoolSettings, configurePool
+
 load_dotenv()
 
+
+def getAsyncDatabaseURL(url: str) -> URL:
+    """ Converts the (psycopg2) DATABASE_URL to one that uses asyncpg, which doesn't understand `sslmode`. """
+    asyncURL = make_url(url).set(drivername="postgresql+asyncpg")
+    if "sslmode" in asyncURL.query:
+        asyncURL = asyncURL.update_query_dict({"ssl": asyncURL.query["sslmode"]}).difference_update_query(["sslmode"])
+    return asyncURL
+
+
+# The sync engine is still used by alembic and the scripts, the API itself uses the async engine.
 engine = create_engine(os.getenv("DATABASE_URL"), pool_pre_ping=True)
+# Pool size, overflow, recycling and pre-pinging are configured through the environment, see pickem.db.pool
+async_engine = create_async_engine(getAsyncDatabaseURL(os.getenv("DATABASE_URL")), **getPoolSettings())
+configurePool(async_engine)
+
+# Optional read replica for read-heavy endpoints. Without one, reads just go to the primary.
+if os.getenv("DATABASE_REPLICA_URL"):
+    replica_engine = create_async_engine(getAsyncDatabaseURL(os.getenv("DATABASE_REPLICA_URL")), **getPoolSettings())
+    configurePool(replica_engine)
+else:
+    replica_engine = async_engine
 
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+# Objects are returned to the client after commits, so don't expire them (that would need another query to reload).
+AsyncSessionLocal = async_sessionmaker(bind=async_engine, autoflush=False, expire_on_commit=False)
+AsyncReadSessionLocal = async_sessionmaker(bind=replica_engine, autoflush=False, expire_on_commit=False)
 Base = declarative_base()
-
-RedisPool = redis.ConnectionPool.from_url(os.getenv("REDIS_URL"))
\ No newline at end of file
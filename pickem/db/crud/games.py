@@ -1,83 +1,135 @@
 import datetime
 from typing import List
 
-from sqlalchemy import func, select
-from sqlalchemy.orm import Session, aliased
-from pickem.db import models, schemas
+from sqlalchemy import and_, or_, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from pickem.db import models
+from pickem.lib.cache import Cache, dateTag, gameTag, seriesTag
+from pickem.lib.schedule import GameRecord, Schedule
+from pickem.lib.teams import TeamRecord, Teams
 
 
-def getGameBaseQuery(db: Session):
-    """ This is the generic query that gets a game, but also with its team names,
-    it should be used for context for every query to fetch a game."""
-    homeTeam = aliased(models.Team, name="ht")
-    awayTeam = aliased(models.Team, name="at")
-    return (db.query(models.Game, homeTeam.teamName, awayTeam.teamName)
-            .join(homeTeam, onclause=homeTeam.id == models.Game.homeTeam_id)
-            .join(awayTeam, onclause=awayTeam.id == models.Game.awayTeam_id))
+def getGameBaseQuery():
+    """ This is the generic query that gets a game, it should be used for every query to fetch a game.
+    Team names aren't joined in, they come from the team registry (see withTeamNames)."""
+    return select(models.Game)
 
 
-def cleanupGameArraysWithTeams(games):
-    """This cleans up the game queries with multiple results to be able to easily parse into a JSON-format."""
-    for game, homeName, awayName in games:
-        game.homeName = homeName
-        game.awayName = awayName
-    return [game for game, _, _ in games]
+async def withTeamNames(db: AsyncSession, games):
+    """Attaches the team names to the games from the team registry, to be able to easily parse into a JSON-format."""
+    teams = await Teams.get(db, {teamID for game in games for teamID in (game.homeTeam_id, game.awayTeam_id)})
+    for game in games:
+        game.homeName = teams.getTeamByID(game.homeTeam_id).teamName
+        game.awayName = teams.getTeamByID(game.awayTeam_id).teamName
+    return games
 
 
-def getAllTeams(db: Session):
-    return db.query(models.Team).all()
+async def loadGameRecords(db: AsyncSession, gameIDs: list[int] | None = None) -> list[GameRecord]:
+    """ Loads games (all of them, or only the given IDs) as immutable records for the schedule index. """
+    query = getGameBaseQuery()
+    if gameIDs is not None:
+        query = query.where(models.Game.id.in_(gameIDs))
+    games = await withTeamNames(db, (await db.scalars(query)).all())
+    return [GameRecord.fromGame(game, game.homeName, game.awayName) for game in games]
 
 
-def getTeam(db: Session, team_id: int):
-    return db.query(models.Team).filter(models.Team.id == team_id).first()
+async def invalidateGames(games: list[GameRecord]):
+    """ Invalidates the cached responses that depend on the games (their IDs, dates and series). """
+    tags = set()
+    for game in games:
+        tags.update((gameTag(game.id), dateTag(game.date)))
+        if game.series_num is not None:
+            tags.add(seriesTag(game.series_num))
+    await Cache.invalidateTags(*tags)
 
 
-def getTeamByAbbr(db: Session, abbr: str):
-    return db.query(models.Team).filter(models.Team.abbr == abbr).first()
+async def getAllTeams(db: AsyncSession) -> List[TeamRecord]:
+    return (await Teams.get(db)).getAllTeams()
 
 
-async def getGame(db: Session, gameID: int) -> models.Game | None:
-    try:
-        game, homeTeamName, awayTeamName = (await getGameBaseQuery(db)
-                                            .filter(models.Game.id == gameID)
-                                            .first())
-        game.homeName = homeTeamName
-        if game is not None:
-            game.awayName = awayTeamName
-            return game
-    except TypeError as e:
-        return None
-
-
-def getGamesWithTeams(db: Session, team1_id: int, team2_id: int):
-    homeTeam = aliased(models.Team, name="ht")
-    awayTeam = aliased(models.Team, name="at")
-    return cleanupGameArraysWithTeams(
-        getGameBaseQuery(db)
-        .filter(
-            (models.Game.homeTeam_id == team1_id and models.Game.awayTeam_id == team2_id) or
-            (models.Game.homeTeam_id == team2_id and models.Game.awayTeam_id == team1_id)
-        ).all())
+async def getTeam(db: AsyncSession, team_id: int) -> TeamRecord | None:
+    return (await Teams.get(db)).getTeamByID(team_id)
 
 
-def getGamesWithAbbr(db: Session, team1_abbr: str, team2_abbr: str):
-    subquery = db.query(models.Team.id).where(models.Team.abbr.in_([team1_abbr, team2_abbr]))
-    return cleanupGameArraysWithTeams(
-        getGameBaseQuery(db)
-        .filter(models.Game.homeTeam_id.in_(subquery))
-        .filter(models.Game.awayTeam_id.in_(subquery))
-        .order_by(models.Game.startTimeUTC)
-        .all())
+async def getTeamByAbbr(db: AsyncSession, abbr: str) -> TeamRecord | None:
+    return (await Teams.get(db)).getTeamByAbbr(abbr)
 
 
-def getGamesByDate(db: Session, year: int, month: int, day: int):
-    return cleanupGameArraysWithTeams(
-        getGameBaseQuery(db)
-        .filter(models.Game.date == datetime.date(year, month, day))
-        .all()
-    )
-
-
-def getGamesByIDs(db: Session, gameIDs: List[int]) -> List[models.Game]:
+async def getGame(db: AsyncSession, gameID: int) -> models.Game | GameRecord | None:
+    if Schedule.index is not None:
+        return Schedule.index.getGame(gameID)
+    game = (await db.scalars(getGameBaseQuery().where(models.Game.id == gameID))).first()
+    if game is None:
+        return None
+    return (await withTeamNames(db, [game]))[0]
+
+
+def getSeasonBounds(season: int | None, startDate: datetime.date | None = None,
+                    endDate: datetime.date | None = None) -> tuple[datetime.date | None, datetime.date | None]:
+    """ Narrows the (optional) date range to the given season. A season is a calendar year. """
+    if season is not None:
+        startDate = max(startDate or datetime.date.min, datetime.date(season, 1, 1))
+        endDate = min(endDate or datetime.date.max, datetime.date(season, 12, 31))
+    return startDate, endDate
+
+
+def getHeadToHeadQuery(team1_id: int, team2_id: int, startDate: datetime.date | None = None,
+                       endDate: datetime.date | None = None):
+    """
+    The query for games between two teams (either one at home), optionally between two dates (inclusive).
+    Each side of the OR matches a prefix of the (homeTeam_id, awayTeam_id, date) index, so Postgres can answer it with
+    two index scans instead of going through every game.
+    """
+    query = getGameBaseQuery().where(or_(
+        and_(models.Game.homeTeam_id == team1_id, models.Game.awayTeam_id == team2_id),
+        and_(models.Game.homeTeam_id == team2_id, models.Game.awayTeam_id == team1_id),
+    ))
+    if startDate is not None:
+        query = query.where(models.Game.date >= startDate)
+    if endDate is not None:
+        query = query.where(models.Game.date <= endDate)
+    return query.order_by(models.Game.date, models.Game.startTimeUTC, models.Game.id)
+
+
+async def getGamesWithTeams(db: AsyncSession, team1_id: int, team2_id: int, season: int | None = None,
+                            startDate: datetime.date | None = None, endDate: datetime.date | None = None):
+    """
+    Gets the games between two teams, ordered by date and start time.
+    :param season: only the games of this season
+    :param startDate: only the games on or after this date
+    :param endDate: only the games on or before this date
+    """
+    startDate, endDate = getSeasonBounds(season, startDate, endDate)
+    if Schedule.index is not None:
+        return [game for game in Schedule.index.getGamesWithTeams(team1_id, team2_id)
+                if (startDate is None or game.date >= startDate) and (endDate is None or game.date <= endDate)]
+    return await withTeamNames(db, (await db.scalars(getHeadToHeadQuery(team1_id, team2_id, startDate, endDate))).all())
+
+
+async def getGamesWithAbbr(db: AsyncSession, team1_abbr: str, team2_abbr: str, season: int | None = None,
+                           startDate: datetime.date | None = None, endDate: datetime.date | None = None):
+    """ Same as getGamesWithTeams, with the teams given by their abbreviation. """
+    team1, team2 = await getTeamByAbbr(db, team1_abbr), await getTeamByAbbr(db, team2_abbr)
+    if team1 is None or team2 is None:
+        return []
+    return await getGamesWithTeams(db, team1.id, team2.id, season, startDate, endDate)
+
+
+async def getGamesByDate(db: AsyncSession, year: int, month: int, day: int):
+    """ Gets the games on a date, from the schedule index if it's loaded. """
+    if Schedule.index is not None:
+        return Schedule.index.getGamesByDate(datetime.date(year, month, day))
+    return await queryGamesByDate(db, year, month, day)
+
+
+async def queryGamesByDate(db: AsyncSession, year: int, month: int, day: int) -> List[models.Game]:
+    """ Gets the games on a date from the database, as ORM objects (i.e. to attach them to a session). """
+    return await withTeamNames(db, (await db.scalars(getGameBaseQuery()
+        .where(models.Game.date == datetime.date(year, month, day)))).all())
+
+
+async def getGamesByIDs(db: AsyncSession, gameIDs: List[int]) -> List[models.Game]:
     """This function is used to get a list of games by their IDs."""
-    return cleanupGameArraysWithTeams(getGameBaseQuery(db).filter(models.Game.id.in_(gameIDs)).all())
+    if Schedule.index is not None:
+        return Schedule.index.getGamesByIDs(gameIDs)
+    return await withTeamNames(db, (await db.scalars(getGameBaseQuery().where(models.Game.id.in_(gameIDs)))).all())
@@ -1,11 +1,16 @@
 import datetime
-from sqlalchemy import func, text
-from sqlalchemy.orm import Session
+from sqlalchemy import (Boolean, DateTime, Integer, String, and_, case, cast, column, delete, func, literal_column,
+                        null, or_, select, text, values)
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession
 from pickem.db import models
+from pickem.db.crud.games import getSeasonBounds, withTeamNames
 from pickem.db.schemas import PickCreate
+from pickem.lib.cache import Cache, gameTag, userTag
+from pickem.lib.ingest import GameStarted
 
 
-def getPicksByUserDate(db: Session, userID: str, year: int, month: int, day: int, isSeries: bool):
+async def getPicksByUserDate(db: AsyncSession, userID: str, year: int, month: int, day: int, isSeries: bool):
     """
     Gets the picks for a certain user on a certain date.
     :param db: Database session instance
@@ -15,38 +20,70 @@ def getPicksByUserDate(db: Session, userID: str, year: int, month: int, day: int
     :param day: Day
     :return:
     """
-    return (db.query(models.Pick.game_id, models.Pick.pickedHome, models.Pick.is_series, models.Pick.comment)
-            .join(models.Game, onclause=models.Game.id == models.Pick.game_id)
-            .filter(models.Pick.user_id == userID)
-            .filter(models.Pick.is_series == isSeries)
-            .filter(models.Game.date == datetime.date(year, month, day))
-            .all())
+    return (await db.execute(
+        select(models.Pick.game_id, models.Pick.pickedHome, models.Pick.is_series, models.Pick.comment)
+        .join(models.Game, onclause=models.Game.id == models.Pick.game_id)
+        .where(models.Pick.user_id == userID)
+        .where(models.Pick.is_series == isSeries)
+        .where(models.Game.date == datetime.date(year, month, day)))).all()
 
 
-def getPicksByUser(db: Session, userID: str):
-    return db.query(models.Pick).join(models.Pick.user_id == userID).all()
+async def getPicksByUser(db: AsyncSession, userID: str, isSeries: bool, season: int | None = None,
+                         graded: bool | None = None, limit: int = 50,
+                         after: tuple[datetime.date, int] | None = None):
+    """
+    Gets a page of a user's picks with their games, latest games first (by game date, then game ID).
+    The user's picks are found through uq_picks_user_game_series (it starts with user_id), but no index covers the
+    order, so every page joins all of the user's matching picks to their games and sorts them: the cost grows with
+    how many picks the user has (at most one per game, per season with `season`), not with the page depth.
+    :param db: Database session
+    :param userID: User ID
+    :param isSeries: Whether to get the series picks rather than the daily picks
+    :param season: Only the picks of games of that season
+    :param graded: Only the graded picks (True) or the ungraded ones (False)
+    :param limit: How many picks to get
+    :param after: The game date and game ID of the last pick of the previous page (keyset pagination)
+    :return: Rows of the pick's pickedHome, comment and correct, and its game (with team names)
+    """
+    startDate, endDate = getSeasonBounds(season)
+    query = (select(models.Pick.pickedHome, models.Pick.comment, models.Pick.correct, models.Game)
+             .join(models.Game, onclause=models.Game.id == models.Pick.game_id)
+             .where(models.Pick.user_id == userID, models.Pick.is_series == isSeries))
+    if startDate is not None:
+        query = query.where(models.Game.date.between(startDate, endDate))
+    if graded is not None:
+        query = query.where(models.Pick.correct.isnot(None) if graded else models.Pick.correct.is_(None))
+    if after is not None:
+        query = query.where(or_(models.Game.date < after[0],
+                                and_(models.Game.date == after[0], models.Game.id < after[1])))
+    rows = (await db.execute(query.order_by(models.Game.date.desc(), models.Game.id.desc()).limit(limit))).all()
+    await withTeamNames(db, [row.Game for row in rows])
+    return rows
 
 
-def getTotalPicksForGame(db: Session, gameID: int, isSeries: bool):
+async def getTalliesForGames(db: AsyncSession, gameIDs: list[int], isSeries: bool) -> dict[int, dict]:
     """
-    Gets the total number of picks, and the number of home picks and away picks for a certain game.
-    TODO: next commit: Check to see if game is series instead
+    Gets the total number of picks, and the number of home picks and away picks for multiple games.
+    Reads the counters kept by the pick_tallies trigger, games without any picks (or that don't exist) get zero counts.
     :param db: Database session
-    :param gameID: Game ID of the game to get picks for.
+    :param gameIDs: Game IDs of the games to get picks for.
     :param isSeries: Whether the picks should be queried by series or not.
-    :return: Object containing gameID, total picks, home picks, and away picks.
+    :return: Dictionary of game ID to an object containing total picks, home picks, and away picks.
     """
-    subquery = (db.query(func.count("*"))
-                .where(models.Pick.game_id == gameID, models.Pick.pickedHome, models.Pick.is_series == isSeries)
-                .scalar_subquery())
-    return (db.query(
-                func.count("*").label("total"),
-                subquery.label("home_picks"),
-                (func.count("*") - subquery).label("away_picks"))
-            .where(models.Pick.game_id == gameID, models.Pick.is_series == isSeries).first())
+    rows = (await db.scalars(select(models.PickTally).where(
+        models.PickTally.game_id.in_(gameIDs),
+        models.PickTally.is_series == isSeries))).all()
+    tallies = {gameID: {"totalPicks": 0, "homePicks": 0, "awayPicks": 0} for gameID in gameIDs}
+    for row in rows:
+        tallies[row.game_id] = {
+            "totalPicks": row.total_picks,
+            "homePicks": row.home_picks,
+            "awayPicks": row.total_picks - row.home_picks,
+        }
+    return tallies
 
 
-def get_picks(db: Session, gameIDs: list[int], isSeries: bool, userID: str = None) -> models.Pick:
+async def get_picks(db: AsyncSession, gameIDs: list[int], isSeries: bool, userID: str = None) -> models.Pick:
     """
     Gets the total number of picks, and the number of home picks and away picks for multiple specified games.
     :param db:
@@ -54,10 +91,10 @@ def get_picks(db: Session, gameIDs: list[int], isSeries: bool, userID: str = Non
     :param isSeries:
     :return: List of pick objects
     """
-    return db.query(models.Pick).filter(models.Pick.game_id.in_(gameIDs), models.Pick.user_id == userID, models.Pick.is_series == isSeries).all()
+    return (await db.scalars(select(models.Pick).where(models.Pick.game_id.in_(gameIDs), models.Pick.user_id == userID, models.Pick.is_series == isSeries))).all()
 
 
-def get_pick(db: Session, userID: str, gameID: int):
+async def get_pick(db: AsyncSession, userID: str, gameID: int):
     """
     Gets the pick for a certain game for a certain user.
     :param db: Database session to query
@@ -65,136 +102,306 @@ def get_pick(db: Session, userID: str, gameID: int):
     :param gameID: Game ID of the game picked.
     :return: The pick object.
     """
-    return db.query(models.Pick).filter(models.Pick.user_id == userID, models.Pick.game_id == gameID).first()
+    return (await db.scalars(select(models.Pick).where(models.Pick.user_id == userID, models.Pick.game_id == gameID))).first()
+
+
+def upsertPicksQuery(picks: list[dict]):
+    """
+    One statement that inserts the picks (or updates the side and comment of the ones that already exist), and adds
+    them to their user's session that has their game, if there is one. Selects the written picks, with a `created`
+    column telling whether each one was inserted (xmax is 0 for rows inserted by the statement) or updated.
+    Picks are only written for games that hadn't started (nor finished) when they were submitted: the others, and picks
+    for games that don't exist, are left out. Changing the side of a pick also clears its grade.
+    :param picks: One dictionary of pick columns (user_id, game_id, pickedHome, is_series, comment) per pick, and
+                  optionally when it was submitted (submitted_at, in UTC, now by default).
+    """
+    submitted = values(column("user_id", String), column("game_id", Integer), column("pickedHome", Boolean),
+                       column("is_series", Boolean), column("comment", String), column("submitted_at", DateTime),
+                       name="submitted").data([
+        (pick["user_id"], pick["game_id"], pick["pickedHome"], pick["is_series"], pick["comment"],
+         pick.get("submitted_at")) for pick in picks])
+    submittedAt = func.coalesce(cast(submitted.c.submitted_at, DateTime), func.timezone("utc", func.now()))
+    stillOpen = (select(submitted.c.user_id, submitted.c.game_id, submitted.c.pickedHome, submitted.c.is_series,
+                        submitted.c.comment)
+                 .join(models.Game, models.Game.id == submitted.c.game_id)
+                 .where(func.coalesce(models.Game.finished, False).is_(False),
+                        or_(models.Game.startTimeUTC.is_(None), models.Game.startTimeUTC > submittedAt))
+                 .order_by(submitted.c.user_id, submitted.c.game_id, submitted.c.is_series))
+    upsert = insert(models.Pick).from_select(["user_id", "game_id", "pickedHome", "is_series", "comment"], stillOpen)
+    upserted = (upsert.on_conflict_do_update(
+                    constraint="uq_picks_user_game_series",
+                    set_={"pickedHome": upsert.excluded.pickedHome,
+                          "comment": upsert.excluded.comment,
+                          "correct": case((models.Pick.pickedHome.is_distinct_from(upsert.excluded.pickedHome), null()),
+                                          else_=models.Pick.correct)})
+                .returning(*models.Pick.__table__.c, literal_column("xmax = 0").label("created"))
+                .cte("upserted"))
+    sessionPicks = (select(upserted.c.id, models.Session.id)
+                    .join(models.Session, and_(models.Session.user_id == upserted.c.user_id,
+                                               models.Session.is_series == upserted.c.is_series))
+                    .join(models.sessionToGames, and_(models.sessionToGames.c.session_id == models.Session.id,
+                                                      models.sessionToGames.c.game_id == upserted.c.game_id)))
+    linked = (insert(models.sessionToPicks)
+              .from_select(["pick_id", "session_id"], sessionPicks)
+              .on_conflict_do_nothing(constraint="uq_session_picks_session_pick")
+              .cte("linked"))
+    return select(upserted).add_cte(linked)
 
 
-def create_picks(db: Session, userID: str, picks: list[PickCreate]):
+async def write_picks(db: AsyncSession, picks: list[dict]):
+    """
+    Writes the picks of any number of users in one statement (see upsertPicksQuery).
+    If the same user picks the same game more than once, the last pick wins.
+    :param db: Database session
+    :param picks: One dictionary of pick columns (user_id, game_id, pickedHome, is_series, comment) per pick.
+    :return: The picks that were written (the others were for games that had started, or don't exist).
+    """
+    latest = {(pick["user_id"], pick["game_id"], pick["is_series"]): pick for pick in picks}
+    if not latest:
+        return []
+    # Sorted, so that concurrent writes lock the pick (and tally) rows in the same order.
+    written = (await db.execute(upsertPicksQuery([latest[key] for key in sorted(latest)]))).mappings().all()
+    await db.commit()
+    await Cache.invalidateTags(*{userTag(userID) for userID, _, _ in latest},
+                               *{gameTag(gameID) for _, gameID, _ in latest})
+    return written
+
+
+async def create_picks(db: AsyncSession, userID: str, picks: list[PickCreate]):
     """
     Creates a list of picks for a user.
-    Same functionality as create_pick, but for multiple picks.
-    Note that this function assumes all games picked are the same date and the same type of is_series.
-    Writes the picks to the database, updates if already present.
+    Same functionality as set_pick, but for multiple picks, still in one statement whatever the number of picks.
+    Raises GameStarted if some of the games had started (the picks of the others are still written).
     :param db: Database session
     :param userID: User ID
     :param picks: The picks for the specific database.
     :return:
     """
-    gameIDs = [pick.gameID for pick in picks]
-    games = db.query(models.Game).filter(models.Game.id.in_(gameIDs)).all()
-
-    # Check which picks already exist in this current instance
-    picksExist = db.query(models.Pick).filter(
-        models.Pick.game_id.in_(gameIDs),
-        models.Pick.user_id == userID).all()
-    picksAlreadyExist = {pick.game_id: pick for pick in picksExist}
-
-    # Check if a session exists for this user.
-    sess = db.query(models.Session).filter(
-        models.Session.user_id == userID,
-        models.Session.is_series == picks[0].isSeries,
-        models.Session.date == games[0].date).first()
-
-    # Offload anything that already exists in the session
-    picksInSess = []
-    if sess is not None:
-        picksInSess = [pick.game_id for pick in sess.picks]
-
-    pickObjects = [models.Pick(
-        user_id=userID,
-        game_id=pick.gameID,
-        pickedHome=pick.pickedHome,
-        is_series=pick.isSeries,
-        comment=pick.comment
-    ) for pick in picks]
-
-    for pickObject in pickObjects:
-        if pickObject.game_id in picksAlreadyExist:  # Update instead of add
-            existingPick = picksAlreadyExist[pickObject.game_id]
-            existingPick.pickedHome = pickObject.pickedHome
-            existingPick.is_series = pickObject.is_series
-            existingPick.comment = pickObject.comment
-            db.refresh(existingPick)
-        elif pickObject.game_id not in picksInSess:  # Add via session if present
-            sess.picks.append(pickObject)
-        else:
-            db.add(pickObject)
-
-    db.commit()
-
-def create_pick(db: Session, userID: str, gameID: int, pickedHome: bool, isSeries: bool, comment: str = ""):
-    """
-    Creates the prediction of a winner for a certain game, known as a pick. Merges pick if already exists.
-    :param db: Database session to insert into
+    written = await write_picks(db, [{
+        "user_id": userID,
+        "game_id": pick.gameID,
+        "pickedHome": pick.pickedHome,
+        "is_series": pick.isSeries,
+        "comment": pick.comment,
+    } for pick in picks])
+    started = {pick.gameID for pick in picks} - {row["game_id"] for row in written}
+    if started:
+        raise GameStarted(sorted(started))
+
+
+async def set_pick(db: AsyncSession, userID: str, gameID: int, pickedHome: bool, isSeries: bool, comment: str = ""):
+    """
+    Creates the prediction of a winner for a certain game, known as a pick, or updates it if it already exists.
+    Adds it to the user's session if the session has the game. One atomic statement, so repeated requests for the
+    same pick can't create duplicates.
+    :param db: Database session to write into
     :param userID: User ID of the pick user.
     :param gameID: Game ID of the game picked.
     :param pickedHome: Whether the user picked the home team or not. Useful to use this to store less data.
     :param isSeries: Whether the user is picking for the series as a whole, or not
     :param comment: The extra comment the user stores when making this pick.
-    :return: The pick object.
+    :return: The pick (as a dictionary of its columns), and whether it was created rather than updated.
+             Raises GameStarted (nothing is written) if the game has started.
     """
-    game = db.query(models.Game).filter(models.Game.id == gameID).first()
-    gameDate = game.date
+    row = (await db.execute(upsertPicksQuery([{
+        "user_id": userID,
+        "game_id": gameID,
+        "pickedHome": pickedHome,
+        "is_series": isSeries,
+        "comment": comment,
+    }]))).mappings().one_or_none()
+    await db.commit()
+    if row is None:
+        raise GameStarted([gameID])
+    await Cache.invalidateTags(userTag(userID), gameTag(gameID))
+    pick = dict(row)
+    return pick, pick.pop("created")
+
 
-    pick = models.Pick(
-        user_id=userID,
-        game_id=gameID,  # Field is not strictly necessary, but adding for readability's sake.
-        pickedHome=pickedHome,
-        is_series=isSeries,
-        comment=comment
+async def get_leaders(db: AsyncSession, is_series: bool):
+    """
+    Get pick leaders for the entire season: the correct and graded picks of every user with graded picks in a session.
+    Used to (re)build the leaderboards in Redis (see lib.leaderboard), and when they can't be read.
+    """
+    return (
+        (await db.execute(text("""
+            SELECT picks.user_id as "userID",
+                   sum(case when picks.correct = true then 1 else 0 end) as "correctPicks",
+                   count(picks.user_id) as "totalPicks"
+            from picks
+            WHERE picks.id in (SELECT pick_id from session_picks) and picks.is_series = :is_series
+              and picks.correct is not null
+            GROUP BY picks.user_id
+            ORDER BY "correctPicks" DESC, picks.user_id COLLATE "C" DESC;
+        """), {"is_series": is_series})).all()
     )
 
-    # Add pick to a session if necessary -- only if it matches.
-    sess = db.query(models.Session).filter(
-        models.Session.user_id == userID,
-        models.Session.date == gameDate).first()
 
-    if sess:
-        games = sess.games
-        if game in games:
-            sess.picks.append(pick)
-        else:
-            db.add(pick)
-    else:
-        db.add(pick)
+LEADERBOARD_WINDOWS = ("all", "week", "month", "season")
 
 
-    db.commit()
-    db.refresh(pick)
+def getWindowBounds(window: str, day: datetime.date) -> tuple[datetime.date | None, datetime.date | None]:
+    """
+    First and last day of the leaderboard window (see LEADERBOARD_WINDOWS) that contains the day: the week (from
+    Monday), the month or the season. No bounds for "all".
+    """
+    if window == "week":
+        start = day - datetime.timedelta(days=day.weekday())
+        return start, start + datetime.timedelta(days=6)
+    if window == "month":
+        start = day.replace(day=1)
+        return start, (start + datetime.timedelta(days=31)).replace(day=1) - datetime.timedelta(days=1)
+    if window == "season":
+        return getSeasonBounds(day.year)
+    return None, None
+
 
-    return pick
+def getRankedLeadersQuery(isSeries: bool, startDate: datetime.date | None, endDate: datetime.date | None):
+    """
+    Every user with graded picks in the window, with their correct and graded picks (added up from the rollups), their
+    rank (tied users share it) and their position in the leaderboard (ordered by correct picks, then user ID).
+    Tied users are ordered by user ID descending, byte-wise, like Redis orders them (see lib.leaderboard), so that a
+    cursor means the same thing whichever one a page was read from.
+    """
+    conditions = [models.PickRollup.is_series == isSeries]
+    if startDate is not None:
+        conditions.append(models.PickRollup.day >= startDate)
+    if endDate is not None:
+        conditions.append(models.PickRollup.day <= endDate)
+    correct = func.sum(models.PickRollup.correct_picks)
+    totals = (select(models.PickRollup.user_id.label("userID"),
+                     correct.label("correctPicks"),
+                     func.sum(models.PickRollup.graded_picks).label("totalPicks"))
+              .where(*conditions)
+              .group_by(models.PickRollup.user_id)
+              .having(func.sum(models.PickRollup.graded_picks) > 0)
+              .subquery("totals"))
+    return select(
+        func.rank().over(order_by=totals.c.correctPicks.desc()).label("rank"),
+        totals.c.userID, totals.c.correctPicks, totals.c.totalPicks,
+        func.row_number().over(order_by=(totals.c.correctPicks.desc(),
+                                         totals.c.userID.collate("C").desc())).label("position"),
+    ).subquery("ranked")
 
 
-def update_pick(db: Session, userID: str, gameID: int, pickedHome: bool, isSeries: bool, comment: str = ""):
+async def getLeadersPage(db: AsyncSession, isSeries: bool, startDate: datetime.date | None,
+                         endDate: datetime.date | None, limit: int, after: tuple[int, str] | None = None):
     """
-    Updates the pick for a certain game for a certain user. This does not check if a pick already exists!
-    :param db: Database session to update into
-    :param userID: User ID of the pick user.
-    :param gameID: Game ID of the game picked.
-    :param pickedHome: Whether the user picked the home team or not. Useful to use this instead of storing homeID, less data.
-    :param isSeries: Whether the user is picking for the series as a whole, or not
-    :param comment: The extra comment the user stores when making this pick.
-    :return: The pick object.
+    A page of the leaderboard over a date window, ordered by correct picks then user ID (descending).
+    :param after: The correct picks and user ID of the last entry of the previous page (keyset pagination).
+    :return: Up to `limit` rows of rank, userID, correctPicks and totalPicks.
     """
-    pick = db.query(models.Pick).filter(models.Pick.user_id == userID, models.Pick.game_id == gameID).first()
-    pick.pickedHome = pickedHome
-    pick.is_series = isSeries
-    pick.comment = comment
-    db.commit()
-    db.refresh(pick)
-    return pick
+    ranked = getRankedLeadersQuery(isSeries, startDate, endDate)
+    query = select(ranked.c.rank, ranked.c.userID, ranked.c.correctPicks, ranked.c.totalPicks)
+    if after is not None:
+        query = query.where(or_(ranked.c.correctPicks < after[0],
+                                and_(ranked.c.correctPicks == after[0], ranked.c.userID.collate("C") < after[1])))
+    return (await db.execute(query.order_by(ranked.c.correctPicks.desc(), ranked.c.userID.collate("C").desc())
+                             .limit(limit))).all()
+
 
-def get_leaders(db: Session, is_series: bool):
+async def getLeadersAround(db: AsyncSession, isSeries: bool, startDate: datetime.date | None,
+                           endDate: datetime.date | None, userID: str, around: int):
     """
-    Get pick leaders for the entire season.
+    The user's row of the leaderboard over a date window, and the `around` rows above and below it.
+    :return: The user's row (None if they have no graded picks in the window), and the rows around it, in order.
     """
-    return (
-        db.execute(text(f"""
-            SELECT picks.user_id as "userID",
-                   sum(case when picks.correct = true then 1 else 0 end) as "correctPicks",
-                   count(picks.user_id) as "totalPicks"
-            from picks
-            WHERE picks.id in (SELECT pick_id from session_picks) and picks.is_series = {is_series}
-            GROUP BY picks.user_id
-            ORDER BY "correctPicks" DESC;
-        """)).all()
-    )
\ No newline at end of file
+    ranked = getRankedLeadersQuery(isSeries, startDate, endDate)
+    columns = (ranked.c.rank, ranked.c.userID, ranked.c.correctPicks, ranked.c.totalPicks)
+    user = select(ranked.c.position).where(ranked.c.userID == userID).scalar_subquery()
+    rows = (await db.execute(select(*columns)
+                             .where(ranked.c.position.between(user - around, user + around))
+                             .order_by(ranked.c.position))).all()
+    return next((row for row in rows if row.userID == userID), None), rows
+
+
+async def rebuildRollups(db: AsyncSession):
+    """ Recomputes every rollup from the graded session picks, while writes to picks wait. """
+    await db.execute(text("LOCK TABLE picks IN SHARE MODE"))
+    await db.execute(delete(models.PickRollup))
+    await db.execute(text("""
+        INSERT INTO pick_rollups (user_id, is_series, day, correct_picks, graded_picks)
+        SELECT picks.user_id, picks.is_series, games.date, count(*) FILTER (WHERE picks.correct), count(*)
+        FROM picks
+        JOIN games ON games.id = picks.game_id
+        WHERE picks.correct IS NOT NULL AND picks.user_id IS NOT NULL AND picks.is_series IS NOT NULL
+          AND picks.id IN (SELECT pick_id FROM session_picks)
+        GROUP BY picks.user_id, picks.is_series, games.date
+    """))
+    await db.commit()
+
+
+async def getGamesToGrade(db: AsyncSession, afterGameID: int, limit: int) -> list[int]:
+    """
+    Gets the IDs of finished games that still have ungraded picks, in order, after the given ID (keyset pagination).
+    Series picks stay ungraded until their whole series is finished, so these games keep coming back until then.
+    """
+    return (await db.scalars(text("""
+        SELECT DISTINCT picks.game_id
+        FROM picks
+        JOIN games ON games.id = picks.game_id
+        WHERE picks.correct IS NULL AND games.finished AND picks.game_id > :after
+        ORDER BY picks.game_id
+        LIMIT :limit
+    """), {"after": afterGameID, "limit": limit})).all()
+
+
+async def gradePicks(db: AsyncSession, gameIDs: list[int]):
+    """
+    Grades every pick of the given games in one statement, and commits.
+    A game pick is correct if the team it picked won the game. A series pick is correct if the team it picked won the
+    series, once every game of the series is finished: the series of a game is the games with the same series number
+    between the same two teams in the same year. Picks stay ungraded while there's no winner (or for a tied series).
+    Only picks whose grade changes are written, so grading again is a no-op, and a corrected result regrades them.
+    :return: The changed picks: user_id, game_id, is_series, previous (the old grade), correct (the new one) and
+             in_session (whether the pick counts towards the leaderboards).
+    """
+    rows = (await db.execute(text("""
+        WITH batch AS (
+            SELECT id, series_num, least("homeTeam_id", "awayTeam_id") AS team1,
+                   greatest("homeTeam_id", "awayTeam_id") AS team2, extract(YEAR FROM date) AS year
+            FROM games
+            WHERE id = ANY(:game_ids)
+        ), series_games AS (
+            SELECT DISTINCT games.*, batch.series_num AS series, batch.team1, batch.team2, batch.year
+            FROM games
+            JOIN batch ON games.series_num = batch.series_num
+                      AND least(games."homeTeam_id", games."awayTeam_id") = batch.team1
+                      AND greatest(games."homeTeam_id", games."awayTeam_id") = batch.team2
+                      AND extract(YEAR FROM games.date) = batch.year
+        ), series_wins AS (
+            SELECT series, team1, team2, year, winner, count(*) AS wins,
+                   rank() OVER (PARTITION BY series, team1, team2, year ORDER BY count(*) DESC) AS place,
+                   count(*) OVER (PARTITION BY series, team1, team2, year, count(*)) AS tied
+            FROM series_games
+            WHERE winner IS NOT NULL
+            GROUP BY series, team1, team2, year, winner
+        ), series_winners AS (
+            SELECT series_wins.series, series_wins.team1, series_wins.team2, series_wins.year, series_wins.winner
+            FROM series_wins
+            WHERE place = 1 AND tied = 1 AND NOT EXISTS (
+                SELECT 1 FROM series_games
+                WHERE (series_games.series, series_games.team1, series_games.team2, series_games.year) =
+                      (series_wins.series, series_wins.team1, series_wins.team2, series_wins.year)
+                  AND NOT series_games.finished)
+        ), results AS (
+            SELECT picks.id, picks.correct AS previous,
+                   CASE coalesce(CASE WHEN picks.is_series THEN series_winners.winner
+                                      WHEN games.finished THEN games.winner END, -1)
+                       WHEN games."homeTeam_id" THEN picks."pickedHome"
+                       WHEN games."awayTeam_id" THEN NOT picks."pickedHome"
+                   END AS correct
+            FROM picks
+            JOIN batch ON batch.id = picks.game_id
+            JOIN games ON games.id = picks.game_id
+            LEFT JOIN series_winners ON (series_winners.series, series_winners.team1, series_winners.team2,
+                                         series_winners.year) = (batch.series_num, batch.team1, batch.team2, batch.year)
+        )
+        UPDATE picks SET correct = results.correct
+        FROM results
+        WHERE picks.id = results.id AND picks.correct IS DISTINCT FROM results.correct
+        RETURNING picks.user_id, picks.game_id, picks.is_series, results.previous, picks.correct,
+                  EXISTS (SELECT 1 FROM session_picks WHERE session_picks.pick_id = picks.id) AS in_session
+    """), {"game_ids": list(gameIDs)})).all()
+    await db.commit()
+    return rows
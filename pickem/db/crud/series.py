@@ -1,5 +1,6 @@
-from sqlalchemy.orm import Session, aliased
+from sqlalchemy.ext.asyncio import AsyncSession
 from pickem.db import models, crud
+from pickem.lib.schedule import Schedule
 
 
 def getSeriesNums():
@@ -8,10 +9,8 @@ def getSeriesNums():
     return {"seriesNums": [24] + list(range(27, 80))}
 
 
-def getGamesBySeries(db: Session, seriesNum: int):
-    homeTeam = aliased(models.Team, name="ht")
-    awayTeam = aliased(models.Team, name="at")
-    return crud.games.cleanupGameArraysWithTeams(
-        crud.games.getGameBaseQuery(db)
-            .where(models.Game.series_num == seriesNum)
-        .all())
+async def getGamesBySeries(db: AsyncSession, seriesNum: int):
+    if Schedule.index is not None:
+        return Schedule.index.getGamesBySeries(seriesNum)
+    return await crud.games.withTeamNames(db, (await db.scalars(crud.games.getGameBaseQuery()
+            .where(models.Game.series_num == seriesNum))).all())
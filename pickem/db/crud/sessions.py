@@ -1,24 +1,25 @@
 import random, datetime
 from typing import Optional
 
-from sqlalchemy import values, insert
-from sqlalchemy.orm import Session
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import selectinload
 
 from pickem.db.schemas import Game
 from pickem.db import models
 
 
-def getSession(db: Session, uid: str, date: datetime.date, is_series: bool) -> models.Session | None:
+async def getSession(db: AsyncSession, uid: str, date: datetime.date, is_series: bool) -> models.Session | None:
     """ Returns the session for a given user on a given date """
-    sess = db.query(models.Session).filter(models.Session.date == date, models.Session.user_id == uid, models.Session.is_series == is_series).first()
+    sess = (await db.scalars(select(models.Session)
+                             .options(selectinload(models.Session.games), selectinload(models.Session.picks))
+                             .where(models.Session.date == date, models.Session.user_id == uid, models.Session.is_series == is_series))).first()
     if not sess:
         return None
-    games = sess.games
-    picks = sess.picks
     return sess
 
 
-def createSession(db: Session, uid: str, game_options: list[Game], is_series: bool, favTeam: Optional[int]) -> models.Session:
+async def createSession(db: AsyncSession, uid: str, game_options: list[Game], is_series: bool, favTeam: Optional[int]) -> models.Session:
     """ Creates a unique session for a user on a given date, optionally with a favorite team. """
 
     session_games = []
@@ -46,9 +47,7 @@ def createSession(db: Session, uid: str, game_options: list[Game], is_series: bo
     sess = models.Session(date=game_options[0].date, user_id=uid, is_series=is_series)
     for game in session_games:
         sess.games.append(game)
+    picks = sess.picks  # Loads the (empty) picks collection, so it's part of the response.
     db.add(sess)  # Games are already added, so no need to do an add_all.
-    db.commit()
-    db.refresh(sess)
-    games = sess.games
-    picks = sess.picks
+    await db.commit()
     return sess
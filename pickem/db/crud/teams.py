@@ -1,12 +1,13 @@
-from sqlalchemy.orm import Session
-from pickem.db import models
+from sqlalchemy.ext.asyncio import AsyncSession
+from pickem.lib.teams import Teams
 
 
-def getAllTeams(db: Session): # noqa: E501
-    return db.query(models.Team).all()
+# Teams are served from the in-memory team registry (see pickem.lib.teams), the session is only used to load it.
+async def getAllTeams(db: AsyncSession): # noqa: E501
+    return (await Teams.get(db)).getAllTeams()
 
-def getTeamByID(db: Session, id: int):
-    return db.query(models.Team).filter(models.Team.id == id).first()
+async def getTeamByID(db: AsyncSession, id: int):
+    return (await Teams.get(db)).getTeamByID(id)
 
-def getTeamByAbbr(db: Session, abbr: str):
-    return db.query(models.Team).filter(models.Team.abbr == abbr).first()
\ No newline at end of file
+async def getTeamByAbbr(db: AsyncSession, abbr: str):
+    return (await Teams.get(db)).getTeamByAbbr(abbr)
@@ -1,29 +1,33 @@
-from sqlalchemy import update, text
-from sqlalchemy.orm import Session
+from sqlalchemy import select, text
+from sqlalchemy.ext.asyncio import AsyncSession
 
 from pickem.db import models, schemas
+from pickem.lib.cache import Cache, userTag
 
 
-def setUserPreferences(db: Session, preferences: schemas.UserPreferences):
+async def setUserPreferences(db: AsyncSession, preferences: schemas.UserPreferences):
     """ Update or create a user's preferences. """
     if preferences.favoriteTeam == 0:  # Reset if no team
         preferences.favoriteTeam = None
     userPrefs = models.User(id=preferences.id,
                             favoriteTeam_id=preferences.favoriteTeam,
                             selectionTiming=preferences.selectionTiming)
-    db.execute(text(f"""
+    await db.execute(text("""
         INSERT INTO users ("id", "favoriteTeam_id", "selectionTiming") 
-        VALUES ('{userPrefs.id}', {userPrefs.favoriteTeam_id or 'NULL'}, '{userPrefs.selectionTiming}') 
+        VALUES (:id, :favoriteTeam_id, :selectionTiming) 
         ON CONFLICT (id) DO UPDATE SET
-        "favoriteTeam_id" = {userPrefs.favoriteTeam_id or 'NULL'},
-        "selectionTiming" = '{userPrefs.selectionTiming}'
-    """))
-    db.commit()
+        "favoriteTeam_id" = excluded."favoriteTeam_id",
+        "selectionTiming" = excluded."selectionTiming"
+    """), {"id": userPrefs.id,
+           "favoriteTeam_id": userPrefs.favoriteTeam_id,
+           "selectionTiming": userPrefs.selectionTiming})
+    await db.commit()
+    await Cache.invalidateTags(userTag(preferences.id))
 
 
-def getUserPreferences(db: Session, userID: str):
+async def getUserPreferences(db: AsyncSession, userID: str):
     """ Get a user's preferences. """
-    return db.query(models.User).filter(models.User.id == userID).first()
+    return (await db.scalars(select(models.User).where(models.User.id == userID))).first()
 
-def getMultipleUsersPreferences(db: Session, userIDs: list[str]):
-    return db.query(models.User).filter(models.User.id._in(userIDs)).all()
\ No newline at end of file
+async def getMultipleUsersPreferences(db: AsyncSession, userIDs: list[str]):
+    return (await db.scalars(select(models.User).where(models.User.id.in_(userIDs)))).all()
\ No newline at end of file
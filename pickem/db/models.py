@@ -1,4 +1,4 @@
-from sqlalchemy import Boolean, Column, ForeignKey, Integer, String, Date, DateTime, Text, Table, UniqueConstraint
+from sqlalchemy import Boolean, Column, ForeignKey, Integer, String, Date, DateTime, Text, Table, UniqueConstraint, Index, text
 from sqlalchemy.orm import relationship
 from .alchemy import Base
 
@@ -23,6 +23,7 @@ class Team(Base):
 
 class Game(Base):
     __tablename__ = "games"
+    __table_args__ = (Index("ix_games_home_away_date", "homeTeam_id", "awayTeam_id", "date"),)  # Head-to-head lookups
 
     id = Column(Integer, primary_key=True, index=True)
     homeTeam_id = Column(Integer, ForeignKey("teams.id"), nullable=False)
@@ -42,7 +43,11 @@ class Game(Base):
 
 class Pick(Base):
     __tablename__ = "picks"
-    __tableargs__ = (UniqueConstraint("user_id", "game_id", "is_series")), # Don't make more than one
+    __table_args__ = (
+        UniqueConstraint("user_id", "game_id", "is_series", name="uq_picks_user_game_series"),  # Don't make more than one
+        Index("ix_picks_game_series_home", "game_id", "is_series", "pickedHome"),  # Counting the picks per game
+        Index("ix_picks_ungraded", "game_id", postgresql_where=text("correct IS NULL")),  # Finding games to grade
+    )
     id = Column(Integer, primary_key=True, index=True)
     user_id = Column(String, ForeignKey("users.id"))
     game_id = Column(Integer, ForeignKey("games.id"))
@@ -52,6 +57,30 @@ class Pick(Base):
     comment = Column(Text)
     correct = Column(Boolean, nullable=True)
 
+class PickTally(Base):
+    """
+    Number of picks per game, kept up to date by a trigger on picks (see the add_pick_tallies migration).
+    No foreign key on game_id: the counts are derived data, and shouldn't stop games from being deleted.
+    """
+    __tablename__ = "pick_tallies"
+    game_id = Column(Integer, primary_key=True)
+    is_series = Column(Boolean, primary_key=True)
+    total_picks = Column(Integer, nullable=False, default=0)
+    home_picks = Column(Integer, nullable=False, default=0)
+
+class PickRollup(Base):
+    """
+    Correct and graded session picks of a user on a day (of the games' dates), kept up to date by a trigger on picks
+    (see the add_pick_rollups migration). Leaderboards over a date window add up these rows instead of the picks.
+    """
+    __tablename__ = "pick_rollups"
+    __table_args__ = (Index("ix_pick_rollups_series_day", "is_series", "day"),)
+    user_id = Column(String, primary_key=True)
+    is_series = Column(Boolean, primary_key=True)
+    day = Column(Date, primary_key=True)
+    correct_picks = Column(Integer, nullable=False, default=0)
+    graded_picks = Column(Integer, nullable=False, default=0)
+
 """ Many-to-many association tables for session games."""
 sessionToGames = Table(
     "session_games",
@@ -65,6 +94,7 @@ sessionToPicks = Table(
     Base.metadata,
     Column("pick_id", Integer, ForeignKey("picks.id")),
     Column("session_id", Integer, ForeignKey("sessions.id")),
+    UniqueConstraint("session_id", "pick_id", name="uq_session_picks_session_pick"),
 )
 
 class Session(Base):
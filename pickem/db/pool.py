@@ -0,0 +1,121 @@
+"""
+Connection pool configuration and metrics for the async engine.
+
+The pool is configured through the environment:
+- `DB_POOL_SIZE`, `DB_MAX_OVERFLOW`, `DB_POOL_TIMEOUT`, `DB_POOL_RECYCLE`: passed straight to SQLAlchemy.
+- `DB_PRE_PING`: "always" pings every connection on checkout (the old behaviour), "idle" only pings connections that
+  have been sitting in the pool for more than `DB_PRE_PING_IDLE_SECONDS`, and "never" doesn't ping at all.
+"""
+import os
+import threading
+import time
+
+from sqlalchemy import event
+from sqlalchemy.exc import DisconnectionError
+from sqlalchemy.ext.asyncio import AsyncEngine
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+
+PRE_PING_STRATEGIES = ("always", "idle", "never")
+
+
+class InstrumentedAsyncPool(AsyncAdaptedQueuePool):
+    """ A queue pool that keeps track of how long checkouts had to wait for a connection. """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._statsLock = threading.Lock()
+        self.checkouts = 0
+        self.totalWait = 0.0
+        self.maxWait = 0.0
+        self.timeouts = 0
+        self.pings = 0
+        self.stalePings = 0
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        except Exception:
+            with self._statsLock:
+                self.timeouts += 1
+            raise
+        finally:
+            waited = time.perf_counter() - start
+            with self._statsLock:
+                self.checkouts += 1
+                self.totalWait += waited
+                self.maxWait = max(self.maxWait, waited)
+
+
+def getPoolSettings() -> dict:
+    """ Reads the pool settings from the environment, as keyword arguments for create_async_engine. """
+    preping = os.getenv("DB_PRE_PING", "always").lower()
+    if preping not in PRE_PING_STRATEGIES:
+        raise ValueError("DB_PRE_PING must be one of " + ", ".join(PRE_PING_STRATEGIES))
+    return {
+        "poolclass": InstrumentedAsyncPool,
+        "pool_size": int(os.getenv("DB_POOL_SIZE", 5)),
+        "max_overflow": int(os.getenv("DB_MAX_OVERFLOW", 10)),
+        "pool_timeout": float(os.getenv("DB_POOL_TIMEOUT", 30)),
+        "pool_recycle": int(os.getenv("DB_POOL_RECYCLE", -1)),
+        "pool_pre_ping": preping == "always",
+    }
+
+
+def installIdlePrePing(engine: AsyncEngine, idleSeconds: float):
+    """
+    Pings connections on checkout, but only if they've been idle in the pool for longer than `idleSeconds`.
+    Busy connections are very unlikely to have been dropped by the server, so they skip the extra round trip.
+    """
+    @event.listens_for(engine.sync_engine, "checkin")
+    def onCheckin(dbapi_connection, connection_record):
+        connection_record.info["checkedInAt"] = time.monotonic()
+
+    @event.listens_for(engine.sync_engine, "checkout")
+    def onCheckout(dbapi_connection, connection_record, connection_proxy):
+        checkedInAt = connection_record.info.get("checkedInAt")
+        if checkedInAt is None or time.monotonic() - checkedInAt < idleSeconds:
+            return
+        pool = engine.sync_engine.pool
+        if isinstance(pool, InstrumentedAsyncPool):
+            pool.pings += 1
+        try:
+            engine.dialect.do_ping(dbapi_connection)
+        except Exception as e:
+            if isinstance(pool, InstrumentedAsyncPool):
+                pool.stalePings += 1
+            # Makes the pool throw this connection away and retry the checkout with a new one.
+            raise DisconnectionError("Connection was dropped while idle") from e
+
+
+def configurePool(engine: AsyncEngine):
+    """ Sets up anything that can't be passed to create_async_engine directly. """
+    if os.getenv("DB_PRE_PING", "always").lower() == "idle":
+        installIdlePrePing(engine, float(os.getenv("DB_PRE_PING_IDLE_SECONDS", 60)))
+
+
+def getPoolStats(engine: AsyncEngine) -> dict:
+    """ Returns a snapshot of the engine's pool: connections in use, idle connections, overflow and wait times. """
+    pool = engine.sync_engine.pool
+    stats = {
+        "poolClass": type(pool).__name__,
+        "size": pool.size(),
+        "checkedOut": pool.checkedout(),
+        "idle": pool.checkedin(),
+        "overflow": max(pool.overflow(), 0),  # SQLAlchemy counts this from -pool_size
+        "maxOverflow": pool._max_overflow,
+        "timeout": pool.timeout(),
+        "recycle": pool._recycle,
+        "preping": os.getenv("DB_PRE_PING", "always").lower(),
+    }
+    if isinstance(pool, InstrumentedAsyncPool):
+        with pool._statsLock:
+            stats.update({
+                "checkouts": pool.checkouts,
+                "avgWaitMs": pool.totalWait / pool.checkouts * 1000 if pool.checkouts else 0.0,
+                "maxWaitMs": pool.maxWait * 1000,
+                "timeouts": pool.timeouts,
+                "idlePings": pool.pings,
+                "staleConnections": pool.stalePings,
+            })
+    return stats
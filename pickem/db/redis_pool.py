@@ -0,0 +1,58 @@
+"""
+The asyncio Redis connection pools: one that decodes responses to strings, used for the live stats (see
+pickem.lib.status), and one that doesn't, for binary values like the compressed response cache (see pickem.lib.cache).
+They're opened at startup and closed at shutdown. Configured through the environment:
+- `REDIS_MAX_CONNECTIONS`: how many connections each worker can open (per pool).
+- `REDIS_TIMEOUT_SECONDS`: socket connect/read timeout, so that a slow Redis can't hold up requests.
+"""
+import logging
+import os
+
+from redis import asyncio as aioredis
+
+REDIS_MAX_CONNECTIONS = int(os.getenv("REDIS_MAX_CONNECTIONS", 50))
+REDIS_TIMEOUT_SECONDS = float(os.getenv("REDIS_TIMEOUT_SECONDS", 0.5))
+
+
+def _createClient(decodeResponses: bool) -> aioredis.Redis:
+    return aioredis.Redis(connection_pool=aioredis.ConnectionPool.from_url(
+        os.getenv("REDIS_URL"),
+        max_connections=REDIS_MAX_CONNECTIONS,
+        socket_timeout=REDIS_TIMEOUT_SECONDS,
+        socket_connect_timeout=REDIS_TIMEOUT_SECONDS,
+        decode_responses=decodeResponses,
+    ))
+
+
+class AsyncRedisPool:
+    """ Holds the pools and clients on top of them. The pools are opened on first use if they weren't at startup. """
+
+    def __init__(self):
+        self._client: aioredis.Redis | None = None
+        self._binaryClient: aioredis.Redis | None = None
+
+    def open(self) -> aioredis.Redis:
+        if self._client is None:
+            self._client = _createClient(decodeResponses=True)
+            self._binaryClient = _createClient(decodeResponses=False)
+            logging.info("Opened the Redis pools (max %d connections each)", REDIS_MAX_CONNECTIONS)
+        return self._client
+
+    def client(self) -> aioredis.Redis:
+        """ A client that decodes responses to strings. """
+        return self.open()
+
+    def binaryClient(self) -> aioredis.Redis:
+        """ A client that returns responses as bytes. """
+        self.open()
+        return self._binaryClient
+
+    async def close(self):
+        for client in (self._client, self._binaryClient):
+            if client is not None:
+                await client.aclose()
+                await client.connection_pool.disconnect()
+        self._client, self._binaryClient = None, None
+
+
+AsyncRedis = AsyncRedisPool()
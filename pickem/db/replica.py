@@ -0,0 +1,42 @@
+"""
+Read-your-writes for the read replica: after a user writes picks, their reads are sent to the primary for a short
+window (`DATABASE_REPLICA_STICKY_SECONDS`), so they don't see stale tallies while the replica catches up.
+The window is a `sticky:<userID>` Redis key that expires with it, so it holds whichever worker the next read lands on.
+Routing only needs to know who's asking, not to authenticate them, so the user ID is read from the token without
+verifying it (see jwks.getTokenSubject): a forged token can only send its own reads to the primary.
+"""
+import logging
+import os
+
+from redis.exceptions import RedisError
+
+from pickem.db.alchemy import async_engine, replica_engine
+from pickem.db.redis_pool import AsyncRedis
+
+REPLICA_STICKY_SECONDS = float(os.getenv("DATABASE_REPLICA_STICKY_SECONDS", 5))
+STICKY_PREFIX = "sticky:"
+
+
+def hasReplica() -> bool:
+    return replica_engine is not async_engine
+
+
+async def stickToPrimary(uid: str):
+    """ Sends this user's reads to the primary for the next REPLICA_STICKY_SECONDS, in every worker. """
+    if not hasReplica() or REPLICA_STICKY_SECONDS <= 0:
+        return
+    try:
+        await AsyncRedis.client().set(STICKY_PREFIX + uid, 1, px=int(REPLICA_STICKY_SECONDS * 1000))
+    except RedisError as e:
+        logging.warning("Could not keep the user's reads on the primary: %s", e)
+
+
+async def isStickyToPrimary(uid: str | None) -> bool:
+    """ Whether the user wrote picks recently. When Redis can't tell, reads go to the primary to be safe. """
+    if uid is None or not hasReplica() or REPLICA_STICKY_SECONDS <= 0:
+        return False
+    try:
+        return bool(await AsyncRedis.client().exists(STICKY_PREFIX + uid))
+    except RedisError as e:
+        logging.warning("Could not check whether the user's reads stay on the primary: %s", e)
+        return True
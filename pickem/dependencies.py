@@ -1,44 +1,76 @@
-from typing import Annotated
-
-import httpx
+import hmac
 import os
-import redis
+from typing import Annotated
 
-from fastapi import HTTPException, Header
-from jwt import JWT, jwk_from_dict
+from fastapi import Depends, HTTPException, Header
+from jwt import JWT
 
-from pickem.db.alchemy import SessionLocal, RedisPool
+from pickem.db.alchemy import SessionLocal, AsyncSessionLocal, AsyncReadSessionLocal
+from pickem.db.redis_pool import AsyncRedis
+from pickem.db.replica import isStickyToPrimary
+from pickem.lib.jwks import JWKS, JWKSUnavailable, getTokenKeyID, getTokenSubject
+from pickem.lib.token_cache import TokenCache
 
 JWT_Instance = JWT()
 AUTHORIZED_PARTIES = ["http://localhost:5173"]
+INTERNAL_API_TOKEN = os.getenv("INTERNAL_API_TOKEN")
 
 
-def get_user(authorization: Annotated[str | None, Header()] = None):
-    """ Decodes an authentication token in the request header and returns the user ID. """
+async def get_user(authorization: Annotated[str | None, Header()] = None):
+    """
+    Decodes an authentication token in the request header and returns the user ID.
+    Responds with a 401 if the token isn't valid, or a 503 if we couldn't get the keys to check it with.
+    """
 
     # Check to verify information is present
     try:
-        # Query the Clerk API to get JWKS, get token and signing key
-        resp = httpx.get("https://api.clerk.dev/v1/jwks",
-                         headers={"Authorization": "Bearer " + os.environ["CLERK_API_KEY"]}).json()
-        signing_key = jwk_from_dict(resp["keys"][0])
         token = authorization.split(" ")[1]
+    except (AttributeError, IndexError):
+        raise HTTPException(401, detail="Unauthorized")
 
-        # Verify token, expiration time, and authorized party
-        message_received = JWT_Instance.decode(token, signing_key)
-        if message_received.get("azp") not in AUTHORIZED_PARTIES:
+    # Tokens we've already verified (and that haven't expired yet) skip the signature check.
+    cached = TokenCache.get(token)
+    if cached is not None:
+        if cached.azp not in AUTHORIZED_PARTIES:
             raise HTTPException(401, detail="Unauthorized")
-    except:
+        return cached.sub
+
+    # Get the signing key the token was signed with (JWKS are cached, see pickem.lib.jwks)
+    try:
+        signing_key = await JWKS.getKey(getTokenKeyID(token))
+    except JWKSUnavailable:
+        raise HTTPException(503, detail="Authentication is temporarily unavailable")
+    except ValueError:  # Header isn't a base64-encoded JSON object (with a string kid)
+        raise HTTPException(401, detail="Unauthorized")
+    if signing_key is None:
+        raise HTTPException(401, detail="Unauthorized")
+
+    # Verify token, expiration time, and authorized party
+    try:
+        message_received = JWT_Instance.decode(token, signing_key)
+    except Exception:
+        raise HTTPException(401, detail="Unauthorized")
+    if message_received.get("azp") not in AUTHORIZED_PARTIES:
         raise HTTPException(401, detail="Unauthorized")
+    TokenCache.put(token, message_received)
     return message_received.get("sub")
 
-def get_user_optional(authorization: Annotated[str | None, Header()] = None):
+async def get_user_optional(authorization: Annotated[str | None, Header()] = None):
     """ Provides optional authentication for endpoints that don't always require it."""
     try:
-        return get_user(authorization)
-    except:
+        return await get_user(authorization)
+    except HTTPException:
         return None
 
+async def require_internal_token(x_internal_token: Annotated[str | None, Header()] = None):
+    """
+    Guards the /internal endpoints: the request needs an `X-Internal-Token` header matching `INTERNAL_API_TOKEN`.
+    They're not found at all when no token is configured, or when the header doesn't match.
+    """
+    if not INTERNAL_API_TOKEN or x_internal_token is None \
+            or not hmac.compare_digest(x_internal_token.encode(), INTERNAL_API_TOKEN.encode()):
+        raise HTTPException(404, detail="Not found")
+
 def get_db():
     db = SessionLocal()
     try:
@@ -47,5 +79,23 @@ def get_db():
         db.close()
 
 
-def get_redis():
-    return redis.Redis(connection_pool=RedisPool)
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        yield db
+
+
+async def get_read_db(authorization: Annotated[str | None, Header()] = None):
+    """
+    A read-only session on the replica (if one is configured). Users who've just written picks are kept
+    on the primary for a little while, so they can read their own writes (see pickem.db.replica).
+    The token isn't verified here, routes that need the user still depend on get_user.
+    """
+    sessionmaker = AsyncSessionLocal if await isStickyToPrimary(getTokenSubject(authorization)) \
+        else AsyncReadSessionLocal
+    async with sessionmaker() as db:
+        yield db
+
+
+async def get_redis():
+    """ A client on the shared asyncio Redis pool (see pickem.db.redis_pool). """
+    return AsyncRedis.client()
@@ -0,0 +1,397 @@
+"""
+A response cache that doesn't stampede when entries expire, shared by every worker.
+
+Each entry has a soft and a hard TTL. Until the soft TTL, it's served as is. Between the soft and the hard TTL,
+the stale value is still served right away, while one background task recomputes it. After the hard TTL (or if there
+is no entry at all), callers have to wait for the new value, but concurrent callers for the same key share a single
+computation instead of each running their own.
+
+There are two tiers: a small LRU in each worker (L1), in front of Redis (L2), where values are stored as compressed
+JSON. Computing a value takes a Redis lock, so that across the whole cluster only one worker computes it while the
+others wait for it to show up in Redis. When a worker stores a new value (or invalidates one), it tells the other
+workers on the `pickem:cache` channel to drop their L1 copy. If Redis is unavailable, every worker falls back to its
+own L1.
+
+Entries can be tagged with the domain keys they depend on (see the *Tag functions), and writers invalidate the tags
+they affect, so hot endpoints can have long TTLs without serving outdated data. Redis keeps a set of keys per tag;
+each L1 is small enough to just be scanned.
+
+Since values can be recomputed after the request that asked for them is gone, loaders can't use the request's
+database session, they open their own.
+"""
+import asyncio
+import datetime
+import functools
+import inspect
+import json
+import logging
+import os
+import time
+import uuid
+import zlib
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Iterable, NamedTuple
+
+from fastapi.encoders import jsonable_encoder
+from redis import asyncio as aioredis
+
+from pickem.db.redis_pool import AsyncRedis
+
+CACHE_L1_SIZE = int(os.getenv("CACHE_L1_SIZE", 256))  # Entries kept in each worker
+CACHE_LOCK_SECONDS = float(os.getenv("CACHE_LOCK_SECONDS", 30))  # Longest a value can take to compute
+CACHE_POLL_SECONDS = 0.05
+CACHE_RECONNECT_SECONDS = 5
+CACHE_CHANNEL = "pickem:cache"
+CACHE_KEY_PREFIX = "cache:"
+CACHE_TAG_PREFIX = "cachetag:"
+LEADERBOARD_TAG = "leaderboard"
+
+# Adds the key to the tags' sets, and makes sure the sets live at least as long as the key.
+TAG_SCRIPT = """
+for _, tag in ipairs(KEYS) do
+    redis.call('SADD', tag, ARGV[1])
+    if redis.call('TTL', tag) < tonumber(ARGV[2]) then
+        redis.call('EXPIRE', tag, ARGV[2])
+    end
+end
+"""
+
+
+def gameTag(gameID: int) -> str:
+    return "game:%d" % gameID
+
+
+def dateTag(date: datetime.date) -> str:
+    return "date:" + date.isoformat()
+
+
+def seriesTag(seriesNum: int) -> str:
+    return "series:%d" % seriesNum
+
+
+def userTag(userID: str) -> str:
+    return "user:" + userID
+
+
+class CacheEntry(NamedTuple):
+    value: Any
+    softExpiry: float
+    hardExpiry: float
+    tags: tuple[str, ...] | list[str] = ()
+
+
+def dumpEntry(entry: CacheEntry) -> bytes:
+    return zlib.compress(json.dumps(entry, separators=(",", ":")).encode())
+
+
+def loadEntry(blob: bytes) -> CacheEntry:
+    return CacheEntry(*json.loads(zlib.decompress(blob)))
+
+
+class LRUTier:
+    """ A bounded, in-process LRU of cache entries. """
+
+    def __init__(self, maxSize: int):
+        self.maxSize = maxSize
+        self.evicted = 0
+        self._entries: OrderedDict[str, CacheEntry] = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key: str) -> CacheEntry | None:
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries.move_to_end(key)
+        return entry
+
+    def put(self, key: str, entry: CacheEntry):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxSize:
+            self._entries.popitem(last=False)
+            self.evicted += 1
+
+    def pop(self, key: str):
+        self._entries.pop(key, None)
+
+    def popTagged(self, tags: set[str]) -> list[str]:
+        """ Drops the entries with any of the tags, and returns their keys. """
+        keys = [key for key, entry in self._entries.items() if tags.intersection(entry.tags)]
+        for key in keys:
+            del self._entries[key]
+        return keys
+
+    def clear(self):
+        self._entries.clear()
+
+
+class ResponseCache:
+    """ Single-flight, stale-while-revalidate cache of JSON-able values by key, with an L1 and a Redis L2. """
+
+    def __init__(self, redis: Callable[[], aioredis.Redis] | None = AsyncRedis.binaryClient,
+                 l1Size: int = CACHE_L1_SIZE, clock: Callable[[], float] = time.time):
+        """
+        :param redis: Returns the (binary) Redis client for L2, or None to only have an L1.
+        :param clock: Wall clock time, which expiry times are based on. It needs to agree between workers.
+        """
+        self.redis = redis
+        self.clock = clock
+        self.id = uuid.uuid4().hex  # To ignore our own invalidation messages
+        self.l1 = LRUTier(l1Size)
+        self._loading: dict[str, asyncio.Task] = {}
+        self._tagVersions: dict[str, int] = {}  # Bumped on invalidation, to not store values computed before it
+        self.hits = 0
+        self.l2Hits = 0
+        self.staleHits = 0
+        self.misses = 0
+        self.loads = 0
+        self.lockWaits = 0
+        self.errors = 0
+        self.redisErrors = 0
+        self.invalidations = 0
+
+    async def get(self, key: str, loader: Callable[[], Awaitable[Any]], softTTL: float, hardTTL: float | None = None,
+                  tags: Iterable[str] = ()):
+        """
+        Returns the value for the key, calling `loader` to compute it if it's missing or stale.
+        :param softTTL: Seconds the value is fresh for.
+        :param hardTTL: Seconds the value can be served (stale) for, while it's recomputed. Defaults to softTTL.
+        :param tags: Tags the value depends on, see invalidateTags.
+        """
+        tags = sorted(set(tags))
+        hardTTL = max(hardTTL or softTTL, softTTL)
+        entry = self.l1.get(key)
+        now = self.clock()
+        if entry is not None and now < entry.softExpiry:
+            self.hits += 1
+            return entry.value
+        # Another worker may have recomputed it already.
+        l2Entry = await self._readL2(key)
+        if l2Entry is not None and (entry is None or l2Entry.hardExpiry > entry.hardExpiry):
+            entry = l2Entry
+            self.l1.put(key, entry)
+            if now < entry.softExpiry:
+                self.l2Hits += 1
+                return entry.value
+        if entry is not None and now < entry.hardExpiry:
+            self.staleHits += 1
+            self._startLoad(key, loader, softTTL, hardTTL, tags)
+            return entry.value
+        self.misses += 1
+        # Shielded, so that a client going away doesn't cancel the computation for everyone else waiting on it.
+        return await asyncio.shield(self._startLoad(key, loader, softTTL, hardTTL, tags))
+
+    def _startLoad(self, key: str, loader: Callable[[], Awaitable[Any]], softTTL: float, hardTTL: float,
+                   tags: list[str]) -> asyncio.Task:
+        """ Starts computing the value, unless that's already happening for this key in this worker. """
+        task = self._loading.get(key)
+        if task is None:
+            task = asyncio.create_task(self._load(key, loader, softTTL, hardTTL, tags))
+            self._loading[key] = task
+            task.add_done_callback(functools.partial(self._loadDone, key))
+        return task
+
+    async def _load(self, key: str, loader: Callable[[], Awaitable[Any]], softTTL: float, hardTTL: float,
+                    tags: list[str]):
+        """ Computes the value, unless another worker is already computing it, in which case it waits for that. """
+        versions = [self._tagVersions.get(tag, 0) for tag in tags]
+        lock = await self._acquireLock(key)
+        if lock is False:
+            self.lockWaits += 1
+            entry = await self._waitForL2(key)
+            if entry is not None:
+                self.l1.put(key, entry)
+                return entry.value
+            lock = None  # The other worker gave up (or took too long), compute it here instead.
+
+        self.loads += 1
+        try:
+            value = jsonable_encoder(await loader())
+        except Exception:
+            self.errors += 1
+            raise
+        finally:
+            if lock:
+                await self._releaseLock(lock)
+        if versions != [self._tagVersions.get(tag, 0) for tag in tags]:
+            return value  # Invalidated while we were computing it, so it may already be outdated: don't keep it.
+        now = self.clock()
+        entry = CacheEntry(value, now + softTTL, now + hardTTL, tags)
+        self.l1.put(key, entry)
+        await self._writeL2(key, entry, hardTTL)
+        return value
+
+    def _loadDone(self, key: str, task: asyncio.Task):
+        if self._loading.get(key) is task:
+            del self._loading[key]
+        if not task.cancelled() and task.exception() is not None:
+            # Stale values are kept, and served until their hard TTL.
+            logging.warning("Could not compute the cached value for %s: %r", key, task.exception())
+
+    def _redisError(self, e: Exception):
+        self.redisErrors += 1
+        logging.warning("Response cache can't use Redis, falling back to this worker's cache: %r", e)
+
+    async def _readL2(self, key: str) -> CacheEntry | None:
+        if self.redis is None:
+            return None
+        try:
+            blob = await self.redis().get(CACHE_KEY_PREFIX + key)
+        except aioredis.RedisError as e:
+            self._redisError(e)
+            return None
+        return loadEntry(blob) if blob is not None else None
+
+    async def _writeL2(self, key: str, entry: CacheEntry, hardTTL: float):
+        if self.redis is None:
+            return
+        try:
+            client = self.redis()
+            if entry.tags:
+                await client.eval(TAG_SCRIPT, len(entry.tags), *(CACHE_TAG_PREFIX + tag for tag in entry.tags),
+                                  CACHE_KEY_PREFIX + key, int(hardTTL) + 1)
+            await client.set(CACHE_KEY_PREFIX + key, dumpEntry(entry), px=int(hardTTL * 1000))
+            await client.publish(CACHE_CHANNEL, json.dumps({"origin": self.id, "keys": [key]}))
+        except aioredis.RedisError as e:
+            self._redisError(e)
+
+    async def _acquireLock(self, key: str):
+        """ Returns the lock if we got it, False if another worker holds it, and None if there's no Redis. """
+        if self.redis is None:
+            return None
+        lock = self.redis().lock("lock:" + CACHE_KEY_PREFIX + key, timeout=CACHE_LOCK_SECONDS)
+        try:
+            return lock if await lock.acquire(blocking=False) else False
+        except aioredis.RedisError as e:
+            self._redisError(e)
+            return None
+
+    async def _releaseLock(self, lock):
+        try:
+            await lock.release()
+        except aioredis.RedisError as e:  # Including the lock having expired meanwhile
+            logging.warning("Could not release %s: %r", lock.name, e)
+
+    async def _waitForL2(self, key: str) -> CacheEntry | None:
+        """ Waits for another worker to store a fresh value, for as long as it holds the lock. """
+        deadline = time.monotonic() + CACHE_LOCK_SECONDS
+        try:
+            client = self.redis()
+            while time.monotonic() < deadline:
+                await asyncio.sleep(CACHE_POLL_SECONDS)
+                entry = await self._readL2(key)
+                if entry is not None and self.clock() < entry.softExpiry:
+                    return entry
+                if not await client.exists("lock:" + CACHE_KEY_PREFIX + key):
+                    return await self._readL2(key)
+        except aioredis.RedisError as e:
+            self._redisError(e)
+        return None
+
+    async def invalidate(self, *keys: str):
+        """ Drops the keys from every worker's L1 and from Redis. """
+        for key in keys:
+            self.l1.pop(key)
+        if self.redis is None or not keys:
+            return
+        try:
+            client = self.redis()
+            await client.delete(*(CACHE_KEY_PREFIX + key for key in keys))
+            await client.publish(CACHE_CHANNEL, json.dumps({"origin": self.id, "keys": list(keys)}))
+        except aioredis.RedisError as e:
+            self._redisError(e)
+
+    async def invalidateTags(self, *tags: str):
+        """ Drops every entry tagged with any of the tags, from every worker's L1 and from Redis. """
+        tags = set(tags)
+        if not tags:
+            return
+        self._dropTagged(tags)
+        if self.redis is None:
+            return
+        try:
+            client = self.redis()
+            tagKeys = [CACHE_TAG_PREFIX + tag for tag in tags]
+            keys = await client.sunion(tagKeys)
+            await client.delete(*keys, *tagKeys)
+            await client.publish(CACHE_CHANNEL, json.dumps({"origin": self.id, "keys": [], "tags": list(tags)}))
+        except aioredis.RedisError as e:
+            self._redisError(e)
+
+    def _dropTagged(self, tags: set[str]):
+        self.invalidations += 1
+        for tag in tags:
+            self._tagVersions[tag] = self._tagVersions.get(tag, 0) + 1
+        self.l1.popTagged(tags)
+
+    async def listen(self):
+        """ Drops L1 entries that other workers changed or invalidated, until cancelled. """
+        while True:
+            client = aioredis.Redis.from_url(os.getenv("REDIS_URL"), decode_responses=True)
+            try:
+                async with client.pubsub() as pubsub:
+                    await pubsub.subscribe(CACHE_CHANNEL)
+                    # Anything could have changed while we weren't listening.
+                    self.l1.clear()
+                    async for message in pubsub.listen():
+                        if message["type"] != "message":
+                            continue
+                        message = json.loads(message["data"])
+                        if message["origin"] != self.id:
+                            for key in message["keys"]:
+                                self.l1.pop(key)
+                            if message.get("tags"):
+                                self._dropTagged(set(message["tags"]))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.warning("Response cache listener failed, reconnecting: %s", e)
+                await asyncio.sleep(CACHE_RECONNECT_SECONDS)
+            finally:
+                await client.aclose()
+
+    def stats(self) -> dict:
+        return {
+            "l1Entries": len(self.l1),
+            "l1MaxSize": self.l1.maxSize,
+            "l1Evicted": self.l1.evicted,
+            "hits": self.hits,
+            "l2Hits": self.l2Hits,
+            "staleHits": self.staleHits,
+            "misses": self.misses,
+            "loads": self.loads,
+            "lockWaits": self.lockWaits,
+            "errors": self.errors,
+            "redisErrors": self.redisErrors,
+            "invalidations": self.invalidations,
+        }
+
+
+Cache = ResponseCache()
+
+
+def getCacheKey(func: Callable, arguments: dict) -> str:
+    return func.__module__ + "." + func.__qualname__ + ":" + ",".join(
+        "%s=%r" % (name, value) for name, value in sorted(arguments.items()))
+
+
+def cached(softTTL: float, hardTTL: float | None = None,
+           tags: Iterable[str] | Callable[..., Iterable[str]] = ()):
+    """
+    Caches the result of an endpoint (see ResponseCache), keyed by its arguments. The endpoint can't depend on things
+    that only live for the duration of the request, like a database session.
+    :param tags: The entry's tags, or a function of the endpoint's arguments (by name) that returns them.
+    """
+    def decorator(func):
+        signature = inspect.signature(func)
+
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            arguments = signature.bind(*args, **kwargs)
+            arguments.apply_defaults()
+            return await Cache.get(getCacheKey(func, arguments.arguments),
+                                   lambda: func(*args, **kwargs), softTTL, hardTTL,
+                                   tags(**arguments.arguments) if callable(tags) else tags)
+        return wrapper
+    return decorator
@@ -0,0 +1,186 @@
+"""
+Grades picks once their games (or series) are finished, filling Pick.correct from the results an external process
+writes to the games (`finished`, `winner`).
+
+Games are graded in batches, each with a single UPDATE (see crud.picks.gradePicks) that only writes the picks whose
+grade changed, so grading is idempotent and a corrected result regrades its picks. After each batch, the changes are
+added to the Redis leaderboards (see lib.leaderboard) while holding the leaderboard lock, the leaderboard responses
+are invalidated, and the results are pushed to live clients (see lib.live). The daily rollups follow the UPDATE through
+their trigger.
+
+Grading doesn't depend on Redis: if the leaderboards can't be locked or updated, the picks are graded anyway and the
+leaderboards are marked as not built instead (retried every round until Redis is back), so they're read from the
+database until the next round rebuilds them.
+
+Every worker runs the scheduled loop (every `GRADING_INTERVAL_SECONDS`), only the one that gets the lock grades in a
+given round. It can also be run on demand, for all finished games or for given ones (POST /internal/grading, or
+`python -m scripts.grade_picks`).
+"""
+import asyncio
+import logging
+import os
+import time
+from dataclasses import asdict, dataclass
+from typing import Awaitable, Callable
+
+from redis.exceptions import LockError, RedisError
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from pickem.lib.cache import Cache, LEADERBOARD_TAG
+from pickem.lib.leaderboard import GradeChange, LeaderLoader, Leaderboard
+from pickem.lib.live import publishEvent
+
+GRADING_INTERVAL_SECONDS = float(os.getenv("GRADING_INTERVAL_SECONDS", 300))
+GRADING_BATCH_SIZE = int(os.getenv("GRADING_BATCH_SIZE", 50))  # Games per UPDATE
+
+# Gets the finished games with ungraded picks after a game ID, up to a limit, see crud.picks.getGamesToGrade
+GameFinder = Callable[[AsyncSession, int, int], Awaitable[list[int]]]
+# Grades the picks of the given games and returns the changed ones, see crud.picks.gradePicks
+PickGrader = Callable[[AsyncSession, list[int]], Awaitable[list]]
+
+
+@dataclass
+class GradingReport:
+    games: int = 0
+    batches: int = 0
+    gradedPicks: int = 0  # Picks whose grade was written (including regrades)
+    seconds: float = 0.0
+    leaderboardsUpdated: bool = True  # False if they missed grades, and have to be rebuilt
+
+
+def getGradeChanges(rows) -> list[GradeChange]:
+    """ Adds up how the changed picks move each user on the leaderboards (only session picks count). """
+    changes: dict[tuple[str, bool], list[int]] = {}
+    for row in rows:
+        if not row.in_session:
+            continue
+        counts = changes.setdefault((row.user_id, row.is_series), [0, 0])
+        counts[0] += (row.correct is True) - (row.previous is True)
+        counts[1] += (row.correct is not None) - (row.previous is not None)
+    return [GradeChange(userID, isSeries, correct, total) for (userID, isSeries), (correct, total) in changes.items()]
+
+
+def getGameResults(rows) -> list[dict]:
+    """ One result per game, for the live clients: how many of its picks were graded, and how many are correct. """
+    results: dict[int, dict] = {}
+    for row in rows:
+        result = results.setdefault(row.game_id, {"gameID": row.game_id, "gradedPicks": 0, "correctPicks": 0})
+        result["gradedPicks"] += row.correct is not None
+        result["correctPicks"] += row.correct is True
+    return list(results.values())
+
+
+class GradingEngine:
+    """ Runs the grading rounds, and keeps the report of the last one. """
+
+    def __init__(self):
+        self.running = False
+        self.lastReport: GradingReport | None = None
+        self.lastGradedAt: float | None = None
+        self.rounds = 0
+        self.leaderboardsStale = False  # Grades were written that the leaderboards couldn't be told about
+
+    async def grade(self, sessionmaker, finder: GameFinder, grader: PickGrader, gameIDs: list[int] | None = None,
+                    wait: bool = True) -> GradingReport | None:
+        """
+        Grades the picks of the given games, or of every finished game with ungraded picks.
+        Returns None without grading if someone else is grading (or rebuilding the leaderboards), after waiting for
+        them for up to the lock's timeout if `wait` is True.
+        """
+        lock = Leaderboard.lock()
+        try:
+            if not await lock.acquire(blocking=wait):
+                return None
+        except RedisError as e:
+            logging.warning("Could not lock the leaderboards, grading without updating them: %s", e)
+            lock, self.leaderboardsStale = None, True
+        report = GradingReport()
+        start = time.monotonic()
+        self.running = True
+        try:
+            async with sessionmaker() as db:
+                batches = self._findBatches(db, finder) if gameIDs is None else self._splitBatches(gameIDs)
+                async for batch in batches:
+                    rows = await grader(db, batch)
+                    await self._applyGrades(lock, rows)
+                    if rows:
+                        await Cache.invalidateTags(LEADERBOARD_TAG)
+                        await publishEvent({"kind": "results", "results": getGameResults(rows)})
+                    report.games += len(batch)
+                    report.batches += 1
+                    report.gradedPicks += len(rows)
+        finally:
+            self.running = False
+            if lock is not None:
+                try:
+                    await lock.release()
+                except (LockError, RedisError) as e:
+                    logging.warning("Could not release the leaderboard lock: %s", e)
+            report.leaderboardsUpdated = not self.leaderboardsStale
+            await self._invalidateLeaderboards()
+        report.seconds = round(time.monotonic() - start, 3)
+        self.lastReport, self.lastGradedAt = report, time.time()
+        if report.gradedPicks:
+            logging.info("Graded %d picks of %d games in %d batches, in %.3fs",
+                         report.gradedPicks, report.games, report.batches, report.seconds)
+        return report
+
+    async def _applyGrades(self, lock, rows):
+        """ Adds a batch's changes to the leaderboards, unless they're going to be rebuilt anyway. """
+        if lock is None or self.leaderboardsStale:
+            return
+        try:
+            await Leaderboard.applyGrades(getGradeChanges(rows))
+            await lock.reacquire()  # Raises LockError if it expired, a rebuild could have counted the grades twice
+        except (LockError, RedisError) as e:
+            logging.warning("Could not update the leaderboards, they'll be rebuilt: %s", e)
+            self.leaderboardsStale = True
+
+    async def _invalidateLeaderboards(self):
+        """ Has the leaderboards rebuilt if they missed grades. Retried every round until Redis can be reached. """
+        if not self.leaderboardsStale:
+            return
+        try:
+            await Leaderboard.invalidate()
+            self.leaderboardsStale = False
+        except RedisError as e:
+            logging.warning("Could not invalidate the leaderboards, retrying in the next round: %s", e)
+
+    async def _splitBatches(self, gameIDs: list[int]):
+        for n in range(0, len(gameIDs), GRADING_BATCH_SIZE):
+            yield gameIDs[n:n + GRADING_BATCH_SIZE]
+
+    async def _findBatches(self, db: AsyncSession, finder: GameFinder):
+        afterGameID = 0
+        while batch := await finder(db, afterGameID, GRADING_BATCH_SIZE):
+            yield batch
+            afterGameID = batch[-1]
+
+    async def run(self, sessionmaker, finder: GameFinder, grader: PickGrader, leaderLoader: LeaderLoader):
+        """
+        Grades whatever finished since the last round, every GRADING_INTERVAL_SECONDS, until cancelled.
+        Rebuilds the leaderboards after a round if they aren't built (e.g. because grading couldn't update them).
+        """
+        while True:
+            try:
+                await self._invalidateLeaderboards()
+                await self.grade(sessionmaker, finder, grader, wait=False)
+                self.rounds += 1
+                await Leaderboard.ensureBuilt(sessionmaker, leaderLoader)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.warning("Grading failed, retrying in the next round: %s", e)
+            await asyncio.sleep(GRADING_INTERVAL_SECONDS)
+
+    def getStats(self) -> dict:
+        return {
+            "running": self.running,
+            "rounds": self.rounds,
+            "leaderboardsStale": self.leaderboardsStale,
+            "lastGradedAt": self.lastGradedAt,
+            "lastReport": asdict(self.lastReport) if self.lastReport else None,
+        }
+
+
+Grading = GradingEngine()
@@ -0,0 +1,264 @@
+"""
+Write-behind ingestion of picks, for the spikes right before games start.
+
+With `PICK_INGESTION=stream`, the pick endpoints only validate the picks (the games exist and haven't started yet),
+append them to a Redis stream and answer right away. One flusher for the whole deployment (whichever worker holds the
+flusher lock) reads the stream through a consumer group, writes each batch with one upsert (see
+crud.picks.write_picks), and acknowledges it. Entries read but not acknowledged, because the flusher died mid-batch,
+are read again by the next flusher; the upsert makes that harmless. The upsert's cutoff is applied to when the picks
+were submitted (their entry's ID), so a slow flush doesn't turn picks away once the games start.
+
+Until they're flushed, a user's picks are also kept in a `pickem:pending:<userID>` hash, which the read endpoints
+merge into their results (see pending), so users see their own picks immediately. Tallies only count them once flushed.
+
+The stream is only as durable as Redis is: run it with AOF persistence when this mode is on. Configured through the
+environment:
+- `PICK_INGESTION`: "direct" (the default, picks are written during the request) or "stream".
+- `PICK_FLUSH_BATCH`: the most stream entries (requests) written per upsert.
+"""
+import asyncio
+import datetime
+import json
+import logging
+import os
+import socket
+import uuid
+from typing import Awaitable, Callable
+
+from redis import asyncio as aioredis
+from redis.exceptions import LockError
+from sqlalchemy.exc import DataError, IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from pickem.db.redis_pool import AsyncRedis
+from pickem.lib.live import publishEvent
+from pickem.lib.schedule import GameRecord
+
+PICK_INGESTION = os.getenv("PICK_INGESTION", "direct").lower()
+PICK_FLUSH_BATCH = int(os.getenv("PICK_FLUSH_BATCH", 500))
+PICK_FLUSH_BLOCK_MS = 1000  # How long a read waits for new entries, well under the lock's timeout
+PICK_FLUSH_LOCK_SECONDS = 10
+PICK_FLUSH_RETRY_SECONDS = 5
+PICK_PENDING_SECONDS = 60 * 60 * 24  # Pending picks outlive any flush delay, but don't stay around forever
+PICK_STREAM = "pickem:picks"
+PICK_DEAD_STREAM = "pickem:picks:dead"
+PICK_GROUP = "flusher"
+PICK_PENDING_PREFIX = "pickem:pending:"
+
+# Removes pending picks once flushed, unless they were replaced by a newer submission meanwhile.
+CLEAR_PENDING_SCRIPT = """
+for i = 2, #ARGV do
+    local pending = redis.call('HGET', KEYS[1], ARGV[i])
+    if pending and cjson.decode(pending)['token'] == ARGV[1] then
+        redis.call('HDEL', KEYS[1], ARGV[i])
+    end
+end
+"""
+
+# Writes picks (dictionaries of pick columns, user_id included) in one go, see crud.picks.write_picks
+PickWriter = Callable[[AsyncSession, list[dict]], Awaitable[list]]
+
+
+class GameStarted(Exception):
+    """ Picks were submitted for games that have already started. """
+
+    def __init__(self, gameIDs: list[int]):
+        super().__init__(f"Games already started: {gameIDs}")
+        self.gameIDs = gameIDs
+
+
+def checkCutoff(games: list[GameRecord], now: datetime.datetime | None = None):
+    """
+    Raises GameStarted if any of the games has started or finished (start times are UTC). The pick upsert applies the
+    same cutoff (see crud.picks.upsertPicksQuery), this is for telling users before writing anything.
+    """
+    now = now or datetime.datetime.utcnow()
+    started = [game.id for game in games
+               if game.finished or (game.startTimeUTC is not None and game.startTimeUTC <= now)]
+    if started:
+        raise GameStarted(started)
+
+
+def _pendingField(gameID: int, isSeries: bool) -> str:
+    return f"{gameID}:{int(isSeries)}"
+
+
+def _submittedPicks(entry) -> list[dict]:
+    """ The picks of a stream entry, with when they were submitted (the entry ID's timestamp) to apply the cutoff to. """
+    entryID, fields = entry
+    submittedAt = datetime.datetime.utcfromtimestamp(int(entryID.split("-")[0]) / 1000)
+    return [{**pick, "submitted_at": submittedAt} for pick in json.loads(fields["picks"])]
+
+
+class PickIngestion:
+    """ Queues picks on the stream, tracks them until they're written, and (in the flusher's worker) writes them. """
+
+    def __init__(self, enabled: bool):
+        self.enabled = enabled
+        self.flushing = False
+        self.submitted = 0
+        self.flushed = 0
+        self.batches = 0
+        self.deadLettered = 0
+
+    async def submit(self, userID: str, picks: list[dict], games: list[GameRecord]):
+        """
+        Queues a user's picks (dictionaries of game_id, pickedHome, is_series and comment) for the given games,
+        which must all be in the list. Raises GameStarted (nothing is queued) if any of the games has started.
+        Raises a RedisError if the picks couldn't be queued.
+        """
+        checkCutoff(games)
+        if not picks:
+            return
+        dates = {game.id: game.date for game in games}
+        token = uuid.uuid4().hex
+        rows = [{"user_id": userID, **pick} for pick in picks]
+        pipe = AsyncRedis.client().pipeline(transaction=True)
+        pipe.xadd(PICK_STREAM, {"picks": json.dumps(rows), "token": token})
+        pipe.hset(PICK_PENDING_PREFIX + userID, mapping={
+            _pendingField(pick["game_id"], pick["is_series"]): json.dumps({
+                "gameID": pick["game_id"],
+                "pickedHome": pick["pickedHome"],
+                "isSeries": pick["is_series"],
+                "comment": pick["comment"],
+                "date": dates[pick["game_id"]].isoformat(),
+                "token": token,
+            }) for pick in picks})
+        pipe.expire(PICK_PENDING_PREFIX + userID, PICK_PENDING_SECONDS)
+        await pipe.execute()
+        self.submitted += 1
+
+    async def pending(self, userID: str) -> dict[tuple[int, bool], dict]:
+        """
+        The user's picks that haven't been written yet, by (game ID, is series), in the same format as the read
+        endpoints (gameID, pickedHome, isSeries, comment) plus the game's date. Empty if Redis can't be reached.
+        """
+        if not self.enabled:
+            return {}
+        try:
+            pending = await AsyncRedis.client().hgetall(PICK_PENDING_PREFIX + userID)
+        except aioredis.RedisError as e:
+            logging.warning("Could not read pending picks: %s", e)
+            return {}
+        picks = {}
+        for value in pending.values():
+            pick = json.loads(value)
+            del pick["token"]
+            picks[(pick["gameID"], pick["isSeries"])] = pick
+        return picks
+
+    async def run(self, sessionmaker, writer: PickWriter):
+        """
+        Flushes the stream while this worker holds the flusher lock, and waits for it otherwise, until cancelled.
+        Runs whatever the mode, so that picks queued before switching back to "direct" are still written.
+        """
+        consumer = f"{socket.gethostname()}:{os.getpid()}"
+        while True:
+            client = aioredis.Redis.from_url(os.getenv("REDIS_URL"), decode_responses=True)
+            try:
+                try:
+                    await client.xgroup_create(PICK_STREAM, PICK_GROUP, id="0", mkstream=True)
+                except aioredis.ResponseError as e:
+                    if "BUSYGROUP" not in str(e):
+                        raise
+                lock = client.lock(PICK_STREAM + ":lock", timeout=PICK_FLUSH_LOCK_SECONDS)
+                while not await lock.acquire(blocking=False):
+                    await asyncio.sleep(PICK_FLUSH_LOCK_SECONDS / 2)
+                self.flushing = True
+                try:
+                    await self._flushUntilLost(client, lock, consumer, sessionmaker, writer)
+                finally:
+                    self.flushing = False
+                    try:
+                        await lock.release()
+                    except (LockError, aioredis.RedisError):
+                        pass
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.warning("Pick flusher failed, retrying: %s", e)
+                await asyncio.sleep(PICK_FLUSH_RETRY_SECONDS)
+            finally:
+                await client.aclose()
+
+    async def _flushUntilLost(self, client: aioredis.Redis, lock, consumer: str, sessionmaker, writer: PickWriter):
+        # Entries the previous flusher read but didn't acknowledge come first, in stream order.
+        claimed = await client.xautoclaim(PICK_STREAM, PICK_GROUP, consumer, min_idle_time=0, count=PICK_FLUSH_BATCH)
+        while claimed[1]:
+            await self._flush(client, claimed[1], sessionmaker, writer)
+            await lock.reacquire()
+            claimed = await client.xautoclaim(PICK_STREAM, PICK_GROUP, consumer, min_idle_time=0,
+                                              count=PICK_FLUSH_BATCH)
+        while True:
+            streams = await client.xreadgroup(PICK_GROUP, consumer, {PICK_STREAM: ">"},
+                                              count=PICK_FLUSH_BATCH, block=PICK_FLUSH_BLOCK_MS)
+            if streams:
+                await self._flush(client, streams[0][1], sessionmaker, writer)
+            await lock.reacquire()  # Raises LockError if another worker took over, then we just wait for it again
+
+    async def _flush(self, client: aioredis.Redis, entries: list, sessionmaker, writer: PickWriter):
+        entries = [(entryID, fields) for entryID, fields in entries if fields]  # Deleted while pending
+        if not entries:
+            return
+        try:
+            async with sessionmaker() as db:
+                await writer(db, [pick for entry in entries for pick in _submittedPicks(entry)])
+            written = entries
+        except (IntegrityError, DataError) as e:
+            # Written one by one instead, so that one bad entry doesn't hold up the rest of the batch forever.
+            # Any other error (e.g. the database being down) leaves the batch unacknowledged, to be retried.
+            logging.warning("Could not write %d queued pick requests at once, writing them one by one: %s",
+                            len(entries), e)
+            written = []
+            for entry in entries:
+                try:
+                    async with sessionmaker() as db:
+                        await writer(db, _submittedPicks(entry))
+                    written.append(entry)
+                except (IntegrityError, DataError) as e:
+                    logging.error("Could not write queued picks %s, moving them to %s: %s", entry[1], PICK_DEAD_STREAM, e)
+                    await client.xadd(PICK_DEAD_STREAM, entry[1])
+                    self.deadLettered += 1
+
+        await self._acknowledge(client, entries)
+        self.batches += 1
+        self.flushed += len(written)
+        gameIDs: dict[bool, set[int]] = {False: set(), True: set()}
+        pipe = client.pipeline(transaction=False)
+        for entry in entries:  # Dead-lettered picks aren't pending anymore either
+            fields = entry[1]
+            picks = json.loads(fields["picks"])
+            if entry in written:
+                for pick in picks:
+                    gameIDs[bool(pick["is_series"])].add(pick["game_id"])
+            pipe.eval(CLEAR_PENDING_SCRIPT, 1, PICK_PENDING_PREFIX + picks[0]["user_id"], fields["token"],
+                      *(_pendingField(pick["game_id"], pick["is_series"]) for pick in picks))
+        await pipe.execute()
+        for isSeries, ids in gameIDs.items():
+            if ids:
+                await publishEvent({"kind": "picks", "gameIDs": sorted(ids), "isSeries": isSeries})
+
+    async def _acknowledge(self, client: aioredis.Redis, entries: list):
+        entryIDs = [entryID for entryID, _ in entries]
+        pipe = client.pipeline(transaction=True)
+        pipe.xack(PICK_STREAM, PICK_GROUP, *entryIDs)
+        pipe.xdel(PICK_STREAM, *entryIDs)
+        await pipe.execute()
+
+    async def getStats(self) -> dict:
+        try:
+            queued = await AsyncRedis.client().xlen(PICK_STREAM)
+        except aioredis.RedisError:
+            queued = None
+        return {
+            "mode": "stream" if self.enabled else "direct",
+            "flushing": self.flushing,
+            "queued": queued,
+            "submitted": self.submitted,
+            "flushed": self.flushed,
+            "batches": self.batches,
+            "deadLettered": self.deadLettered,
+        }
+
+
+PickQueue = PickIngestion(PICK_INGESTION == "stream")
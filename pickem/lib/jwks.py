@@ -0,0 +1,136 @@
+"""
+This module keeps the Clerk JSON Web Key Set (JWKS) in memory, so authenticating a request doesn't need an
+outbound call to Clerk every single time.
+Keys are indexed by their key ID (`kid`), and are only re-fetched when the cache is too old or when a token
+is signed with a key we haven't seen before (i.e. Clerk rotated its keys).
+Fetching is async and shares one HTTP client, so a slow Clerk never blocks the event loop.
+"""
+import asyncio
+import json
+import logging
+import os
+import time
+
+import httpx
+from jwt import jwk_from_dict
+from jwt.jwk import AbstractJWKBase
+from jwt.utils import b64decode
+
+CLERK_JWKS_URL = os.getenv("CLERK_JWKS_URL", "https://api.clerk.dev/v1/jwks")
+JWKS_TTL_SECONDS = int(os.getenv("JWKS_TTL_SECONDS", 60 * 60))
+JWKS_MIN_REFRESH_SECONDS = int(os.getenv("JWKS_MIN_REFRESH_SECONDS", 30))  # Throttles refreshes for unknown kids
+JWKS_TIMEOUT_SECONDS = float(os.getenv("JWKS_TIMEOUT_SECONDS", 3))
+JWKS_FAILURE_BACKOFF_SECONDS = 5  # How long to fail fast after Clerk couldn't be reached, when we have no keys
+
+
+class JWKSUnavailable(Exception):
+    """ Raised when there are no signing keys to verify with, because Clerk couldn't be reached. """
+
+
+def getTokenKeyID(token: str) -> str | None:
+    """
+    Reads the `kid` from the (unverified) header of a JWT, if it has one.
+    Raises a ValueError if the header isn't base64-encoded JSON object, or if its `kid` isn't a string.
+    """
+    try:
+        header = json.loads(b64decode(token.split(".")[0]))
+    except (TypeError, UnicodeDecodeError) as e:
+        raise ValueError(f"Invalid token header: {e}")
+    if not isinstance(header, dict):
+        raise ValueError("Invalid token header: not an object")
+    kid = header.get("kid")
+    if kid is not None and not isinstance(kid, str):
+        raise ValueError("Invalid token header: kid isn't a string")
+    return kid
+
+
+def getTokenSubject(authorization: str | None) -> str | None:
+    """
+    Reads the `sub` (user ID) from an Authorization header's token, WITHOUT verifying it. Only use it where a forged
+    value is harmless (e.g. picking a database to read from), never to authenticate. None if there's no readable sub.
+    """
+    try:
+        payload = json.loads(b64decode(authorization.split(" ")[1].split(".")[1]))
+    except (AttributeError, IndexError, TypeError, ValueError):
+        return None
+    subject = payload.get("sub") if isinstance(payload, dict) else None
+    return subject if isinstance(subject, str) else None
+
+
+class JWKSCache:
+    """
+    An in-memory store of signing keys, indexed by `kid`.
+    Refreshes are single-flight: when a burst of requests all find a stale cache or an unknown key ID,
+    only the first one will call Clerk, and the rest will use the keys it fetched.
+    """
+
+    def __init__(self, url: str = CLERK_JWKS_URL, ttl: int = JWKS_TTL_SECONDS,
+                 minRefreshInterval: int = JWKS_MIN_REFRESH_SECONDS, timeout: float = JWKS_TIMEOUT_SECONDS):
+        self.url = url
+        self.ttl = ttl
+        self.minRefreshInterval = minRefreshInterval
+        self.timeout = timeout
+        self.keys: dict[str | None, AbstractJWKBase] = {}
+        self.fetchedAt = float("-inf")
+        self.fetches = 0
+        self.failedAt = float("-inf")
+        self._lock = asyncio.Lock()
+        self._client: httpx.AsyncClient | None = None
+
+    def _isExpired(self) -> bool:
+        return time.monotonic() - self.fetchedAt > self.ttl
+
+    def _getClient(self) -> httpx.AsyncClient:
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(timeout=httpx.Timeout(self.timeout))
+        return self._client
+
+    async def close(self):
+        """ Closes the shared HTTP client, should be called on shutdown. """
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    async def _fetch(self):
+        resp = await self._getClient().get(self.url, headers={"Authorization": "Bearer " + os.environ["CLERK_API_KEY"]})
+        resp.raise_for_status()
+        self.keys = {key.get("kid"): jwk_from_dict(key) for key in resp.json()["keys"]}
+        self.fetchedAt = time.monotonic()
+        self.fetches += 1
+
+    async def _refresh(self, kid: str | None, force: bool):
+        """ Fetches the key set, unless another caller already did while we were waiting for the lock. """
+        async with self._lock:
+            if not force and not self._isExpired():
+                return
+            if force and kid in self.keys:  # Someone else picked up the rotated key
+                return
+            if force and time.monotonic() - self.fetchedAt < self.minRefreshInterval:
+                return
+            if not self.keys and time.monotonic() - self.failedAt < JWKS_FAILURE_BACKOFF_SECONDS:
+                raise JWKSUnavailable("Clerk was unreachable moments ago")  # Don't queue up behind more timeouts
+            try:
+                await self._fetch()
+            except (httpx.HTTPError, KeyError, ValueError) as e:
+                self.failedAt = time.monotonic()
+                if not self.keys:
+                    raise JWKSUnavailable("Could not fetch JWKS") from e
+                # Keep serving the keys we already have, and try again shortly.
+                logging.warning("Could not refresh JWKS, using cached keys: %s", e)
+                self.fetchedAt = time.monotonic() - self.ttl + self.minRefreshInterval
+
+    async def getKey(self, kid: str | None) -> AbstractJWKBase | None:
+        """
+        Returns the signing key for the given key ID, refreshing the key set if necessary.
+        Raises JWKSUnavailable if there are no keys at all and Clerk can't be reached.
+        """
+        if not self.keys or self._isExpired():
+            await self._refresh(kid, force=False)
+        if kid is None:  # No key ID to match against, so use the first key like before.
+            return next(iter(self.keys.values()), None)
+        if kid not in self.keys:  # Unknown key ID, the keys may have been rotated.
+            await self._refresh(kid, force=True)
+        return self.keys.get(kid)
+
+
+JWKS = JWKSCache()
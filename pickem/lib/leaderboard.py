@@ -0,0 +1,190 @@
+"""
+The pick leaderboards, kept in Redis and updated as picks are graded instead of recounted from the picks table.
+
+There's one leaderboard per mode ("daily" picks and "series" picks), each made of:
+- `leaderboard:<mode>`: a sorted set of user IDs, scored by their number of correct picks;
+- `leaderboard:<mode>:totals`: a hash of user ID to their number of graded picks;
+- `leaderboard:<mode>:order`: the same users in the same order, as "<correct picks, zero-padded>:<user ID>" members
+  that all score 0, so that the position of any (correct picks, user ID) cursor is one ZLEXCOUNT away, even for a
+  user that's gone or moved since.
+Only picks that are part of a session count, like in crud.picks.get_leaders.
+
+Grading calls applyGrades with how each user's counts changed, or invalidate when it couldn't (the grades are in the
+database already). rebuild recomputes everything from the database (`python -m scripts.rebuild_leaderboard`), and
+runs (see ensureBuilt) at startup and after every grading round when a leaderboard isn't built. Grading holds
+the leaderboard lock from before it writes the grades until it has applied them, and rebuild holds it too, so that a
+rebuild can't both read a grade from the database and have it added again afterwards.
+Ranks are competition ranks: users with the same number of correct picks share a rank. Users with the same number of
+correct picks are ordered by user ID, descending (that's how ZREVRANGE orders them); the SQL leaderboards order them
+the same way, so pages can be read from either.
+"""
+import logging
+from typing import Awaitable, Callable, Iterable, NamedTuple
+
+from redis import asyncio as aioredis
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from pickem.db.redis_pool import AsyncRedis
+
+LEADERBOARD_PREFIX = "leaderboard:"
+LEADERBOARD_LOCK_SECONDS = 60
+LEADERBOARD_FORMAT = "2"  # Stored in the built markers, leaderboards built in another format get rebuilt
+
+# Adds to a user's correct picks (KEYS[1]), and moves them to match in the order set (KEYS[2]).
+APPLY_CORRECT_SCRIPT = """
+local previous = redis.call('ZSCORE', KEYS[1], ARGV[1])
+local correct = redis.call('ZINCRBY', KEYS[1], ARGV[2], ARGV[1])
+if previous then
+    redis.call('ZREM', KEYS[2], string.format('%010d:', tonumber(previous)) .. ARGV[1])
+end
+redis.call('ZADD', KEYS[2], 0, string.format('%010d:', tonumber(correct)) .. ARGV[1])
+"""
+
+
+class GradeChange(NamedTuple):
+    """ How a user's counts changed in one mode: picks that became (or stopped being) correct, and newly graded picks. """
+    userID: str
+    isSeries: bool
+    correct: int
+    total: int
+
+
+# Gets (userID, correctPicks, totalPicks) for every user with graded picks in a mode, see crud.picks.get_leaders
+LeaderLoader = Callable[[AsyncSession, bool], Awaitable[list[tuple[str, int, int]]]]
+
+
+def getMode(isSeries: bool) -> str:
+    return "series" if isSeries else "daily"
+
+
+def _key(isSeries: bool) -> str:
+    return LEADERBOARD_PREFIX + getMode(isSeries)
+
+
+def _orderMember(correct: int, userID: str) -> str:
+    """ The member for a user in the order set: ascending by correct picks, then by user ID (like the tied users). """
+    return "%010d:%s" % (correct, userID)
+
+
+class LeaderboardStore:
+    """ Reads and updates the leaderboards. Reads return None when the leaderboard hasn't been built yet. """
+
+    def lock(self):
+        """ The lock grading and rebuilds hold (use with `async with`), it waits for the other one to be done. """
+        return AsyncRedis.client().lock(LEADERBOARD_PREFIX + "lock", timeout=LEADERBOARD_LOCK_SECONDS,
+                                        blocking_timeout=LEADERBOARD_LOCK_SECONDS)
+
+    async def isBuilt(self, isSeries: bool) -> bool:
+        return await AsyncRedis.client().get(_key(isSeries) + ":built") == LEADERBOARD_FORMAT
+
+    async def invalidate(self):
+        """ Marks both leaderboards as not built: they're read from the database until ensureBuilt rebuilds them. """
+        await AsyncRedis.client().delete(*(_key(isSeries) + ":built" for isSeries in (False, True)))
+
+    async def applyGrades(self, changes: Iterable[GradeChange]):
+        """ Adds the changes to the leaderboards, atomically. The caller should be holding the lock. """
+        changes = [change for change in changes if change.correct or change.total]
+        if not changes:
+            return
+        pipe = AsyncRedis.client().pipeline(transaction=True)
+        for change in changes:
+            key = _key(change.isSeries)
+            # Also adds users graded for the first time
+            pipe.eval(APPLY_CORRECT_SCRIPT, 2, key, key + ":order", change.userID, change.correct)
+            if change.total:
+                pipe.hincrby(key + ":totals", change.userID, change.total)
+        await pipe.execute()
+
+    async def rebuild(self, db: AsyncSession, loader: LeaderLoader) -> dict[str, int]:
+        """ Recomputes both leaderboards from the database. Returns the number of users on each. """
+        client = AsyncRedis.client()
+        counts = {}
+        async with self.lock():
+            for isSeries in (False, True):
+                leaders = await loader(db, isSeries)
+                key = _key(isSeries)
+                pipe = client.pipeline(transaction=True)
+                pipe.delete(key, key + ":totals", key + ":order")
+                if leaders:
+                    pipe.zadd(key, {userID: correct for userID, correct, _ in leaders})
+                    pipe.zadd(key + ":order", {_orderMember(correct, userID): 0 for userID, correct, _ in leaders})
+                    pipe.hset(key + ":totals", mapping={userID: total for userID, _, total in leaders})
+                pipe.set(key + ":built", LEADERBOARD_FORMAT)
+                await pipe.execute()
+                counts[getMode(isSeries)] = len(leaders)
+        return counts
+
+    async def ensureBuilt(self, sessionmaker, loader: LeaderLoader):
+        """ Builds the leaderboards if they never were. Failing only means the leaderboard is read from the database. """
+        try:
+            if await self.isBuilt(False) and await self.isBuilt(True):
+                return
+            async with sessionmaker() as db:
+                counts = await self.rebuild(db, loader)
+            logging.info("Built the leaderboards: %s", counts)
+        except Exception as e:
+            logging.warning("Could not build the leaderboards: %s", e)
+
+    async def _entries(self, client: aioredis.Redis, isSeries: bool, leaders: list[tuple[str, float]], start: int):
+        """ Adds the totals and competition ranks to (userID, correct) pairs, in order from position `start`. """
+        if not leaders:
+            return []
+        key = _key(isSeries)
+        totals = await client.hmget(key + ":totals", [userID for userID, _ in leaders])
+        # Users tied with the first one may come before it in the set, its rank counts users with strictly more.
+        rank = await client.zcount(key, f"({leaders[0][1]}", "+inf") + 1 if start else 1
+        entries = []
+        for position, ((userID, correct), total) in enumerate(zip(leaders, totals)):
+            if position and correct < leaders[position - 1][1]:
+                rank = start + position + 1
+            entries.append({
+                "rank": rank,
+                "userID": userID,
+                "correctPicks": int(correct),
+                "totalPicks": int(total or 0),
+            })
+        return entries
+
+    async def getPage(self, isSeries: bool, limit: int, after: tuple[int, str] | None = None) -> list[dict] | None:
+        """
+        A page of `limit` users, best first.
+        :param after: The correct picks and user ID of the last entry of the previous page.
+        """
+        client = AsyncRedis.client()
+        if not await self.isBuilt(isSeries):
+            return None
+        start = await self._positionAfter(client, isSeries, after) if after is not None else 0
+        leaders = await client.zrevrange(_key(isSeries), start, start + limit - 1, withscores=True)
+        return await self._entries(client, isSeries, leaders, start)
+
+    async def _positionAfter(self, client: aioredis.Redis, isSeries: bool, after: tuple[int, str]) -> int:
+        """ The position of the first user that comes after the given (correct picks, user ID) in the leaderboard. """
+        # Everyone with more correct picks and the tied users with a greater user ID come first, and that user itself if
+        # it's still there at that score.
+        return await client.zlexcount(_key(isSeries) + ":order", "[" + _orderMember(*after), "+")
+
+    async def getAround(self, isSeries: bool, userID: str, around: int) -> dict | None:
+        """ The user's entry, and the `around` users above and below them. The user is None if they aren't ranked. """
+        client = AsyncRedis.client()
+        if not await self.isBuilt(isSeries):
+            return None
+        position = await client.zrevrank(_key(isSeries), userID)
+        if position is None:
+            return {"user": None, "leaders": []}
+        start = max(position - around, 0)
+        leaders = await client.zrevrange(_key(isSeries), start, position + around, withscores=True)
+        entries = await self._entries(client, isSeries, leaders, start)
+        return {"user": entries[position - start], "leaders": entries}
+
+    async def getStats(self) -> dict:
+        client = AsyncRedis.client()
+        stats = {}
+        for isSeries in (False, True):
+            stats[getMode(isSeries)] = {
+                "built": await self.isBuilt(isSeries),
+                "users": await client.zcard(_key(isSeries)),
+            }
+        return stats
+
+
+Leaderboard = LeaderboardStore()
@@ -0,0 +1,303 @@
+"""
+Pushes live stats to connected clients, instead of having them poll /games/status.
+
+Each worker runs a single LiveStatsHub: it subscribes to Redis keyspace notifications for the `game:<id>` hashes the
+live stats service writes, re-reads the hashes that changed (in batches) and fans out only the fields that changed
+to every subscription interested in those games.
+
+The hub also follows the `pickem:events` channel, which the API itself publishes to (see publishEvent): when picks
+are written, it recomputes the tallies of those games (once per batch, for every worker's clients together), and
+it passes along grading results. Keyspace notifications need `notify-keyspace-events` to include
+`K`, `h` (hash commands), `g` (DEL/EXPIRE), `x` (keys expiring on their TTL) and `e` (keys evicted), otherwise games
+would never end; the hub tries to enable them, but managed Redis may need it set on the server instead.
+"""
+import asyncio
+import json
+import logging
+import os
+from contextlib import contextmanager
+from typing import Awaitable, Callable, Iterable, NamedTuple
+
+from redis import asyncio as aioredis
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from pickem.db.redis_pool import AsyncRedis
+from pickem.lib.status import LiveStatsUnavailable, getStatsKey, retrieveStatsBatch
+
+LIVE_BATCH_SECONDS = float(os.getenv("LIVE_BATCH_SECONDS", 0.1))  # Collects notifications before re-reading hashes
+LIVE_QUEUE_SIZE = int(os.getenv("LIVE_QUEUE_SIZE", 256))  # Pending events per subscription before it's dropped
+LIVE_KEEPALIVE_SECONDS = 15
+LIVE_RECONNECT_SECONDS = 5
+KEYSPACE_EVENTS = "Khgxe"
+EVENTS_CHANNEL = "pickem:events"
+
+
+class LiveEvent(NamedTuple):
+    """
+    An update for one game. `kind` is "status" (changed live stats fields), "ended" (the live stats are gone),
+    "tally" (the pick counts changed) or "result" (the game's picks were graded).
+    """
+    kind: str
+    gameID: int
+    data: dict
+
+
+# Gets the tallies of the given games ({gameID: {totalPicks, homePicks, awayPicks}}), see crud.picks.getTalliesForGames
+TallyLoader = Callable[[AsyncSession, list[int], bool], Awaitable[dict[int, dict]]]
+
+
+class Subscription:
+    """ The events (of the given kinds, or all of them) for a set of games (or every game) for one client. """
+
+    def __init__(self, gameIDs: Iterable[int] | None, kinds: Iterable[str] | None = None):
+        self.gameIDs = None if gameIDs is None else frozenset(gameIDs)
+        self.kinds = None if kinds is None else frozenset(kinds)
+        self.queue: asyncio.Queue[LiveEvent | None] = asyncio.Queue(LIVE_QUEUE_SIZE)
+        self.dropped = False
+
+    def wants(self, gameID: int, kind: str | None = None) -> bool:
+        return ((self.gameIDs is None or gameID in self.gameIDs) and
+                (kind is None or self.kinds is None or kind in self.kinds))
+
+    def put(self, event: LiveEvent):
+        if self.dropped:
+            return
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            # The client can't keep up. Rather than skipping diffs (and leaving it with wrong stats), end its stream;
+            # it reconnects and starts over from a snapshot.
+            self.dropped = True
+            self.queue.get_nowait()
+            self.queue.put_nowait(None)
+
+    async def get(self) -> LiveEvent | None:
+        """ The next event, or None once the subscription was dropped. """
+        return await self.queue.get()
+
+    async def getBatch(self, tickSeconds: float) -> list[LiveEvent] | None:
+        """
+        Waits for an event, then for `tickSeconds` more, and returns everything that came in meanwhile.
+        Returns None once the subscription was dropped.
+        """
+        events = [await self.get()]
+        await asyncio.sleep(tickSeconds)
+        while not self.queue.empty():
+            events.append(self.queue.get_nowait())
+        return None if None in events else events
+
+
+def diffStats(gameID: int, old: dict | None, new: dict) -> dict:
+    """ The fields of `new` that aren't the same in `old` (empty if nothing changed). The game ID is always included. """
+    changed = {key: value for key, value in new.items() if old is None or old.get(key) != value}
+    return {"gameID": gameID, **changed} if changed else {}
+
+
+def hasKeyspaceEvents(flags: str) -> bool:
+    """ Whether the notify-keyspace-events flags include every KEYSPACE_EVENTS class (`A` includes them all). """
+    return "K" in flags and ("A" in flags or all(flag in flags for flag in KEYSPACE_EVENTS))
+
+
+class LiveStatsHub:
+    """ Keeps the last known live stats of each game, and sends what changed to the subscriptions. """
+
+    def __init__(self):
+        self.stats: dict[int, dict] = {}
+        self.subscriptions: set[Subscription] = set()
+        self.connected = False
+        self.notifications = 0
+        self.published = 0
+
+    @contextmanager
+    def subscribe(self, gameIDs: Iterable[int] | None = None, kinds: Iterable[str] | None = None):
+        subscription = Subscription(gameIDs, kinds)
+        self.subscriptions.add(subscription)
+        try:
+            yield subscription
+        finally:
+            self.subscriptions.discard(subscription)
+
+    def publish(self, event: LiveEvent):
+        self.published += 1
+        for subscription in list(self.subscriptions):
+            if subscription.wants(event.gameID, event.kind):
+                subscription.put(event)
+
+    def getStats(self) -> dict:
+        return {
+            "connected": self.connected,
+            "subscriptions": len(self.subscriptions),
+            "liveGames": len(self.stats),
+            "notifications": self.notifications,
+            "published": self.published,
+        }
+
+    async def snapshot(self, gameIDs: Iterable[int]) -> dict[int, dict]:
+        """ The current live stats of the given games (the ones that have any). Can raise LiveStatsUnavailable. """
+        gameIDs = list(gameIDs)
+        missing = [gameID for gameID in gameIDs if gameID not in self.stats]
+        if missing or not self.connected:
+            # Until we're listening, what we have could be stale.
+            self.stats.update(await retrieveStatsBatch(gameIDs if not self.connected else missing, AsyncRedis.client()))
+        return {gameID: self.stats[gameID] for gameID in gameIDs if gameID in self.stats}
+
+    async def refresh(self, gameIDs: set[int]):
+        """ Re-reads the given games' live stats, and publishes what changed. """
+        stats = await retrieveStatsBatch(gameIDs, AsyncRedis.client())
+        for gameID in gameIDs:
+            if gameID in stats:
+                changed = diffStats(gameID, self.stats.get(gameID), stats[gameID])
+                self.stats[gameID] = stats[gameID]
+                if changed:
+                    self.publish(LiveEvent("status", gameID, changed))
+            elif self.stats.pop(gameID, None) is not None:
+                self.publish(LiveEvent("ended", gameID, {"gameID": gameID}))
+
+    async def refreshTallies(self, sessionmaker, tallyLoader: TallyLoader, gameIDs: set[int], isSeries: bool):
+        """ Reloads the tallies of the given games (the ones anyone is subscribed to), and publishes them. """
+        gameIDs = [gameID for gameID in gameIDs
+                   if any(subscription.wants(gameID, "tally") for subscription in self.subscriptions)]
+        if not gameIDs:
+            return
+        async with sessionmaker() as db:
+            tallies = await tallyLoader(db, gameIDs, isSeries)
+        for gameID, tally in tallies.items():
+            self.publish(LiveEvent("tally", gameID, {"gameID": gameID, "isSeries": isSeries, **tally}))
+
+    async def _enableNotifications(self, client: aioredis.Redis):
+        try:
+            current = (await client.config_get("notify-keyspace-events")).get("notify-keyspace-events", "")
+            if not hasKeyspaceEvents(current):
+                await client.config_set("notify-keyspace-events", "".join(sorted(set(current + KEYSPACE_EVENTS))))
+        except aioredis.RedisError as e:
+            logging.warning("Could not enable keyspace notifications, they need to be enabled on the server: %s", e)
+
+    async def listen(self, sessionmaker, tallyLoader: TallyLoader):
+        """
+        Follows the keyspace notifications of the live stats, and the events channel, until cancelled.
+        Reconnects if Redis goes away.
+        """
+        while True:
+            client = aioredis.Redis.from_url(os.getenv("REDIS_URL"), decode_responses=True)
+            try:
+                await self._enableNotifications(client)
+                pattern = "__keyspace@%d__:%s*" % (AsyncRedis.client().connection_pool.connection_kwargs.get("db", 0),
+                                                   getStatsKey(""))
+                async with client.pubsub() as pubsub:
+                    await pubsub.psubscribe(pattern)
+                    await pubsub.subscribe(EVENTS_CHANNEL)
+                    self.connected = True
+                    # Anything could have changed while we weren't listening.
+                    if self.stats:
+                        await self.refresh(set(self.stats))
+                    while True:
+                        message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=None)
+                        if message is None:
+                            continue
+                        messages = [message]
+                        await asyncio.sleep(LIVE_BATCH_SECONDS)
+                        while (message := await pubsub.get_message(ignore_subscribe_messages=True)) is not None:
+                            messages.append(message)
+                        await self._handle(messages, sessionmaker, tallyLoader)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.warning("Live stats listener failed, reconnecting: %s", e)
+                await asyncio.sleep(LIVE_RECONNECT_SECONDS)
+            finally:
+                self.connected = False
+                await client.aclose()
+
+    async def _handle(self, messages: list[dict], sessionmaker, tallyLoader: TallyLoader):
+        statusIDs: set[int] = set()
+        tallyIDs: dict[bool, set[int]] = {False: set(), True: set()}
+        for message in messages:
+            if message["channel"] != EVENTS_CHANNEL:
+                gameID = message["channel"].rsplit(":", 1)[-1]
+                if gameID.isnumeric():
+                    statusIDs.add(int(gameID))
+                continue
+            event = json.loads(message["data"])
+            if event["kind"] == "picks":
+                tallyIDs[bool(event["isSeries"])].update(event["gameIDs"])
+            elif event["kind"] == "results":
+                for result in event["results"]:
+                    self.publish(LiveEvent("result", result["gameID"], result))
+        self.notifications += len(messages)
+
+        try:
+            if statusIDs:
+                await self.refresh(statusIDs)
+        except LiveStatsUnavailable:
+            pass  # Logged already, the next change to these games will be picked up.
+        for isSeries, gameIDs in tallyIDs.items():
+            if not gameIDs:
+                continue
+            try:
+                await self.refreshTallies(sessionmaker, tallyLoader, gameIDs, isSeries)
+            except SQLAlchemyError as e:
+                # Keep the subscription up, the next picks event for these games will retry.
+                logging.warning("Could not refresh the tallies of games %s: %s", sorted(gameIDs), e)
+
+
+LiveStats = LiveStatsHub()
+
+
+async def publishEvent(event: dict):
+    """
+    Sends an event to the hubs of every worker: {"kind": "picks", "gameIDs": [...], "isSeries": bool} when picks were
+    written, or {"kind": "results", "results": [{"gameID": ..., ...}]} when games were graded.
+    Failing to publish only means clients see the change later, so errors are logged and ignored.
+    """
+    try:
+        await AsyncRedis.client().publish(EVENTS_CHANNEL, json.dumps(event, default=str))
+    except aioredis.RedisError as e:
+        logging.warning("Could not publish %s event: %s", event.get("kind"), e)
+
+
+def mergeEvents(events: Iterable[LiveEvent]) -> list[dict]:
+    """
+    Folds a batch of events into one update per game: the changed live stats fields (merged), `ended`, and the latest
+    tally and grading result.
+    """
+    updates: dict[int, dict] = {}
+    for event in events:
+        update = updates.setdefault(event.gameID, {"gameID": event.gameID})
+        if event.kind == "status":
+            update.pop("ended", None)
+            update.setdefault("status", {}).update(event.data)
+        elif event.kind == "ended":
+            update.pop("status", None)
+            update["ended"] = True
+        elif event.kind == "tally":
+            update["tally"] = event.data
+        elif event.kind == "result":
+            update["result"] = event.data
+    return list(updates.values())
+
+
+def toServerSentEvent(kind: str, data) -> str:
+    return "event: %s\ndata: %s\n\n" % (kind, json.dumps(data, default=str))
+
+
+async def streamLiveStats(gameIDs: list[int] | None):
+    """
+    The Server-Sent Events for a client: a "snapshot" of the current live stats first, then "status" events with the
+    fields that changed and "ended" events. The stream ends if the client falls too far behind.
+    """
+    with LiveStats.subscribe(gameIDs, ("status", "ended")) as subscription:
+        try:
+            snapshot = await LiveStats.snapshot(gameIDs) if gameIDs is not None else dict(LiveStats.stats)
+        except LiveStatsUnavailable:
+            snapshot = {}
+        yield toServerSentEvent("snapshot", list(snapshot.values()))
+        while True:
+            try:
+                event = await asyncio.wait_for(subscription.get(), LIVE_KEEPALIVE_SECONDS)
+            except asyncio.TimeoutError:
+                yield ": keepalive\n\n"
+                continue
+            if event is None:
+                return
+            yield toServerSentEvent(event.kind, event.data)
@@ -0,0 +1,215 @@
+"""
+This module keeps the season's schedule in memory, so that listing games doesn't need to query Postgres at all.
+The index is immutable: when games change, a new index is built from the old one (only touching the games that
+changed) and swapped in, so readers never see a half-updated schedule.
+
+Changes are picked up through Postgres notifications: a trigger on `games` sends the ID of every changed game on
+the `games_changed` channel (see the 2026-10-18 migration), and a background task reloads just those games.
+"""
+import asyncio
+import datetime
+import logging
+import os
+from dataclasses import dataclass, fields
+from types import MappingProxyType
+from typing import Awaitable, Callable, Iterable
+
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from pickem.db import models
+
+GAMES_CHANGED_CHANNEL = "games_changed"
+SCHEDULE_DEBOUNCE_SECONDS = float(os.getenv("SCHEDULE_DEBOUNCE_SECONDS", 0.5))  # Batches bursts of notifications
+SCHEDULE_RECONNECT_SECONDS = 5
+
+
+@dataclass(frozen=True)
+class GameRecord:
+    """ An immutable copy of a game row, along with its team names (same fields as the game responses). """
+    id: int
+    homeTeam_id: int
+    awayTeam_id: int
+    date: datetime.date
+    startTimeUTC: datetime.datetime
+    venue: str
+    finished: bool
+    is_marquee: bool
+    series_num: int | None
+    winner: int | None
+    home_score: int | None
+    away_score: int | None
+    homeName: str
+    awayName: str
+
+    @classmethod
+    def fromGame(cls, game: models.Game, homeName: str, awayName: str) -> "GameRecord":
+        return cls(**{field.name: getattr(game, field.name) for field in fields(cls)
+                      if field.name not in ("homeName", "awayName")},
+                   homeName=homeName, awayName=awayName)
+
+
+def _sortKey(game: GameRecord):
+    return game.startTimeUTC or datetime.datetime.min, game.id
+
+
+def _teamPair(team1_id: int, team2_id: int) -> frozenset:
+    return frozenset((team1_id, team2_id))
+
+
+class ScheduleIndex:
+    """ Read-only lookups of games by ID, date, series number and pair of teams. Results are ordered by start time. """
+
+    def __init__(self, games: dict[int, GameRecord]):
+        byDate: dict[datetime.date, list[GameRecord]] = {}
+        bySeries: dict[int, list[GameRecord]] = {}
+        byTeams: dict[frozenset, list[GameRecord]] = {}
+        for game in games.values():
+            byDate.setdefault(game.date, []).append(game)
+            bySeries.setdefault(game.series_num, []).append(game)
+            byTeams.setdefault(_teamPair(game.homeTeam_id, game.awayTeam_id), []).append(game)
+
+        self._games = MappingProxyType(dict(games))
+        self._byDate = MappingProxyType({key: tuple(sorted(value, key=_sortKey)) for key, value in byDate.items()})
+        self._bySeries = MappingProxyType({key: tuple(sorted(value, key=_sortKey)) for key, value in bySeries.items()})
+        self._byTeams = MappingProxyType({key: tuple(sorted(value, key=_sortKey)) for key, value in byTeams.items()})
+
+    def __len__(self):
+        return len(self._games)
+
+    def getGame(self, gameID: int) -> GameRecord | None:
+        return self._games.get(gameID)
+
+    def getGamesByIDs(self, gameIDs: Iterable[int]) -> list[GameRecord]:
+        return [self._games[gameID] for gameID in gameIDs if gameID in self._games]
+
+    def getGamesByDate(self, date: datetime.date) -> list[GameRecord]:
+        return list(self._byDate.get(date, ()))
+
+    def getGamesBySeries(self, seriesNum: int) -> list[GameRecord]:
+        return list(self._bySeries.get(seriesNum, ()))
+
+    def getGamesWithTeams(self, team1_id: int, team2_id: int) -> list[GameRecord]:
+        return list(self._byTeams.get(_teamPair(team1_id, team2_id), ()))
+
+    def getChangesFrom(self, previous: "ScheduleIndex") -> list[GameRecord]:
+        """ The games that were added, removed or changed since the previous index (both versions of changed ones). """
+        return [game for gameID in previous._games.keys() | self._games.keys()
+                for game in (previous._games.get(gameID), self._games.get(gameID))
+                if game is not None and previous._games.get(gameID) != self._games.get(gameID)]
+
+    def withChanges(self, changed: Iterable[GameRecord], removedIDs: Iterable[int] = ()) -> "ScheduleIndex":
+        """ Returns a new index with the given games replaced (or added) and removed. This index isn't modified. """
+        changed = list(changed)
+        removedIDs = set(removedIDs)
+        if not changed and not removedIDs:
+            return self
+        games = dict(self._games)
+        touched = [games[gameID] for gameID in removedIDs | {game.id for game in changed} if gameID in games]
+        for gameID in removedIDs:
+            games.pop(gameID, None)
+        for game in changed:
+            games[game.id] = game
+
+        # Only the buckets that held (or will hold) a changed game need to be rebuilt.
+        index = object.__new__(ScheduleIndex)
+        index._games = MappingProxyType(games)
+        index._byDate = self._rebuildBuckets(self._byDate, games, touched + changed, lambda game: game.date)
+        index._bySeries = self._rebuildBuckets(self._bySeries, games, touched + changed, lambda game: game.series_num)
+        index._byTeams = self._rebuildBuckets(self._byTeams, games, touched + changed,
+                                              lambda game: _teamPair(game.homeTeam_id, game.awayTeam_id))
+        return index
+
+    @staticmethod
+    def _rebuildBuckets(buckets, games: dict[int, GameRecord], affected: list[GameRecord], keyFn):
+        newBuckets = dict(buckets)
+        for key in {keyFn(game) for game in affected}:
+            members = {game.id for game in buckets.get(key, ())} | {game.id for game in affected if keyFn(game) == key}
+            bucket = sorted((games[gameID] for gameID in members if gameID in games and keyFn(games[gameID]) == key),
+                            key=_sortKey)
+            if bucket:
+                newBuckets[key] = tuple(bucket)
+            else:
+                newBuckets.pop(key, None)
+        return MappingProxyType(newBuckets)
+
+
+# Loads games (all of them when given None, otherwise only the given IDs) as records, see crud.games.loadGameRecords
+GameLoader = Callable[[AsyncSession, list[int] | None], Awaitable[list[GameRecord]]]
+# Called with the games that changed (both their old and new versions), see crud.games.invalidateGames
+ChangeHandler = Callable[[list[GameRecord]], Awaitable[None]]
+
+
+class ScheduleStore:
+    """ Holds the current schedule index, and keeps it up to date. `index` is None until the schedule is loaded. """
+
+    def __init__(self):
+        self.index: ScheduleIndex | None = None
+        self.loadedAt: datetime.datetime | None = None
+        self.refreshes = 0
+
+    async def load(self, db: AsyncSession, loader: GameLoader, previous: ScheduleIndex | None = None,
+                   onChange: ChangeHandler | None = None):
+        """ Loads every game. With the previous index, `onChange` is called with the games that changed since. """
+        self.index = ScheduleIndex({game.id: game for game in await loader(db, None)})
+        self.loadedAt = datetime.datetime.utcnow()
+        logging.info("Loaded %d games into the schedule index", len(self.index))
+        if previous is not None and onChange is not None:
+            changes = self.index.getChangesFrom(previous)
+            if changes:
+                await onChange(changes)
+
+    async def refresh(self, db: AsyncSession, loader: GameLoader, gameIDs: set[int], onChange: ChangeHandler | None = None):
+        """ Reloads only the given games. Games that no longer exist are removed from the index. """
+        if self.index is None:
+            return await self.load(db, loader)
+        previous = self.index.getGamesByIDs(gameIDs)
+        records = await loader(db, list(gameIDs))
+        self.index = self.index.withChanges(records, gameIDs - {record.id for record in records})
+        self.refreshes += 1
+        if onChange is not None:
+            await onChange(previous + records)
+
+    async def listen(self, engine, sessionmaker, loader: GameLoader, onChange: ChangeHandler | None = None):
+        """
+        Loads the schedule, then keeps it up to date from `games_changed` notifications until cancelled.
+        `onChange` is called with the games that changed, after the index has been updated.
+        Holds one connection from the engine's pool for as long as it's listening.
+        If the connection drops, it reconnects and reloads everything, since notifications may have been missed, and
+        calls `onChange` with whatever changed meanwhile (so cached responses don't keep serving it).
+        """
+        previous: ScheduleIndex | None = None  # The last index before losing the connection
+        while True:
+            try:
+                async with engine.connect() as conn:
+                    try:
+                        changed: asyncio.Queue[int | None] = asyncio.Queue()
+                        rawConnection = (await conn.get_raw_connection()).driver_connection
+                        await rawConnection.add_listener(GAMES_CHANGED_CHANNEL,
+                                                         lambda *args: changed.put_nowait(int(args[-1])))
+                        rawConnection.add_termination_listener(lambda *args: changed.put_nowait(None))
+                        async with sessionmaker() as db:
+                            await self.load(db, loader, previous, onChange)
+                        previous = None
+                        while True:
+                            gameIDs = {await changed.get()}
+                            await asyncio.sleep(SCHEDULE_DEBOUNCE_SECONDS)
+                            while not changed.empty():
+                                gameIDs.add(changed.get_nowait())
+                            if None in gameIDs:
+                                raise ConnectionError("Listener connection was closed")
+                            async with sessionmaker() as db:
+                                await self.refresh(db, loader, gameIDs, onChange)
+                    finally:
+                        # Never hand the connection back to the pool still LISTENing, with our callbacks on it.
+                        await conn.invalidate()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # Changes could be missed while we're disconnected, so go back to the database until we've reloaded.
+                logging.warning("Schedule listener failed, reconnecting: %s", e)
+                previous = previous if previous is not None else self.index
+                self.index = None
+                await asyncio.sleep(SCHEDULE_RECONNECT_SECONDS)
+
+
+Schedule = ScheduleStore()
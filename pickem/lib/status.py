@@ -1,19 +1,86 @@
 """
 This module contains functions that provide status updates for games in real time.
 See the live stats repo (https://github.com/specificlanguage/PickemGoLiveStats) for more information.
+
+Reads go through the asyncio Redis pool (see pickem.db.redis_pool) and give up after LIVE_STATS_TIMEOUT_SECONDS,
+raising LiveStatsUnavailable, so that callers can fall back to the statuses in the database.
 """
-from redis import Redis
+import asyncio
+import logging
+import os
+from typing import Iterable
 
+from redis.asyncio import Redis
+from redis.exceptions import RedisError
 
-async def retrieveStats(gameID: int, cache: Redis):
-    """
-    Retrieves the stats for a game with the given ID.
-    """
-    response = cache.hgetall("game:" + str(gameID))
+from pickem.db.redis_pool import REDIS_TIMEOUT_SECONDS
+
+NO_LIVE_STATS = {"error": "Game does not have live stats."}
+LIVE_STATS_TIMEOUT_SECONDS = float(os.getenv("LIVE_STATS_TIMEOUT_SECONDS", REDIS_TIMEOUT_SECONDS))
+
+
+class LiveStatsUnavailable(Exception):
+    """ Raised when Redis didn't answer (in time), so we don't know the live stats. """
+
+
+def getStatsKey(gameID: int) -> str:
+    return "game:" + str(gameID)
+
+
+def parseStats(response: dict) -> dict:
+    """ Turns a game's live stats hash into a response, converting the numeric fields to ints. """
     if not response:
-        return {"error": "Game does not have live stats."}
+        return dict(NO_LIVE_STATS)
+    response = {(key.decode() if isinstance(key, bytes) else key): (value.decode() if isinstance(value, bytes) else value)
+                for key, value in response.items()}
     for key in response:
         if response[key].isnumeric():
             response[key] = int(response[key])
     return response
 
+
+def getStoredStatus(game) -> dict:
+    """ The status of a game without live stats (scheduled, completed or postponed), from the game itself. """
+    currStatus = "COMPLETED" if game.finished else "SCHEDULED"
+    if game.winner == None and game.finished:
+        currStatus = "POSTPONED"
+    statusObj = {
+        "status": currStatus,
+        "gameID": game.id,
+    }
+    if statusObj["status"] == "SCHEDULED":
+        statusObj["startTimeUTC"] = game.startTimeUTC
+    if statusObj["status"] == "COMPLETED" or statusObj["status"] == "POSTPONED":
+        statusObj["homeScore"] = game.home_score
+        statusObj["awayScore"] = game.away_score
+    return statusObj
+
+
+async def _withTimeout(request):
+    try:
+        return await asyncio.wait_for(request, LIVE_STATS_TIMEOUT_SECONDS)
+    except (asyncio.TimeoutError, RedisError) as e:
+        logging.warning("Live stats unavailable: %r", e)
+        raise LiveStatsUnavailable() from e
+
+
+async def retrieveStats(gameID: int, cache: Redis):
+    """
+    Retrieves the stats for a game with the given ID.
+    """
+    return parseStats(await _withTimeout(cache.hgetall(getStatsKey(gameID))))
+
+
+async def retrieveStatsBatch(gameIDs: Iterable[int], cache: Redis) -> dict[int, dict]:
+    """
+    Retrieves the stats for all the given games in a single round trip to Redis (a pipeline of HGETALLs).
+    Games without live stats are left out of the result.
+    """
+    gameIDs = list(gameIDs)
+    if not gameIDs:
+        return {}
+    pipeline = cache.pipeline(transaction=False)
+    for gameID in gameIDs:
+        pipeline.hgetall(getStatsKey(gameID))
+    responses = await _withTimeout(pipeline.execute())
+    return {gameID: parseStats(response) for gameID, response in zip(gameIDs, responses) if response}
@@ -0,0 +1,74 @@
+"""
+This module keeps the 30 teams in memory. Teams basically never change, so there's no reason to query (or join)
+the `teams` table for every request: lookups by ID or abbreviation, and team names for games, come from here.
+"""
+import logging
+from dataclasses import dataclass, fields
+from types import MappingProxyType
+from typing import Iterable
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from pickem.db import models
+
+
+@dataclass(frozen=True)
+class TeamRecord:
+    """ An immutable copy of a team row (same fields as the team responses). """
+    id: int
+    name: str
+    cityName: str
+    teamName: str
+    logo: str
+    abbr: str
+
+    @classmethod
+    def fromTeam(cls, team: models.Team) -> "TeamRecord":
+        return cls(**{field.name: getattr(team, field.name) for field in fields(cls)})
+
+
+class TeamRegistry:
+    """ Read-only lookups of teams by ID and abbreviation. """
+
+    def __init__(self, teams: Iterable[TeamRecord]):
+        teams = sorted(teams, key=lambda team: team.id)
+        self._teams = tuple(teams)
+        self._byID = MappingProxyType({team.id: team for team in teams})
+        self._byAbbr = MappingProxyType({team.abbr: team for team in teams})
+
+    def __len__(self):
+        return len(self._teams)
+
+    def __contains__(self, teamID: int):
+        return teamID in self._byID
+
+    def getAllTeams(self) -> list[TeamRecord]:
+        return list(self._teams)
+
+    def getTeamByID(self, teamID: int) -> TeamRecord | None:
+        return self._byID.get(teamID)
+
+    def getTeamByAbbr(self, abbr: str) -> TeamRecord | None:
+        return self._byAbbr.get(abbr)
+
+
+class TeamStore:
+    """ Holds the team registry. It's loaded at startup, or on first use if that didn't work. """
+
+    def __init__(self):
+        self.registry: TeamRegistry | None = None
+
+    async def load(self, db: AsyncSession) -> TeamRegistry:
+        self.registry = TeamRegistry(TeamRecord.fromTeam(team) for team in (await db.scalars(select(models.Team))).all())
+        logging.info("Loaded %d teams into the team registry", len(self.registry))
+        return self.registry
+
+    async def get(self, db: AsyncSession, teamIDs: Iterable[int] = ()) -> TeamRegistry:
+        """ Returns the registry, (re)loading it if it isn't loaded or is missing any of the given team IDs. """
+        if self.registry is None or any(teamID not in self.registry for teamID in teamIDs):
+            return await self.load(db)
+        return self.registry
+
+
+Teams = TeamStore()
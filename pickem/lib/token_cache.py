@@ -0,0 +1,80 @@
+"""
+This module remembers tokens that have already been verified, so that the same bearer token sent over and over
+(which the frontend does a lot on every page load) doesn't need its RSA signature checked every time.
+Tokens are stored by their SHA-256 hash, never in plain text, and are dropped once they expire.
+"""
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import NamedTuple
+
+TOKEN_CACHE_SIZE = int(os.getenv("TOKEN_CACHE_SIZE", 10000))
+
+
+class VerifiedToken(NamedTuple):
+    sub: str
+    azp: str | None
+    exp: int
+
+
+class VerifiedTokenCache:
+    """ A bounded LRU cache of verified tokens, with hit/miss counters. """
+
+    def __init__(self, maxSize: int = TOKEN_CACHE_SIZE):
+        self.maxSize = maxSize
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evicted = 0
+        self._entries: OrderedDict[bytes, VerifiedToken] = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(token: str) -> bytes:
+        return hashlib.sha256(token.encode()).digest()
+
+    def get(self, token: str) -> VerifiedToken | None:
+        """ Returns the claims of a previously verified token, if it is still cached and hasn't expired. """
+        key = self._key(token)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.exp <= time.time():  # Expired tokens must be verified (and rejected) again.
+                del self._entries[key]
+                self.expired += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, token: str, claims: dict):
+        """ Stores the claims of a verified token. Tokens without an expiry are never cached. """
+        if not isinstance(claims.get("exp"), int):
+            return
+        key = self._key(token)
+        with self._lock:
+            self._entries[key] = VerifiedToken(claims.get("sub"), claims.get("azp"), claims["exp"])
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxSize:
+                self._entries.popitem(last=False)
+                self.evicted += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "maxSize": self.maxSize,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hitRate": self.hits / lookups if lookups else 0.0,
+                "expired": self.expired,
+                "evicted": self.evicted,
+            }
+
+
+TokenCache = VerifiedTokenCache()
@@ -1,15 +1,25 @@
-from fastapi import FastAPI, Depends
+import asyncio
+import logging
+
+from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi_cache import FastAPICache
-from fastapi_cache.backends.inmemory import InMemoryBackend # TODO later: use Redis
-from fastapi_cache.decorator import cache
 from dotenv import load_dotenv
-from sqlalchemy.orm import Session
 import httpx
 
-from pickem.routers import games, picks, users
-from pickem.dependencies import get_db
+from pickem.routers import games, picks, users, internal
+from pickem.lib.cache import Cache, cached
+from pickem.lib.ingest import PickQueue
+from pickem.lib.grading import Grading
+from pickem.lib.jwks import JWKS
+from pickem.lib.leaderboard import Leaderboard
+from pickem.lib.live import LiveStats
+from pickem.lib.schedule import Schedule
+from pickem.lib.teams import Teams
+from pickem.db.alchemy import async_engine, AsyncSessionLocal, AsyncReadSessionLocal
+from pickem.db.redis_pool import AsyncRedis
 from pickem.db.crud import teams
+from pickem.db.crud.games import invalidateGames, loadGameRecords
+from pickem.db.crud.picks import get_leaders, getGamesToGrade, getTalliesForGames, gradePicks, write_picks
 
 load_dotenv()
 app = FastAPI()
@@ -17,6 +27,7 @@ app = FastAPI()
 app.include_router(games.router)
 app.include_router(picks.router)
 app.include_router(users.router)
+app.include_router(internal.router)
 
 # TODO use env variables depending on env
 app.add_middleware(
@@ -33,9 +44,10 @@ async def root():
             "version": "0.0.1 alpha"}
 
 @app.get("/teams/standings")
-@cache(expire=60 * 60 * 3)  # Retrieve new stats only a few times a day.
+@cached(softTTL=60 * 60 * 3, hardTTL=60 * 60 * 24)  # Retrieve new stats only a few times a day.
 async def getTeamRecords():
-    resp =httpx.get("https://statsapi.mlb.com/api/v1/standings?leagueId=103,104&season=2024&standingTypes=regularSeason&hydrate=division,conference,sport,league,team,")
+    async with httpx.AsyncClient() as client:
+        resp = await client.get("https://statsapi.mlb.com/api/v1/standings?leagueId=103,104&season=2024&standingTypes=regularSeason&hydrate=division,conference,sport,league,team,")
     standingGroups = {"standings": [], "teams": {}}  # Want to return standings by division as well as by team
     for standingGroup in resp.json()["records"]:
         standingObj = {"name": standingGroup["division"]["name"], "teams": []}
@@ -56,14 +68,44 @@ async def getTeamRecords():
 
 
 @app.get("/teams")
-@cache(expire=1000000)  # We don't need to retrieve this data from the database very often, if at all.
-async def getTeams(id: int | None = None, abbr: str | None = None, db: Session = Depends(get_db)):
-    if id:
-        return teams.getTeamByID(db, id)
-    if abbr:
-        return teams.getTeamByAbbr(db, abbr)
-    return teams.getAllTeams(db)
+@cached(softTTL=1000000)  # We don't need to retrieve this data from the database very often, if at all.
+async def getTeams(id: int | None = None, abbr: str | None = None):
+    async with AsyncReadSessionLocal() as db:
+        if id:
+            return await teams.getTeamByID(db, id)
+        if abbr:
+            return await teams.getTeamByAbbr(db, abbr)
+        return await teams.getAllTeams(db)
+
+backgroundTasks: list[asyncio.Task] = []
 
 @app.on_event("startup")
 async def startup():
-    FastAPICache.init(InMemoryBackend(), prefix="pickem")
+    AsyncRedis.open()
+    try:
+        async with AsyncSessionLocal() as db:
+            await Teams.load(db)
+    except Exception as e:  # Not fatal, the registry is loaded on first use instead.
+        logging.warning("Could not load the team registry: %s", e)
+    # Loads the schedule into memory and keeps it up to date, game lookups use the database until it's ready.
+    backgroundTasks.append(asyncio.create_task(Schedule.listen(async_engine, AsyncSessionLocal, loadGameRecords, invalidateGames)))
+    # Keeps this worker's response cache in line with the other workers'.
+    backgroundTasks.append(asyncio.create_task(Cache.listen()))
+    # One Redis subscriber per worker, pushing live stats, tallies and results to the stream and feed clients.
+    backgroundTasks.append(asyncio.create_task(LiveStats.listen(AsyncSessionLocal, getTalliesForGames)))
+    # Writes the picks queued on the stream (in one worker at a time), see PICK_INGESTION.
+    backgroundTasks.append(asyncio.create_task(PickQueue.run(AsyncSessionLocal, write_picks)))
+    # The leaderboards are read from the database until they're built.
+    backgroundTasks.append(asyncio.create_task(Leaderboard.ensureBuilt(AsyncSessionLocal, get_leaders)))
+    # Grades the picks of games that finished since the last round (in one worker at a time), and rebuilds the
+    # leaderboards if grading couldn't update them.
+    backgroundTasks.append(asyncio.create_task(Grading.run(AsyncSessionLocal, getGamesToGrade, gradePicks, get_leaders)))
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    for task in backgroundTasks:
+        task.cancel()
+    await asyncio.gather(*backgroundTasks, return_exceptions=True)
+    await JWKS.close()
+    await AsyncRedis.close()
@@ -1,13 +1,23 @@
-from datetime import datetime
+import asyncio
+import json
+import os
+from datetime import date
 from typing import Annotated
 
-from fastapi import APIRouter, Depends, HTTPException, Query
-from redis import Redis
-from sqlalchemy.orm import Session
+from fastapi import APIRouter, Depends, HTTPException, Query, Response, WebSocket, WebSocketException, status
+from fastapi.responses import StreamingResponse
+from redis.asyncio import Redis
+from sqlalchemy.ext.asyncio import AsyncSession
 
-from pickem.dependencies import get_db, get_redis
-from pickem.db.crud import series, games
-from pickem.lib.status import retrieveStats
+from pickem.db.alchemy import AsyncSessionLocal, AsyncReadSessionLocal
+from pickem.db.replica import isStickyToPrimary
+from pickem.dependencies import get_read_db, get_redis, get_user_optional
+from pickem.db.crud import series, games, picks
+from pickem.lib.cache import cached, dateTag, seriesTag
+from pickem.lib.live import LiveStats, mergeEvents, streamLiveStats
+from pickem.lib.status import LiveStatsUnavailable, getStoredStatus, retrieveStats, retrieveStatsBatch
+
+LIVE_FEED_TICK_SECONDS = float(os.getenv("LIVE_FEED_TICK_SECONDS", 0.5))  # Updates are sent at most this often
 
 router = APIRouter(
     prefix="/games",
@@ -22,20 +32,26 @@ async def get_games_with_teams(team1_abbr: str | None = None,
                                team2_abbr: str | None = None,
                                team1_id: int | None = None,
                                team2_id: int | None = None,
-                               db: Session = Depends(get_db)):
+                               season: int | None = None,
+                               startDate: date | None = None,
+                               endDate: date | None = None,
+                               db: AsyncSession = Depends(get_read_db)):
     if team1_id is None or team2_id is None:
         if team1_abbr is None or team2_abbr is None:
             raise HTTPException(status_code=400, detail=
             "Either team1_id/team2_id must be specified, or team1_abbr/team2_abbr.")
-        gamesInfo = games.getGamesWithAbbr(db, team1_abbr, team2_abbr)
+        gamesInfo = await games.getGamesWithAbbr(db, team1_abbr, team2_abbr, season, startDate, endDate)
         return gamesInfo
 
-    return games.getGamesWithTeams(db, team1_id, team2_id)
+    return await games.getGamesWithTeams(db, team1_id, team2_id, season, startDate, endDate)
 
 
 @router.get("/date")
-async def get_game_by_date(year: int, month: int, day: int, db: Session = Depends(get_db)):
-    return games.getGamesByDate(db, year, month, day)
+@cached(softTTL=60 * 60 * 24, tags=lambda year, month, day: [dateTag(date(year, month, day))])
+async def get_game_by_date(year: int, month: int, day: int):
+    """ Cached until one of the games changes (see crud.games.invalidateGames). """
+    async with AsyncSessionLocal() as db:
+        return await games.getGamesByDate(db, year, month, day)
 
 
 @router.get("/series/seriesNums")
@@ -44,15 +60,19 @@ async def get_series_nums():
 
 
 @router.get("/series")
-async def get_game_by_series(seriesNum: int, db: Session = Depends(get_db)):
-    games = series.getGamesBySeries(db, seriesNum)
+@cached(softTTL=60 * 60 * 24, tags=lambda seriesNum: [seriesTag(seriesNum)])
+async def get_game_by_series(seriesNum: int):
+    """ Cached until one of the games changes (see crud.games.invalidateGames). """
+    async with AsyncSessionLocal() as db:
+        games = await series.getGamesBySeries(db, seriesNum)
     if len(games) == 0:
         raise HTTPException(status_code=404, detail="No games for this series number")
     return games
 
 
 @router.get("/status/date")
-async def get_game_status(year: int, month: int, day: int, redis: Redis = Depends(get_redis), db: Session = Depends(get_db)):
+async def get_game_status(year: int, month: int, day: int, response: Response, redis: Redis = Depends(get_redis),
+                          db: AsyncSession = Depends(get_read_db)):
     """
     Returns the current status of the games on the given date, usually in the form of:
     Please note that due to limitations on Redis cache, all fields are returned as strings.
@@ -72,42 +92,131 @@ async def get_game_status(year: int, month: int, day: int, redis: Redis = Depend
     `currentInning: int`, `currentPitcher: str`, `atBat: str`
     `isTopInning: int`, `outs: int`, `onFirst: int`, `onSecond: int`, `onThird: int`
     Please note that the last five fields are 0 or 1, representing booleans.
-    """
-    response = []
-    gameObjs = games.getGamesByDate(db, year, month, day)
-    gameIDs = [gameObj.id for gameObj in gameObjs]
 
-    needsDBQuery = set(gameIDs)
-    for gid in gameIDs:
-        stats = await retrieveStats(gid, redis)
-        if not stats.get("error"):
-            needsDBQuery.remove(gid)
-            response.append(stats)
+    Completed and postponed games without live stats report their scores as `home_score` and `away_score` instead.
 
-    # Live stats not available for all items still in needsDBQuery, which means either scheduled or completed, must query the database.
-    gameObjs = games.getGamesByIDs(db, list(needsDBQuery))
+    If the live stats can't be read in time, every game gets its status from the database instead, and the
+    `X-Live-Stats: unavailable` header is set.
+    """
+    statuses = []
+    gameObjs = await games.getGamesByDate(db, year, month, day)
+    try:
+        liveStats = await retrieveStatsBatch([gameObj.id for gameObj in gameObjs], redis)
+    except LiveStatsUnavailable:
+        liveStats = {}
+        response.headers["X-Live-Stats"] = "unavailable"
+    statuses.extend(liveStats.values())
+
+    # Live stats not available for the other games, which means either scheduled or completed, use the games we already loaded.
+    # This endpoint has always returned their scores as home_score/away_score, clients depend on it.
     for gameObj in gameObjs:
-        currStatus = "COMPLETED" if gameObj.finished else "SCHEDULED"
-        if gameObj.winner == None and gameObj.finished:
-            currStatus = "POSTPONED"
-        statusObj = {
-            "status": currStatus,
+        if gameObj.id in liveStats:
+            continue
+        statusObj = getStoredStatus(gameObj)
+        if "homeScore" in statusObj:
+            statusObj["home_score"] = statusObj.pop("homeScore")
+            statusObj["away_score"] = statusObj.pop("awayScore")
+        statuses.append(statusObj)
+
+    return statuses
+
+
+
+
+@router.get("/status/stream")
+async def stream_game_status(gameIDs: Annotated[list[int] | None, Query()] = None,
+                             year: int | None = None, month: int | None = None, day: int | None = None):
+    """
+    Streams the live stats of the given games (or of the games on the given date, or of every game) as Server-Sent
+    Events, instead of polling /games/status:
+    - `snapshot`: sent first, a list of the current live stats of the games, in the same format as /games/status.
+    - `status`: the fields that changed for one game, along with its `gameID`.
+    - `ended`: the live stats for a game (`gameID`) are gone; the game's status is in the database from now on.
+    """
+    if gameIDs is None and None not in (year, month, day):
+        # Don't hold on to a database connection for as long as the stream is open.
+        async with AsyncReadSessionLocal() as db:
+            gameIDs = [game.id for game in await games.getGamesByDate(db, year, month, day)]
+    return StreamingResponse(streamLiveStats(gameIDs), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+async def getFeedSnapshot(db: AsyncSession, gameIDs: list[int], isSeries: bool, uid: str | None) -> list[dict]:
+    """ The current status, pick tally and (for signed in users) pick of each of the games. """
+    gameObjs = await games.getGamesByIDs(db, gameIDs)
+    try:
+        liveStats = await LiveStats.snapshot(gameIDs)
+    except LiveStatsUnavailable:
+        liveStats = {}
+    tallies = await picks.getTalliesForGames(db, gameIDs, isSeries)
+    userPicks = {pick.game_id: pick for pick in await picks.get_picks(db, gameIDs, isSeries, uid)} if uid else {}
+    return [{
+        "gameID": gameObj.id,
+        "status": liveStats.get(gameObj.id) or getStoredStatus(gameObj),
+        "tally": tallies.get(gameObj.id),
+        "pick": {
             "gameID": gameObj.id,
-        }
-        if statusObj["status"] == "SCHEDULED":
-            statusObj["startTimeUTC"] = gameObj.startTimeUTC
-        if statusObj["status"] == "COMPLETED" or statusObj["status"] == "POSTPONED":
-            statusObj["home_score"] = gameObj.home_score
-            statusObj["away_score"] = gameObj.away_score
-        response.append(statusObj)
+            "pickedHome": userPicks[gameObj.id].pickedHome,
+            "isSeries": userPicks[gameObj.id].is_series,
+            "comment": userPicks[gameObj.id].comment,
+        } if gameObj.id in userPicks else None,
+    } for gameObj in gameObjs]
+
+
+@router.websocket("/feed")
+async def game_feed(websocket: WebSocket, gameIDs: Annotated[list[int] | None, Query()] = None,
+                    year: int | None = None, month: int | None = None, day: int | None = None,
+                    isSeries: bool = False, token: str | None = None):
+    """
+    A feed for a slate of games (the given game IDs, or the games on the given date), for the game-day screen.
+    Pass the session token as `token` to also get your own picks (browsers can't set headers on WebSockets).
+    The first message is `{"type": "snapshot", "games": [{gameID, status, tally, pick}]}`, and after that,
+    `{"type": "update", "games": [...]}` messages with, for each game that changed since the last one: the changed
+    live `status` fields (or `ended`), the new `tally`, and the grading `result`. Updates are batched, so there's
+    at most one message every LIVE_FEED_TICK_SECONDS.
+    """
+    if gameIDs is None and None in (year, month, day):
+        raise WebSocketException(status.WS_1008_POLICY_VIOLATION, "Either gameIDs or year/month/day must be specified.")
+    uid = await get_user_optional("Bearer " + token) if token else None
+    await websocket.accept()
 
-    return response
+    # Sessions are only used for the snapshot, not held for as long as the feed is open.
+    sessionmaker = AsyncSessionLocal if await isStickyToPrimary(uid) else AsyncReadSessionLocal
+    if gameIDs is None:
+        async with sessionmaker() as db:
+            gameIDs = [game.id for game in await games.getGamesByDate(db, year, month, day)]
 
+    # Subscribed before taking the snapshot, so that nothing is missed in between.
+    with LiveStats.subscribe(gameIDs) as events:
+        async with sessionmaker() as db:
+            snapshot = await getFeedSnapshot(db, gameIDs, isSeries, uid)
 
+        async def sendUpdates():
+            await websocket.send_text(json.dumps({"type": "snapshot", "games": snapshot}, default=str))
+            while (batch := await events.getBatch(LIVE_FEED_TICK_SECONDS)) is not None:
+                updates = mergeEvents(event for event in batch
+                                      if event.kind != "tally" or event.data["isSeries"] == isSeries)
+                if updates:
+                    await websocket.send_text(json.dumps({"type": "update", "games": updates}, default=str))
+            # Fell too far behind, the client should reconnect to get a new snapshot.
+            await websocket.close(status.WS_1013_TRY_AGAIN_LATER)
+
+        async def receive():
+            while True:
+                await websocket.receive_text()  # Client messages aren't used, this only waits for a disconnect
+
+        tasks = [asyncio.create_task(sendUpdates()), asyncio.create_task(receive())]
+        try:
+            await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
 
 
 @router.get("/status")
-async def get_game_status(gameID: int, redis: Redis = Depends(get_redis), db: Session = Depends(get_db)):
+async def get_game_status(gameID: int, response: Response, redis: Redis = Depends(get_redis),
+                          db: AsyncSession = Depends(get_read_db)):
     """ Returns the current status of one single game, usually in the form of:
         Please note that due to limitations on Redis cache, all fields are returned as strings.
         {
@@ -126,33 +235,27 @@ async def get_game_status(gameID: int, redis: Redis = Depends(get_redis), db: Se
         `currentInning: int`, `currentPitcher: str`, `atBat: str`
         `isTopInning: int`, `outs: int`, `onFirst: int`, `onSecond: int`, `onThird: int`
         Please note that the last five fields are 0 or 1, representing booleans.
+
+        If the live stats can't be read in time, the status comes from the database instead, and the
+        `X-Live-Stats: unavailable` header is set.
     """
 
-    stats = await retrieveStats(gameID, redis)
-    if not stats.get("error"):
-        return stats
+    try:
+        stats = await retrieveStats(gameID, redis)
+        if not stats.get("error"):
+            return stats
+    except LiveStatsUnavailable:
+        response.headers["X-Live-Stats"] = "unavailable"
 
     # Live stats not available for all items still in needsDBQuery, which means either scheduled or completed,
     # must query the database.
-    gameObjs = games.getGamesByIDs(db, [gameID])
+    gameObjs = await games.getGamesByIDs(db, [gameID])
     for gameObj in gameObjs:
-        currStatus = "COMPLETED" if gameObj.finished else "SCHEDULED"
-        if gameObj.winner == None and gameObj.finished:
-            currStatus = "POSTPONED"
-        statusObj = {
-            "status": currStatus,
-            "gameID": gameObj.id,
-        }
-        if statusObj["status"] == "SCHEDULED":
-            statusObj["startTimeUTC"] = gameObj.startTimeUTC
-        if statusObj["status"] == "COMPLETED" or statusObj["status"] == "POSTPONED":
-            statusObj["homeScore"] = gameObj.home_score
-            statusObj["awayScore"] = gameObj.away_score
-        return statusObj
+        return getStoredStatus(gameObj)
 
 
 @router.get("/{id}")
-async def get_game(id: str, db: Session = Depends(get_db)):
+async def get_game(id: str, db: AsyncSession = Depends(get_read_db)):
     game = await games.getGame(db, int(id))
     if not game:
         raise HTTPException(status_code=404, detail="Game does not exist")
@@ -0,0 +1,76 @@
+from typing import Annotated
+
+from fastapi import APIRouter, Depends, HTTPException, Query
+
+from pickem.db.alchemy import async_engine, AsyncSessionLocal
+from pickem.db.crud.picks import getGamesToGrade, gradePicks
+from pickem.db.pool import getPoolStats
+from pickem.dependencies import require_internal_token
+from pickem.lib.cache import Cache
+from pickem.lib.grading import Grading
+from pickem.lib.ingest import PickQueue
+from pickem.lib.leaderboard import Leaderboard
+from pickem.lib.live import LiveStats
+from pickem.lib.token_cache import TokenCache
+
+router = APIRouter(
+    prefix="/internal",
+    tags=["internal"],
+    dependencies=[Depends(require_internal_token)],  # Not for the public, see require_internal_token
+    responses={404: {"message": "Not found"}}
+)
+
+
+@router.get("/auth-cache")
+async def get_auth_cache_stats():
+    """ Returns the hit/miss counters of the verified-token cache. """
+    return TokenCache.stats()
+
+
+@router.get("/db-pool")
+async def get_db_pool_stats():
+    """ Returns connections checked out and idle, overflow, and how long checkouts have waited for a connection. """
+    return getPoolStats(async_engine)
+
+
+@router.get("/live")
+async def get_live_stats_hub():
+    """ Returns whether this worker is listening for live stats, its subscriptions and how many events it sent. """
+    return LiveStats.getStats()
+
+
+@router.get("/cache")
+async def get_response_cache_stats():
+    """ Returns the response cache's entries and hit/stale/miss counters. """
+    return Cache.stats()
+
+
+@router.get("/picks")
+async def get_pick_ingestion_stats():
+    """ Returns the pick ingestion mode, whether this worker is the flusher, and how many picks are queued/written. """
+    return await PickQueue.getStats()
+
+
+@router.get("/leaderboard")
+async def get_leaderboard_stats():
+    """ Returns whether each leaderboard has been built in Redis, and how many users are on it. """
+    return await Leaderboard.getStats()
+
+
+@router.get("/grading")
+async def get_grading_stats():
+    """ Returns whether picks are being graded in this worker, and the report of its last grading round. """
+    return Grading.getStats()
+
+
+@router.post("/grading")
+async def grade_picks(gameID: Annotated[list[int] | None, Query()] = None):
+    """
+    Grades the picks of the given games (regrading them if their results changed), or of every finished game with
+    ungraded picks. Responds with a 409 right away if a round (or a leaderboard rebuild) is already running.
+    Returns how many games and picks were graded, and how long it took.
+    """
+    report = await Grading.grade(AsyncSessionLocal, getGamesToGrade, gradePicks, gameID, wait=False)
+    if report is None:
+        raise HTTPException(409, detail="Grading is already running")
+    return report
@@ -1,15 +1,28 @@
+import base64
 import datetime
+import json
 import logging
-from typing import List, Annotated
+from typing import List, Annotated, Literal
 
 from fastapi import APIRouter, Depends, HTTPException, Response, status, Query
-from fastapi_cache.decorator import cache
 from pydantic import BaseModel
-from sqlalchemy.orm import Session
+from redis.exceptions import RedisError
+from sqlalchemy.ext.asyncio import AsyncSession
 
 from pickem.db.crud import games, users, picks, sessions
+from pickem.db.crud.picks import LEADERBOARD_WINDOWS
+from pickem.db.alchemy import AsyncSessionLocal
 from pickem.db.schemas import Date
-from pickem.dependencies import get_db, get_user
+from pickem.db.replica import stickToPrimary
+from pickem.dependencies import get_async_db, get_read_db, get_user
+from pickem.lib.cache import LEADERBOARD_TAG, cached, gameTag
+from pickem.lib.ingest import GameStarted, PickQueue, checkCutoff
+from pickem.lib.leaderboard import Leaderboard
+from pickem.lib.live import publishEvent
+from pickem.lib.schedule import GameRecord
+
+LEADERBOARD_MAX_PAGE = 500
+PICK_HISTORY_MAX_PAGE = 200
 
 router = APIRouter(
     prefix="/picks",
@@ -28,24 +41,76 @@ class MultiplePickEntry(BaseModel):
     picks: List[PickEntry]
 
 
+async def checkPicks(db: AsyncSession, pickList: List[PickEntry]) -> list:
+    """
+    Gets the picked games, making sure they all exist (404 otherwise) and haven't started yet (400 otherwise).
+    The pick upsert applies the cutoff too, this is to tell the user which games it turned away.
+    """
+    gameIDs = {pick.gameID for pick in pickList}
+    gameRecords = await games.getGamesByIDs(db, list(gameIDs))
+    if len(gameRecords) < len(gameIDs):
+        raise HTTPException(404, detail="Game not found")
+    try:
+        checkCutoff(gameRecords)
+    except GameStarted as e:
+        raise picksClosed(e)
+    return gameRecords
+
+
+def picksClosed(e: GameStarted) -> HTTPException:
+    return HTTPException(400, detail=f"Picks are closed for games that have started: {e.gameIDs}")
+
+
+async def queuePicks(uid: str, pickList: List[PickEntry], gameRecords: list) -> bool:
+    """
+    Queues the picks (already checked, see checkPicks) to be written in the background, when picks are ingested
+    through the stream (see lib.ingest).
+    Returns False when they should be written right away instead: in "direct" mode, or if Redis can't be reached.
+    """
+    if not PickQueue.enabled:
+        return False
+    try:
+        await PickQueue.submit(uid, [{
+            "game_id": pick.gameID,
+            "pickedHome": pick.pickedHome,
+            "is_series": pick.isSeries,
+            "comment": pick.comment,
+        } for pick in pickList], gameRecords)
+    except GameStarted as e:
+        raise picksClosed(e)
+    except RedisError as e:
+        logging.warning("Could not queue picks, writing them directly: %s", e)
+        return False
+    return True
+
+
+def withPending(pickResults: list[dict], pending: dict[tuple[int, bool], dict], wanted) -> list[dict]:
+    """ Replaces (or adds) the picks that are still queued to be written, for those `wanted` returns True for. """
+    merged = {(pick["gameID"], pick["isSeries"]): pick for pick in pickResults}
+    for key, pick in pending.items():
+        if wanted(pick):
+            merged[key] = {field: pick[field] for field in ("gameID", "pickedHome", "isSeries", "comment")}
+    return list(merged.values())
+
+
 @router.post("/session/new")
-async def createSession(date: Date | None, response: Response, uid=Depends(get_user), db: Session = Depends(get_db)):
+async def createSession(date: Date | None, response: Response, uid=Depends(get_user), db: AsyncSession = Depends(get_async_db)):
     """ Creates a list of picks for a current session (only for a specific day) """
-    prefs = users.getUserPreferences(db, uid)
+    prefs = await users.getUserPreferences(db, uid)
     if not date:
         today = date.today()
         date = Date(year=today.year, month=today.month, day=today.day)
     date = datetime.date(year=date.year, month=date.month, day=date.day)
-    session = sessions.getSession(db, uid, date, prefs.selectionTiming != "daily")
+    session = await sessions.getSession(db, uid, date, prefs.selectionTiming != "daily")
 
     if session:  # Returns without creating a new session -- must keep unique constraint
         return session
 
     # Creates the session (and returns a 201 status code to indicate creation)
-    gameOptions = games.getGamesByDate(db, date.year, date.month, date.day)
+    gameOptions = await games.queryGamesByDate(db, date.year, date.month, date.day)
     if not gameOptions:
         raise HTTPException(404, detail="No games found for this date")
-    newSess = sessions.createSession(db, uid, gameOptions,
+    newSess = await sessions.createSession(db, uid, gameOptions,
                             is_series=prefs.selectionTiming != "daily",
                             favTeam=prefs.favoriteTeam_id)
     response.status_code = status.HTTP_201_CREATED
@@ -53,30 +118,121 @@ async def createSession(date: Date | None, response: Response, uid=Depends(get_u
 
 
 @router.get("/session")
-async def getPickSession(year: int, month: int, day: int, uid=Depends(get_user), db: Session = Depends(get_db)):
-    prefs = users.getUserPreferences(db, uid)
+async def getPickSession(year: int, month: int, day: int, uid=Depends(get_user), db: AsyncSession = Depends(get_async_db)):
+    prefs = await users.getUserPreferences(db, uid)
     date = datetime.date(year=year, month=month, day=day)
-    session = sessions.getSession(db, uid, date, is_series=prefs.selectionTiming != "daily")
+    session = await sessions.getSession(db, uid, date, is_series=prefs.selectionTiming != "daily")
     if not session:
         raise HTTPException(404, detail="Session not found")
     return session
 
 
-# TODO later: Date range (i.e. by week or by month)
+def encodeCursor(*values) -> str:
+    """ The cursor of the next page, from the sort key of the last entry of the page. """
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+
+def decodeCursor(cursor: str, *types) -> tuple:
+    """ The sort key a cursor was made from, each value converted with its type. Responds with a 400 if it's invalid. """
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return tuple(convert(value) for convert, value in zip(types, values, strict=True))
+    except (TypeError, ValueError):
+        raise HTTPException(400, detail="Invalid cursor")
+
+
+@cached(softTTL=60 * 60 * 4, hardTTL=60 * 60 * 24, tags=[LEADERBOARD_TAG])
+async def getLeadersPageFromDatabase(isSeries: bool, startDate: datetime.date | None, endDate: datetime.date | None,
+                                     limit: int, after: tuple[int, str] | None) -> list[dict]:
+    """ A page of the leaderboard, added up from the daily rollups, see crud.picks.getLeadersPage. """
+    # Invalidated by grading, so read from the primary: a lagging replica could get the old standings cached again.
+    async with AsyncSessionLocal() as db:
+        leaders = await picks.getLeadersPage(db, isSeries, startDate, endDate, limit, after)
+    return [dict(leader._mapping) for leader in leaders]
+
+
 @router.get("/leaderboard")
-@cache(expire=60 * 60 * 4)
-async def getLeaderboard(db: Session = Depends(get_db)):
-    # Todo later: Discriminate by series
-    leaderboard = picks.get_leaders(db, False)
-    return {"leaders": [{
-        "userID": userID,
-        "correctPicks": correctPicks,
-        "totalPicks": totalPicks,
-    } for userID, correctPicks, totalPicks in leaderboard]}
+async def getLeaderboard(isSeries: bool = False, window: Literal[LEADERBOARD_WINDOWS] = "all",
+                         date: datetime.date | None = None,
+                         limit: Annotated[int, Query(ge=1, le=LEADERBOARD_MAX_PAGE)] = 100, cursor: str | None = None):
+    """
+    Gets a page of the users with the most correct picks, best first, with their rank (tied users share it).
+    **isSeries**: The leaderboard of series picks rather than daily picks.
+    **window**: Only count the picks of the week, month or season of `date` (today by default), or all of them.
+    **limit**: How many users to return.
+    **cursor**: The `next` value of the previous page.
+    Returns the users, and the cursor of the next page (null on the last page).
+    """
+    after = decodeCursor(cursor, int, str) if cursor else None
+    leaders = None
+    if window == "all":
+        try:
+            leaders = await Leaderboard.getPage(isSeries, limit, after)
+        except RedisError as e:
+            logging.warning("Could not read the leaderboard: %s", e)
+    if leaders is None:
+        startDate, endDate = picks.getWindowBounds(window, date or datetime.date.today())
+        leaders = await getLeadersPageFromDatabase(isSeries, startDate, endDate, limit, after)
+    last = leaders[-1] if len(leaders) == limit else None
+    return {"leaders": leaders, "next": encodeCursor(last["correctPicks"], last["userID"]) if last else None}
+
+
+@router.get("/leaderboard/me")
+async def getLeaderboardAroundMe(isSeries: bool = False, window: Literal[LEADERBOARD_WINDOWS] = "all",
+                                 date: datetime.date | None = None,
+                                 around: Annotated[int, Query(ge=0, le=50)] = 5,
+                                 uid=Depends(get_user), db: AsyncSession = Depends(get_read_db)):
+    """
+    Gets the user's rank, and the users just above and below them. Requires authentication.
+    **isSeries**: The leaderboard of series picks rather than daily picks.
+    **window**: Only count the picks of the week, month or season of `date` (today by default), or all of them.
+    **around**: How many users to return above and below the user.
+    Returns the user's entry (null if none of their picks were graded yet) and the neighbouring entries.
+    """
+    if window == "all":
+        try:
+            result = await Leaderboard.getAround(isSeries, uid, around)
+            if result is not None:
+                return result
+        except RedisError as e:
+            logging.warning("Could not read the leaderboard: %s", e)
+    startDate, endDate = picks.getWindowBounds(window, date or datetime.date.today())
+    user, leaders = await picks.getLeadersAround(db, isSeries, startDate, endDate, uid, around)
+    return {"user": dict(user._mapping) if user else None, "leaders": [dict(leader._mapping) for leader in leaders]}
+
+
+@router.get("/history")
+async def get_pick_history(isSeries: bool = False, season: int | None = None, graded: bool | None = None,
+                           limit: Annotated[int, Query(ge=1, le=PICK_HISTORY_MAX_PAGE)] = 50,
+                           cursor: str | None = None,
+                           uid=Depends(get_user), db: AsyncSession = Depends(get_read_db)):
+    """
+    Gets a page of the user's picks along with their games, latest games first. Requires authentication.
+    Picks that are still queued to be written aren't included yet.
+    **isSeries**: The series picks rather than the daily picks.
+    **season**: Only the picks of that season's games.
+    **graded**: Only the graded picks (true) or the ones still waiting for a result (false).
+    **limit**: How many picks to return.
+    **cursor**: The `next` value of the previous page.
+    Returns the picks, and the cursor of the next page (null on the last page).
+    """
+    after = decodeCursor(cursor, datetime.date.fromisoformat, int) if cursor else None
+    rows = await picks.getPicksByUser(db, uid, isSeries, season, graded, limit, after)
+    history = [{
+        "gameID": row.Game.id,
+        "pickedHome": row.pickedHome,
+        "isSeries": isSeries,
+        "comment": row.comment,
+        "correct": row.correct,
+        "game": GameRecord.fromGame(row.Game, row.Game.homeName, row.Game.awayName),
+    } for row in rows]
+    last = rows[-1].Game if len(rows) == limit else None
+    return {"picks": history, "next": encodeCursor(last.date.isoformat(), last.id) if last else None}
+
 
 @router.get("/date")
-async def get_picks_by_date(year: int, month: int, day: int, uid=Depends(get_user), db: Session = Depends(get_db)):
-    pickResults = picks.getPicksByUserDate(db, uid, year, month, day, False)
+async def get_picks_by_date(year: int, month: int, day: int, uid=Depends(get_user), db: AsyncSession = Depends(get_async_db)):
+    pickResults = await picks.getPicksByUserDate(db, uid, year, month, day, False)
     response = []
     for gameID, pickedHome, isSeries, comment in pickResults:
         response.append({
@@ -85,74 +241,69 @@ async def get_picks_by_date(year: int, month: int, day: int, uid=Depends(get_use
             "isSeries": isSeries,
             "comment": comment
         })
-    return response
+    date = datetime.date(year, month, day).isoformat()
+    return withPending(response, await PickQueue.pending(uid),
+                       lambda pick: not pick["isSeries"] and pick["date"] == date)
 
 @router.get("/all")
-async def get_total_picks_multiple(isSeries: bool, gameID: Annotated[list[int], Query()] = [], db: Session = Depends(get_db)):
+@cached(softTTL=60 * 60, tags=lambda isSeries, gameID: [gameTag(gid) for gid in gameID])
+async def get_total_picks_multiple(isSeries: bool, gameID: Annotated[list[int], Query()] = []):
     """
     Gets the total number of picks, and the number of home picks and away picks for multiple specified games.
+    Cached until picks for one of the games are written.
     :param gameIDs: Game IDs of the game to get picks for.
     :param isSeries: Whether the picks should be queried by series or not.
-    :param db: Session to use.
     :return:
     """
-    gameResults = []
-    for gid in gameID:
-        ans = picks.getTotalPicksForGame(db, gid, isSeries)
-        if not ans:
-            raise HTTPException(404, detail="Game not found")
-        gameResults.append({
-            "game_id": gid,
-            "totalPicks": ans[0],
-            "homePicks": ans[1],
-            "awayPicks": ans[2],
-        })
+    async with AsyncSessionLocal() as db:  # The primary, so that a write is never followed by a stale tally
+        tallies = await picks.getTalliesForGames(db, gameID, isSeries)
+    gameResults = [{"game_id": gid, **tallies[gid]} for gid in gameID]
     return {"results": gameResults}
 
 
 @router.get("/user")
-async def get_multiple_picks(gameID: Annotated[list[int], Query()] = [], uid=Depends(get_user), db: Session = Depends(get_db)):
+async def get_multiple_picks(gameID: Annotated[list[int], Query()] = [], uid=Depends(get_user), db: AsyncSession = Depends(get_async_db)):
     """
     Gets the picks for multiple games. Requires authentication.
     **gameIDs**: List of game IDs to get picks for.
     Returns list of picks.
     """
-    pickResp = picks.get_picks(db, gameID, False, uid)
-    return [{
+    pickResp = await picks.get_picks(db, gameID, False, uid)
+    return withPending([{
         "gameID": pick.game_id,
         "pickedHome": pick.pickedHome,
         "isSeries": pick.is_series,
         "comment": pick.comment
-    } for pick in pickResp]
+    } for pick in pickResp], await PickQueue.pending(uid),
+        lambda pick: not pick["isSeries"] and pick["gameID"] in gameID)
 
 
 @router.get("/{gameID}/all")
-async def get_total_picks(gameID: int, isSeries: bool, db: Session = Depends(get_db)):
+@cached(softTTL=60 * 60, tags=lambda gameID, isSeries: [gameTag(gameID)])
+async def get_total_picks(gameID: int, isSeries: bool):
     """
     Gets the total number of picks, and the number of home picks and away picks for a certain game.
+    Cached until picks for the game are written.
     **gameID**: Game ID of the game to get picks for.
     **isSeries**: Whether the picks should be queried by series or not.
     :return: Object containing gameID, total picks, home picks, and away picks.
     """
-    ans = picks.getTotalPicksForGame(db, gameID, isSeries)
-    if not ans:
-        raise HTTPException(404, detail="Game not found")
-    return {
-        "game_id": gameID,
-        "totalPicks": ans[0],
-        "homePicks": ans[1],
-        "awayPicks": ans[2],
-    }
+    async with AsyncSessionLocal() as db:  # The primary, so that a write is never followed by a stale tally
+        tallies = await picks.getTalliesForGames(db, [gameID], isSeries)
+    return {"game_id": gameID, **tallies[gameID]}
 
 
 @router.get("/{gameID}")
-async def get_pick(gameID: int, uid=Depends(get_user), db: Session = Depends(get_db)):
+async def get_pick(gameID: int, uid=Depends(get_user), db: AsyncSession = Depends(get_async_db)):
     """
     Gets the pick for a certain game for a certain user.
     Requires authentication.
     - **gameID**: The ID of the game to pick
     """
-    pick = picks.get_pick(db, uid, gameID)
+    for pending in (await PickQueue.pending(uid)).values():
+        if pending["gameID"] == gameID:
+            return {field: pending[field] for field in ("gameID", "pickedHome", "isSeries", "comment")}
+    pick = await picks.get_pick(db, uid, gameID)
     if not pick:
         raise HTTPException(404, detail="Pick not found")
     return {
@@ -164,48 +315,65 @@ async def get_pick(gameID: int, uid=Depends(get_user), db: Session = Depends(get
 
 
 @router.post("/{gameID}")
-async def set_pick(pick: PickEntry, response: Response, uid=Depends(get_user), db: Session = Depends(get_db), ):
+async def set_pick(pick: PickEntry, response: Response, uid=Depends(get_user), db: AsyncSession = Depends(get_async_db), ):
     """
     Sets the pick for a certain game (created) by a certain user, and associates it with each game.
     Requires authentication.
     - **gameID**: The ID of the game to pick
     - **pickedHome**: Whether the user picked the home team in the game
     - **isSeries**: Whether the user is picking for the series of games, rather than the individual game
-    Returns the Pick object that was created.
+    Returns the Pick object that was created (201) or updated. When picks are queued to be written in the background,
+    returns the pick as it was submitted instead (202).
     """
+    gameRecords = await checkPicks(db, [pick])
+    if await queuePicks(uid, [pick], gameRecords):
+        response.status_code = status.HTTP_202_ACCEPTED
+        return {"gameID": pick.gameID, "pickedHome": pick.pickedHome, "isSeries": pick.isSeries,
+                "comment": pick.comment if pick.comment else ""}
     try:
+        pickObj, created = await picks.set_pick(db, uid,
+                                                pick.gameID,
+                                                pick.pickedHome,
+                                                pick.isSeries,
+                                                pick.comment if pick.comment else "")  # Comment optional.
+        await stickToPrimary(uid)
+        await publishEvent({"kind": "picks", "gameIDs": [pick.gameID], "isSeries": pick.isSeries})
 
-        pickObj = picks.get_pick(db, uid, pick.gameID)
-
-        if pickObj:  # Pick already exists, just update instead of inserting.
-            return picks.update_pick(db, uid, pick.gameID, pick.pickedHome, pick.isSeries, pick.comment if pick.comment else "")
-
-        # Creates pick.
-        pickObj = picks.create_pick(db, uid,
-                                 pick.gameID,
-                                 pick.pickedHome,
-                                 pick.isSeries,
-                                 pick.comment if pick.comment else "")  # Comment optional.
-
-        response.status_code = status.HTTP_201_CREATED
+        if created:
+            response.status_code = status.HTTP_201_CREATED
         return pickObj
+    except GameStarted as e:  # Started since it was checked
+        raise picksClosed(e)
     except Exception as e:
         logging.warning(e)
         raise HTTPException(500, detail="Internal service error")
 
 
 @router.post("/")
-async def set_multiple_picks(pickList: MultiplePickEntry, uid=Depends(get_user), db: Session = Depends(get_db)):
+async def set_multiple_picks(pickList: MultiplePickEntry, response: Response, uid=Depends(get_user), db: AsyncSession = Depends(get_async_db)):
     """
     Sets multiple picks for multiple games -- has same functionality as set_pick, but for multiple games. Requires authentication.
     **picks**: List of picks to set.
     Returns pick object created.
     """
+    gameRecords = await checkPicks(db, pickList.picks)
+    if await queuePicks(uid, pickList.picks, gameRecords):
+        response.status_code = status.HTTP_202_ACCEPTED
+        return {"message": "Picks accepted"}
+    closed = None
     try:
-        picks.create_picks(db, uid, pickList.picks)
-        return {"message": "Picks created"}
+        await picks.create_picks(db, uid, pickList.picks)
+    except GameStarted as e:  # Started since they were checked, the picks of the other games were still written
+        closed = e
     except Exception as e:
         logging.warning(e)
         raise HTTPException(500, detail="Internal service error")
+    await stickToPrimary(uid)
+    for isSeries in {pick.isSeries for pick in pickList.picks}:
+        await publishEvent({"kind": "picks", "isSeries": isSeries,
+                            "gameIDs": [pick.gameID for pick in pickList.picks if pick.isSeries == isSeries]})
+    if closed is not None:
+        raise picksClosed(closed)
+    return {"message": "Picks created"}
 
 
@@ -4,12 +4,13 @@ from typing import Annotated
 
 import httpx
 from fastapi import APIRouter, Depends, HTTPException, Body
-from fastapi_cache.decorator import cache
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 
-from pickem.dependencies import get_db, get_user, get_user_optional
+from pickem.db.alchemy import AsyncSessionLocal
+from pickem.dependencies import get_async_db, get_user, get_user_optional
 from pickem.db.crud.users import getUserPreferences, setUserPreferences
 from pickem.db import schemas
+from pickem.lib.cache import Cache, cached, userTag
 
 router = APIRouter(
     prefix="/users",
@@ -20,36 +21,43 @@ router = APIRouter(
 
 
 @router.put("/preferences")
-def set_preferences(favoriteTeam: Annotated[int | None, Body()],
-                    selectionTiming: Annotated[str, Body()],
-                    userID: str = Depends(get_user),
-                    db: Session = Depends(get_db)):
-    setUserPreferences(db, schemas.UserPreferences(
+async def set_preferences(favoriteTeam: Annotated[int | None, Body()],
+                          selectionTiming: Annotated[str, Body()],
+                          userID: str = Depends(get_user),
+                          db: AsyncSession = Depends(get_async_db)):
+    await setUserPreferences(db, schemas.UserPreferences(
         favoriteTeam=favoriteTeam,
         selectionTiming=selectionTiming,
         id=userID))
     return {"message": "Preferences updated"}
 
 
+async def loadPreferences(uid: str):
+    async with AsyncSessionLocal() as db:
+        return await getUserPreferences(db, uid)
+
+
 @router.get("/preferences")
-def get_preferences(uid: str,
-                    userID: str | None = Depends(get_user_optional),
-                    db: Session = Depends(get_db)):
-    res = getUserPreferences(db, uid)
+async def get_preferences(uid: str,
+                          userID: str | None = Depends(get_user_optional)):
+    # Cached until the user changes them (setUserPreferences invalidates the user's tag).
+    res = await Cache.get("pickem.routers.users.preferences:" + uid, lambda: loadPreferences(uid),
+                          softTTL=60 * 60 * 24, tags=[userTag(uid)])
     if (userID == uid):
         return res
     else:
         return {
             "id": uid,
-            "favoriteTeam_id": res.favoriteTeam_id
+            "favoriteTeam_id": res["favoriteTeam_id"] if res else None
         }
 
 @router.get("/all")
-@cache(expire=60 * 60 * 24)
+@cached(softTTL=60 * 60 * 24, hardTTL=60 * 60 * 24 * 7)
 async def getUsers():
-    clerkResp = httpx.get(
-        "https://api.clerk.dev/v1/users",
-        headers={"Authorization": "Bearer " + os.environ["CLERK_API_KEY"]}).json()
+    async with httpx.AsyncClient() as client:
+        clerkResp = (await client.get(
+            "https://api.clerk.dev/v1/users",
+            headers={"Authorization": "Bearer " + os.environ["CLERK_API_KEY"]})).json()
     users = {user["id"]: {"id": user["id"], "username": user["username"], "image_url": user["image_url"]} for user in clerkResp}
     return {
         "users": users
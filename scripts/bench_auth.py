@@ -0,0 +1,96 @@
+"""
+Benchmarks the latency of authenticating a request, before and after caching the Clerk JWKS.
+A fake JWKS server is started locally (with a bit of artificial latency, to look more like Clerk),
+and the same token is verified against it over and over.
+
+Usage: python -m scripts.bench_auth [iterations] [latency in ms]
+"""
+import asyncio
+import json
+import os
+import statistics
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import httpx
+from cryptography.hazmat.primitives.asymmetric import rsa
+from jwt import JWT, jwk_from_dict
+from jwt.jwk import RSAJWK
+
+ITERATIONS = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+LATENCY_MS = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+AUTHORIZED_PARTY = "http://localhost:5173"
+
+# Signing key and the JWKS document served for it
+signingKey = RSAJWK(rsa.generate_private_key(public_exponent=65537, key_size=2048), kid="bench-key")
+jwksDocument = json.dumps({"keys": [signingKey.to_dict()]}).encode()
+token = JWT().encode({"sub": "user_bench", "azp": AUTHORIZED_PARTY, "exp": int(time.time()) + 3600},
+                     signingKey, alg="RS256", optional_headers={"kid": "bench-key"})
+
+
+class FakeJWKSHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        time.sleep(LATENCY_MS / 1000)
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.end_headers()
+        self.wfile.write(jwksDocument)
+
+    def log_message(self, *args):
+        pass
+
+
+server = ThreadingHTTPServer(("127.0.0.1", 0), FakeJWKSHandler)
+threading.Thread(target=server.serve_forever, daemon=True).start()
+url = "http://127.0.0.1:{0}/v1/jwks".format(server.server_port)
+os.environ.setdefault("CLERK_API_KEY", "bench")
+os.environ["CLERK_JWKS_URL"] = url
+
+from pickem.lib.jwks import JWKSCache, getTokenKeyID  # noqa: E402 (needs the environment above)
+
+jwtInstance = JWT()
+
+
+def authenticateUncached():
+    """ The way get_user used to work: fetch the JWKS for every request. """
+    resp = httpx.get(url, headers={"Authorization": "Bearer " + os.environ["CLERK_API_KEY"]}).json()
+    message = jwtInstance.decode(token, jwk_from_dict(resp["keys"][0]))
+    assert message["azp"] == AUTHORIZED_PARTY
+    return message["sub"]
+
+
+cache = JWKSCache(url=url)
+
+
+async def authenticateCached():
+    message = jwtInstance.decode(token, await cache.getKey(getTokenKeyID(token)))
+    assert message["azp"] == AUTHORIZED_PARTY
+    return message["sub"]
+
+
+async def bench(name, fn):
+    timings = []
+    for _ in range(ITERATIONS):
+        start = time.perf_counter()
+        if asyncio.iscoroutinefunction(fn):
+            await fn()
+        else:
+            fn()
+        timings.append((time.perf_counter() - start) * 1000)
+    timings.sort()
+    print("{0:<10} mean {1:8.3f} ms   p50 {2:8.3f} ms   p99 {3:8.3f} ms".format(
+        name, statistics.mean(timings), timings[len(timings) // 2], timings[int(len(timings) * 0.99) - 1]))
+
+
+async def main():
+    print("{0} iterations, fake JWKS latency {1} ms".format(ITERATIONS, LATENCY_MS))
+    await bench("before", authenticateUncached)
+    await bench("after", authenticateCached)
+    print("JWKS fetches with cache:", cache.fetches)
+    await cache.close()
+
+
+asyncio.run(main())
+server.shutdown()
@@ -0,0 +1,93 @@
+"""
+Benchmarks the head-to-head query (crud.games.getHeadToHeadQuery) on a synthetic multi-season schedule,
+with and without the (homeTeam_id, awayTeam_id, date) index, and prints the query plans.
+
+The synthetic games go in a temporary table called `games`, which shadows the real one for this connection only
+(temporary tables come first in the search path), so the real query runs against it and nothing is written for real.
+
+Usage: python -m scripts.bench_head_to_head [seasons] [iterations]
+"""
+import datetime
+import random
+import statistics
+import sys
+import time
+
+from sqlalchemy import text
+from sqlalchemy.dialects import postgresql
+
+from pickem.db.alchemy import engine
+from pickem.db.crud.games import getHeadToHeadQuery, getSeasonBounds
+
+SEASONS = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+ITERATIONS = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+TEAMS = 30
+GAMES_PER_SEASON = 2430
+FIRST_SEASON = 2026 - SEASONS + 1
+
+
+def syntheticGames():
+    """ Roughly an MLB schedule: every team plays ~162 games between the end of March and the end of September. """
+    random.seed(42)
+    gameID = 0
+    for season in range(FIRST_SEASON, FIRST_SEASON + SEASONS):
+        opening = datetime.date(season, 3, 28)
+        for n in range(GAMES_PER_SEASON):
+            gameID += 1
+            home, away = random.sample(range(1, TEAMS + 1), 2)
+            date = opening + datetime.timedelta(days=n * 186 // GAMES_PER_SEASON)
+            start = datetime.datetime.combine(date, datetime.time(23, 5))
+            yield {"id": gameID, "home": home, "away": away, "date": date, "start": start,
+                   "venue": "Synthetic Park", "series": n // 10 + 1}
+
+
+def toSQL(query) -> str:
+    return str(query.compile(dialect=postgresql.dialect(), compile_kwargs={"literal_binds": True}))
+
+
+def run(conn, sql: str) -> list[float]:
+    timings = []
+    for _ in range(ITERATIONS):
+        start = time.perf_counter()
+        conn.execute(text(sql)).all()
+        timings.append((time.perf_counter() - start) * 1000)
+    return timings
+
+
+def report(conn, label: str, sql: str):
+    plan = "\n".join(row[0] for row in conn.execute(text("EXPLAIN (ANALYZE, BUFFERS) " + sql)))
+    timings = run(conn, sql)
+    print(f"--- {label}: median {statistics.median(timings):.3f} ms, "
+          f"p95 {statistics.quantiles(timings, n=20)[-1]:.3f} ms over {ITERATIONS} runs")
+    print(plan)
+    return plan
+
+
+def main():
+    with engine.connect() as conn:
+        conn.execute(text("CREATE TEMPORARY TABLE games (LIKE public.games INCLUDING DEFAULTS) ON COMMIT DROP"))
+        conn.execute(text('INSERT INTO games (id, "homeTeam_id", "awayTeam_id", date, "startTimeUTC", venue, '
+                          'finished, is_marquee, series_num) '
+                          'VALUES (:id, :home, :away, :date, :start, :venue, false, false, :series)'),
+                     list(syntheticGames()))
+        conn.execute(text("ANALYZE games"))
+        print(f"{SEASONS * GAMES_PER_SEASON} synthetic games over {SEASONS} seasons")
+
+        queries = {
+            "all-time head to head": toSQL(getHeadToHeadQuery(1, 2)),
+            "one season": toSQL(getHeadToHeadQuery(1, 2, *getSeasonBounds(FIRST_SEASON + SEASONS // 2))),
+        }
+        for label, sql in queries.items():
+            report(conn, label + " (no index)", sql)
+
+        conn.execute(text('CREATE INDEX ix_games_home_away_date ON games ("homeTeam_id", "awayTeam_id", date)'))
+        conn.execute(text("ANALYZE games"))
+        for label, sql in queries.items():
+            plan = report(conn, label + " (indexed)", sql)
+            if "ix_games_home_away_date" not in plan:
+                print(f"!!! {label} did not use ix_games_home_away_date")
+        conn.rollback()
+
+
+if __name__ == "__main__":
+    main()
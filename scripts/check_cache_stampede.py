@@ -0,0 +1,104 @@
+"""
+Checks that the response cache (pickem.lib.cache) makes one upstream call per expiry, however many requests come in
+at the same time: on a cold cache, once the soft TTL has passed (while the stale value is still served), and once the
+hard TTL has passed. Then, if REDIS_URL is set, that a cold start across several workers (caches sharing Redis)
+makes one upstream call for the whole cluster. Exits with an error if it doesn't.
+
+Usage: python -m scripts.check_cache_stampede [concurrent requests]
+"""
+import asyncio
+import os
+import sys
+import uuid
+
+from pickem.db.redis_pool import AsyncRedis
+from pickem.lib.cache import ResponseCache
+
+CONCURRENCY = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+WORKERS = 8
+SOFT_TTL = 10
+HARD_TTL = 60
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+async def checkCluster(failures: list):
+    """ Several caches sharing Redis, like the workers of a deployment, all starting cold at the same time. """
+    workers = [ResponseCache(AsyncRedis.binaryClient) for _ in range(WORKERS)]
+    key = "stampede-check:" + uuid.uuid4().hex
+    calls = 0
+
+    async def loader():
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.2)  # Long enough for every worker to miss
+        return {"version": calls}
+
+    results = await asyncio.gather(*(workers[n % WORKERS].get(key, loader, SOFT_TTL, HARD_TTL)
+                                     for n in range(CONCURRENCY)))
+    versions = {result["version"] for result in results}
+    ok = calls == 1 and versions == {1}
+    print(f"{'ok  ' if ok else 'FAIL'} cold cluster: {CONCURRENCY} requests over {WORKERS} workers, "
+          f"{calls} upstream calls, served versions {sorted(versions)}")
+    if not ok:
+        failures.append("cold cluster")
+    await workers[0].invalidate(key)
+    await AsyncRedis.close()
+
+
+async def main():
+    clock = FakeClock()
+    cache = ResponseCache(redis=None, clock=clock)
+    calls = 0
+    upstream = asyncio.Event()
+
+    async def loader():
+        nonlocal calls
+        calls += 1
+        await upstream.wait()  # Keep the upstream call "in flight" until every request has arrived
+        return {"version": calls}
+
+    async def requests():
+        pending = [asyncio.create_task(cache.get("leaderboard", loader, SOFT_TTL, HARD_TTL)) for _ in range(CONCURRENCY)]
+        await asyncio.sleep(0.01)
+        upstream.set()
+        results = await asyncio.gather(*pending)
+        upstream.clear()
+        await asyncio.sleep(0.01)  # Let background refreshes finish
+        return results
+
+    failures = []
+
+    def check(label: str, results, expectedCalls: int, expectedVersions: set):
+        versions = {result["version"] for result in results}
+        ok = calls == expectedCalls and versions == expectedVersions
+        print(f"{'ok  ' if ok else 'FAIL'} {label}: {CONCURRENCY} requests, {calls} upstream calls in total, "
+              f"served versions {sorted(versions)}")
+        if not ok:
+            failures.append(label)
+
+    check("cold cache", await requests(), 1, {1})
+    check("fresh", await requests(), 1, {1})
+
+    clock.now = SOFT_TTL + 1
+    check("after soft TTL (stale served, one refresh)", await requests(), 2, {1})
+    check("after the refresh", await requests(), 2, {2})
+
+    clock.now += HARD_TTL + 1
+    check("after hard TTL (waits for one refresh)", await requests(), 3, {3})
+
+    print(cache.stats())
+    if os.getenv("REDIS_URL"):
+        await checkCluster(failures)
+    if failures:
+        sys.exit("Stampede check failed: " + ", ".join(failures))
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,35 @@
+"""
+Grades the picks of every finished game with ungraded picks, or regrades the picks of the given games (e.g. after a
+result was corrected), like the API does on a schedule (see pickem.lib.grading). Prints what was graded.
+Waits for a grading round (or leaderboard rebuild) that's already running, and exits with an error if it doesn't end.
+
+Usage: python -m scripts.grade_picks [game ID ...]
+"""
+import asyncio
+import sys
+
+from pickem.db.alchemy import AsyncSessionLocal
+from pickem.db.crud.picks import getGamesToGrade, gradePicks
+from pickem.db.redis_pool import AsyncRedis
+from pickem.lib.grading import Grading
+
+
+async def main() -> int:
+    gameIDs = [int(gameID) for gameID in sys.argv[1:]] or None
+    try:
+        report = await Grading.grade(AsyncSessionLocal, getGamesToGrade, gradePicks, gameIDs)
+    finally:
+        await AsyncRedis.close()
+    if report is None:
+        print("Grading is already running (or the leaderboards are being rebuilt), try again later", file=sys.stderr)
+        return 1
+    print(f"Graded {report.gradedPicks} picks of {report.games} games in {report.batches} batches, "
+          f"in {report.seconds}s")
+    if not report.leaderboardsUpdated:
+        print("Could not update the leaderboards: the API rebuilds them after its next grading round once Redis is "
+              "back, or run `python -m scripts.rebuild_leaderboard`", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
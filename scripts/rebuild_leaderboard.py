@@ -0,0 +1,28 @@
+"""
+Recomputes the daily and series leaderboards in Redis (see pickem.lib.leaderboard), and the daily rollups the
+windowed leaderboards add up (see crud.picks.rebuildRollups), from the graded picks in the database. E.g. after picks
+were added to sessions after being graded, which the rollups don't follow. Grading waits while it runs.
+
+Usage: python -m scripts.rebuild_leaderboard
+"""
+import asyncio
+
+from pickem.db.alchemy import AsyncSessionLocal
+from pickem.db.crud.picks import get_leaders, rebuildRollups
+from pickem.db.redis_pool import AsyncRedis
+from pickem.lib.cache import Cache, LEADERBOARD_TAG
+from pickem.lib.leaderboard import Leaderboard
+
+
+async def main():
+    async with AsyncSessionLocal() as db:
+        await rebuildRollups(db)
+        counts = await Leaderboard.rebuild(db, get_leaders)
+    await Cache.invalidateTags(LEADERBOARD_TAG)
+    await AsyncRedis.close()
+    for mode, users in counts.items():
+        print(f"{mode}: {users} users")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
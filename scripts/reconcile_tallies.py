@@ -0,0 +1,74 @@
+"""
+Recounts the picks per game from the picks table and compares them with the counters in pick_tallies (kept by a
+trigger on picks, see crud.picks.getTalliesForGames). Prints every game whose counters drifted, then rebuilds them
+and invalidates the cached tallies for those games, unless run with --dry-run.
+Writes to picks wait while it runs, so the recount and the counters can't move apart in the meantime.
+
+Usage: python -m scripts.reconcile_tallies [--dry-run]
+"""
+import asyncio
+import os
+import sys
+
+from sqlalchemy import text
+
+from pickem.db.alchemy import engine
+from pickem.db.redis_pool import AsyncRedis
+from pickem.lib.cache import Cache, gameTag
+
+DRY_RUN = "--dry-run" in sys.argv
+
+DRIFT = """
+    WITH counted AS (
+        SELECT game_id, is_series, count(*) AS total_picks, count(*) FILTER (WHERE "pickedHome") AS home_picks
+        FROM picks
+        WHERE game_id IS NOT NULL AND is_series IS NOT NULL
+        GROUP BY game_id, is_series
+    )
+    SELECT coalesce(counted.game_id, pick_tallies.game_id) AS game_id,
+           coalesce(counted.is_series, pick_tallies.is_series) AS is_series,
+           pick_tallies.total_picks AS stored_total, pick_tallies.home_picks AS stored_home,
+           coalesce(counted.total_picks, 0) AS total, coalesce(counted.home_picks, 0) AS home
+    FROM counted
+    FULL OUTER JOIN pick_tallies USING (game_id, is_series)
+    WHERE coalesce(pick_tallies.total_picks, 0) <> coalesce(counted.total_picks, 0)
+       OR coalesce(pick_tallies.home_picks, 0) <> coalesce(counted.home_picks, 0)
+    ORDER BY 1, 2
+"""
+
+
+async def invalidate(gameIDs: set[int]):
+    await Cache.invalidateTags(*(gameTag(gameID) for gameID in gameIDs))
+    await AsyncRedis.close()
+
+
+def main():
+    with engine.begin() as conn:
+        conn.execute(text("LOCK TABLE picks IN SHARE MODE"))
+        drifted = conn.execute(text(DRIFT)).all()
+        for gameID, isSeries, storedTotal, storedHome, total, home in drifted:
+            print(f"game {gameID} ({'series' if isSeries else 'game'} picks): "
+                  f"stored {storedTotal or 0} total / {storedHome or 0} home, counted {total} total / {home} home")
+        print(f"{len(drifted)} drifted counters")
+        if DRY_RUN or not drifted:
+            return
+
+        for gameID, isSeries, _, _, total, home in drifted:
+            if total == 0:
+                conn.execute(text("DELETE FROM pick_tallies WHERE game_id = :game AND is_series = :series"),
+                             {"game": gameID, "series": isSeries})
+            else:
+                conn.execute(text("""
+                    INSERT INTO pick_tallies (game_id, is_series, total_picks, home_picks)
+                    VALUES (:game, :series, :total, :home)
+                    ON CONFLICT (game_id, is_series) DO UPDATE
+                    SET total_picks = EXCLUDED.total_picks, home_picks = EXCLUDED.home_picks
+                """), {"game": gameID, "series": isSeries, "total": total, "home": home})
+    print("Rebuilt the drifted counters")
+
+    if os.getenv("REDIS_URL"):
+        asyncio.run(invalidate({row[0] for row in drifted}))
+
+
+if __name__ == "__main__":
+    main()